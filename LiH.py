@@ -1,6 +1,7 @@
 import os
+import json
 import argparse
-from typing import Any, Union
+from typing import Any, Optional, Union
 import pandas as pd
 
 import jax
@@ -19,6 +20,13 @@ from ofdft_normflows.functionals import _kinetic, _hartree, _nuclear, _exchange_
 from ofdft_normflows.jax_ode import neural_ode, neural_ode_score
 from ofdft_normflows.cn_flows import Gen_CNFSimpleMLP as CNF
 from ofdft_normflows.utils import get_scheduler, batche_generator_1D
+from ofdft_normflows.ensemble import stack_trees, unstack_trees, broadcast_members
+from ofdft_normflows.continuation import run_continuation, time_to_accuracy
+from ofdft_normflows.hartree_estimators import hartree_ustat
+from ofdft_normflows.poisson import hartree_grid
+from ofdft_normflows.quadrature import quadrature_1d, quadrature_energy
+from ofdft_normflows.convergence import get_monitor, add_convergence_args, monitor_from_args
+from ofdft_normflows.compilation import WarmUp, batch_spec, add_compilation_args, cache_from_args
 
 
 import matplotlib.pyplot as plt
@@ -37,6 +45,20 @@ class F_values:
     hart: chex.ArrayDevice
     xc: chex.ArrayDevice
 
+def get_ckpt_dir(tw_kin: str, v_pot: str, h_pot: str, xc_pot: str, scheduler_type: str, run: str,
+                 hartree_est: str = 'pair', loss_mode: str = 'mc', quad_rule: str = 'gauss',
+                 n_quad: int = 256) -> str:
+    """Results directory of a run, 'run' is 'lr_{lr:.1e}' (single run), 'scan' or 'continuation'."""
+    ckpt_dir = f"Results/{mol_name}_{tw_kin.upper()}_{v_pot.upper()}_{h_pot.upper()}_{xc_pot.upper()}_{run}"
+    if scheduler_type.lower() != 'c' or scheduler_type.lower() != 'const':
+        ckpt_dir = ckpt_dir + f"_sched_{scheduler_type.upper()}"
+    if hartree_est != 'pair':
+        ckpt_dir = ckpt_dir + f"_{hartree_est}"
+    if loss_mode == 'quad':
+        ckpt_dir = ckpt_dir + f"_quad_{quad_rule}{n_quad}"
+    return ckpt_dir
+
+
 def training(tw_kin: str = 'TF',
             v_pot: str = 'HGH',
             h_pot: str = 'MT',
@@ -49,13 +71,27 @@ def training(tw_kin: str = 'TF',
             scheduler_type: str = 'mix', 
             R:float = 10., 
             Z_alpha:int = 3, 
-            Z_beta:int = 1):
+            Z_beta:int = 1,
+            xc_weight: float = 1.,
+            params_init: Any = None,
+            monitor: Any = None,
+            ckpt_dir: str = None,
+            hartree_est: str = 'pair',
+            hartree_tile: int = 256,
+            n_grid: int = 512,
+            compile_only: bool = False,
+            loss_mode: str = 'mc',
+            quad_rule: str = 'gauss',
+            n_quad: int = 256):
     
-    CKPT_DIR = f"Results/{mol_name}_{tw_kin.upper()}_{v_pot.upper()}_{h_pot.upper()}_{xc_pot.upper()}_lr_{lr:.1e}"
-    if scheduler_type.lower() != 'c' or scheduler_type.lower() != 'const':
-        CKPT_DIR = CKPT_DIR + f"_sched_{scheduler_type.upper()}"
+    CKPT_DIR = get_ckpt_dir(tw_kin, v_pot, h_pot, xc_pot, scheduler_type, f"lr_{lr:.1e}",
+                            hartree_est, loss_mode, quad_rule, n_quad)
+    if ckpt_dir is not None:
+        CKPT_DIR = ckpt_dir
     FIG_DIR = f"{CKPT_DIR}/Figures"
-    CKPT_DIR_ALL = f"{CKPT_DIR}/checkpoints_all/"
+    CKPT_DIR_ALL = os.path.abspath(f"{CKPT_DIR}/checkpoints_all/")
+    if not os.path.exists(FIG_DIR):
+        os.makedirs(FIG_DIR)
 
   
     png = jrnd.PRNGKey(0)
@@ -65,7 +101,9 @@ def training(tw_kin: str = 'TF',
     model_fwd = CNF(1, (512, 512, 512, ), bool_neg=True)
     test_inputs = lax.concatenate((jnp.ones((1, 1)), jnp.ones((1, 1))), 1)
     params = model_rev.init(key, jnp.array(0.), test_inputs)
-    params_init = params
+    if params_init is not None:
+        # warm start, e.g. from a neighbouring point of a continuation path
+        params = params_init
 
     @jax.jit
     def NODE_rev(params, batch): return neural_ode(
@@ -77,7 +115,7 @@ def training(tw_kin: str = 'TF',
     
     prior_dist = MultivariateNormalDiag(jnp.zeros(1), 1.*jnp.ones(1))
     
-    lr_sched = get_scheduler(epochs,scheduler_type,3E-4)
+    lr_sched = get_scheduler(epochs,scheduler_type,lr)
     optimizer = optax.chain(
         optax.clip_by_global_norm(1.0),
         optax.rmsprop(learning_rate=lr_sched)
@@ -104,6 +142,11 @@ def training(tw_kin: str = 'TF',
         z0, logp_z0 = NODE_rev(params, zt)
         logp_x = prior_dist.log_prob(z0)[:, None] - logp_z0
         return jnp.exp(logp_x)  
+
+    def log_rho_rev(params, x):
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = NODE_rev(params, zt)
+        return prior_dist.log_prob(z0) - logp_z0.ravel()
     
     @jax.jit
     def _integral(params,x):
@@ -123,9 +166,16 @@ def training(tw_kin: str = 'TF',
         x, xp = x_all[:batch_size], x_all[batch_size:]
         score, scorep = score_all[:batch_size], score_all[batch_size:]
         e_t = t_functional(den, score, Ne)
-        e_h = vh_functional(x, xp, Ne)
+        if hartree_est == 'ustat':
+            # all distinct pairs of the 2B samples instead of (x_i, x_{i+B})
+            e_h = hartree_ustat(x_all, Ne, vh_functional, hartree_tile)
+        elif hartree_est == 'grid':
+            # soft-Coulomb convolution on a (doubled) 1D grid with FFTs
+            e_h = hartree_grid(x_all, Ne, 'softc', n_grid)
+        else:
+            e_h = vh_functional(x, xp, Ne)
         e_nuc_v = v_functional(x, R, Z_alpha, Z_beta,Ne)
-        e_xc =  xc_functional(den,Ne)
+        e_xc =  xc_weight*xc_functional(den,Ne)
         
         e = e_t + e_h + e_nuc_v + e_xc 
         energy = jnp.mean(e)
@@ -136,6 +186,24 @@ def training(tw_kin: str = 'TF',
                             xc= jnp.mean(e_xc),
                             )
         return energy, f_values
+
+    if loss_mode == 'quad':
+        # deterministic energy, every term by quadrature over the reverse-evaluated density
+        # (the batches are not used), see 'quadrature.quadrature_energy'
+        q = quadrature_1d(quad_rule, n_quad, -20., 20.)
+
+        def local_terms(den, score, x):
+            return {'kin': t_functional(den, score, Ne),
+                    'vnuc': v_functional(x, R, Z_alpha, Z_beta, Ne),
+                    'xc': xc_weight*xc_functional(den, Ne)}
+
+        @jax.jit
+        def loss(params, u_samples):
+            terms = quadrature_energy(log_rho_rev, params, q, local_terms, vh_functional, Ne, hartree_tile)
+            energy = terms['kin'] + terms['vnuc'] + terms['hart'] + terms['xc']
+            f_values = F_values(energy=energy, kin=terms['kin'], vnuc=terms['vnuc'],
+                                hart=terms['hart'], xc=terms['xc'])
+            return energy, f_values
     
     @jax.jit
     def step(params, opt_state, batch):
@@ -150,6 +218,16 @@ def training(tw_kin: str = 'TF',
     _, key = jrnd.split(key)
     gen_batches = batche_generator_1D(key, batch_size, prior_dist)
     # gen_batches = batch_generator(key, batch_size, prior_dist)
+    zt = jnp.linspace(-20., 20., num=2048)[:, jnp.newaxis]
+
+    # ahead-of-time compilation with the shapes of this run (loaded from the persistent cache if available)
+    warmup = WarmUp()
+    step = warmup.compile('step', step, params, opt_state, batch_spec(batch_size, 1))
+    _integral = warmup.compile('integral', _integral, params, zt)
+    print(warmup.summary())
+    warmup.write(CKPT_DIR)
+    if compile_only:
+        return params, {'epochs': 0, 'compile_time': warmup.total}
 
     for i in range(epochs+1):
         batch = next(gen_batches)
@@ -159,7 +237,6 @@ def training(tw_kin: str = 'TF',
         energies_i_ema, energies_state = energies_ema.update(
             losses, energies_state)
         ei_ema = energies_i_ema.energy
-        zt = jnp.linspace(-20., 20., num=2048)[:, jnp.newaxis]
         norm_val, rho_pred = _integral(params,zt)
         
         r_ = {'epoch': i,
@@ -198,6 +275,297 @@ def training(tw_kin: str = 'TF',
             plt.tight_layout()
             plt.savefig(f'{FIG_DIR}/epoch_rho_z_{i}.svg', transparent=True)
             plt.savefig(f'{FIG_DIR}/epoch_rho_z_{i}.png')
+            plt.close('all')
+
+        if monitor is not None and monitor.update(i, ei_ema, loss_epoch, norm_val):
+            print(f'converged at epoch {i}: {monitor.reason}')
+            break
+
+    checkpoints.save_checkpoint(
+        ckpt_dir=os.path.abspath(f"{CKPT_DIR}/checkpoints/"), target=params, step=i, overwrite=True)
+    info = {'epochs': i + 1, 'E': float(ei_ema), 'I': float(norm_val), 'compile_time': warmup.total,
+            'converged': monitor is not None and monitor.converged,
+            'reason': None if monitor is None else monitor.reason}
+    with open(f"{CKPT_DIR}/completed.json", "w") as outfile:
+        json.dump({'epoch': i, **info}, outfile, indent=4)
+    return params, info
+
+
+def training_continuation(tw_kin: str = 'TF',
+                          v_pot: str = 'HGH',
+                          h_pot: str = 'MT',
+                          xc_pot: str = 'dirac',
+                          Ne: int = 2,
+                          batch_size: int = 256,
+                          epochs: int = 2000,
+                          lr: float = 1E-5,
+                          scheduler_type: str = 'mix',
+                          R: tuple = (10.,),
+                          xc_weight: tuple = (1.,),
+                          Z_alpha: int = 3,
+                          Z_beta: int = 1,
+                          bool_extrapolate: bool = False,
+                          get_point_monitor: Any = None,
+                          bool_compare_cold: bool = False):
+    """
+    Continuation along a bond-stretch and/or exchange-correlation mixing path.
+    The points (R, xc_weight) are ordered along the path and each one is
+    initialized from the converged flow of its neighbour (optionally
+    extrapolated from the two previous points). Every point stops once the
+    monitor returned by 'get_point_monitor()' is converged (by default the EMA
+    energy changes less than 1E-4 over 200 epochs), 'epochs' is only an upper bound.
+    With 'bool_compare_cold' every point is also trained from the identity-initialized
+    flow, the epochs and wall times of both modes are written to the scan CSV.
+    """
+    CKPT_DIR = get_ckpt_dir(tw_kin, v_pot, h_pot, xc_pot, scheduler_type, 'continuation')
+
+    n_points = max(len(R), len(xc_weight))
+    points = list(zip(broadcast_members(R, n_points),
+                      broadcast_members(xc_weight, n_points)))
+    bool_mixing = len(set(p[1] for p in points)) > 1
+    bool_geometry = len(set(p[0] for p in points)) > 1
+    if bool_mixing and not bool_geometry:
+        path = [p[1] for p in points]
+    elif bool_geometry and not bool_mixing:
+        path = [p[0] for p in points]
+    else:
+        path = points
+
+    def train_point(s, params, mode='warm'):
+        R_i, w_i = points[path.index(s)]
+        monitor = get_point_monitor() if get_point_monitor is not None else get_monitor('ema')
+        point_dir = f"R_{R_i:.4f}_Z_{Z_alpha}_{Z_beta}_xc_{w_i:.3f}"
+        if mode == 'cold':
+            point_dir = f"cold/{point_dir}"
+        params, info = training(tw_kin, v_pot, h_pot, xc_pot, Ne, batch_size, epochs, lr,
+                                False, scheduler_type, R_i, Z_alpha, Z_beta,
+                                xc_weight=w_i, params_init=params, monitor=monitor,
+                                ckpt_dir=f"{CKPT_DIR}/{point_dir}")
+        print(f"R = {R_i:.4f}, xc = {w_i:.3f} ({mode}): {info['epochs']} epochs, E = {info['E']:.6f}")
+        return params, info
+
+    train_cold = (lambda s, params: train_point(s, params, 'cold')) if bool_compare_cold else None
+    results = run_continuation(train_point, path, None, bool_extrapolate, train_cold=train_cold)
+
+    rows = []
+    for r in results:
+        row = {'R': points[r['index']][0], 'xc_weight': points[r['index']][1], **r['info']}
+        if bool_compare_cold:
+            row.update({'epochs_cold': r['info_cold']['epochs'], 'E_cold': r['info_cold']['E'],
+                        'wall_time_cold': r['info_cold']['wall_time']})
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    df.to_csv(f"{CKPT_DIR}/continuation_{mol_name}.csv", index=False)
+    print(f"total epochs: {df['epochs'].sum()}")
+    if bool_compare_cold:
+        summary = time_to_accuracy(results)
+        print(f"warm start: {summary['epochs_warm']} epochs, {summary['wall_time_warm']:.1f} s; "
+              f"cold start: {summary['epochs_cold']} epochs, {summary['wall_time_cold']:.1f} s")
+        with open(f"{CKPT_DIR}/continuation_{mol_name}_time_to_accuracy.json", "w") as outfile:
+            json.dump(summary, outfile, indent=4)
+    return df
+
+def training_scan(tw_kin: str = 'TF',
+                  v_pot: str = 'HGH',
+                  h_pot: str = 'MT',
+                  xc_pot: str = 'dirac',
+                  Ne: int = 2,
+                  batch_size: int = 256,
+                  epochs: int = 2000,
+                  lr: float = 3E-4,
+                  scheduler_type: str = 'mix',
+                  R: tuple = (10.,),
+                  Z_alpha: tuple = (3,),
+                  Z_beta: tuple = (1,),
+                  monitors: Optional[list] = None):
+    """
+    Trains one flow per interatomic distance in a single process. The parameters
+    and optimizer states of all points are stacked and 'step' is vmapped over
+    (R, Z_alpha, Z_beta), so the 'CNFSimpleMLP' is compiled once for the whole
+    bond-length scan. All points share the same batch of prior samples, hence
+    every point reproduces the corresponding single '--R' run.
+    With 'monitors' (one convergence monitor per point) the scan stops once all
+    the points are converged.
+    """
+
+    CKPT_DIR = get_ckpt_dir(tw_kin, v_pot, h_pot, xc_pot, scheduler_type, 'scan')
+    FIG_DIR = f"{CKPT_DIR}/Figures"
+    for d in (CKPT_DIR, FIG_DIR):
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+    n_points = max(len(R), len(Z_alpha), len(Z_beta))
+    R = jnp.array(broadcast_members(R, n_points), dtype=float)
+    Z_alpha = jnp.array(broadcast_members(Z_alpha, n_points), dtype=float)
+    Z_beta = jnp.array(broadcast_members(Z_beta, n_points), dtype=float)
+
+    png = jrnd.PRNGKey(0)
+    _, key = jrnd.split(png)
+
+    model_rev = CNF(1, (512, 512, 512, ), bool_neg=False)
+    model_fwd = CNF(1, (512, 512, 512, ), bool_neg=True)
+    test_inputs = lax.concatenate((jnp.ones((1, 1)), jnp.ones((1, 1))), 1)
+    params = model_rev.init(key, jnp.array(0.), test_inputs)
+    params = stack_trees([params]*n_points)
+
+    @jax.jit
+    def NODE_rev(params, batch): return neural_ode(
+        params, batch, model_rev, -1., 0., 1)
+
+    @jax.jit
+    def NODE_fwd_score(params, batch): return neural_ode_score(
+        params, batch, model_fwd, 0., 1., 1)
+
+    prior_dist = MultivariateNormalDiag(jnp.zeros(1), 1.*jnp.ones(1))
+
+    lr_sched = get_scheduler(epochs, scheduler_type, lr)
+    optimizer = optax.chain(
+        optax.clip_by_global_norm(1.0),
+        optax.rmsprop(learning_rate=lr_sched)
+    )
+    opt_state = jax.vmap(optimizer.init)(params)
+    energies_ema = ema(decay=0.99)
+    zeros = jnp.zeros(n_points)
+    energies_state = energies_ema.init(
+        F_values(energy=zeros, kin=zeros, vnuc=zeros, hart=zeros, xc=zeros))
+
+    @jax.jit
+    def rho_x_score(params, samples):
+        zt, logp_zt, score_zt = NODE_fwd_score(params, samples)
+        return jnp.exp(logp_zt), zt, score_zt
+
+    @jax.jit
+    def rho_rev(params, x):
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = NODE_rev(params, zt)
+        logp_x = prior_dist.log_prob(z0)[:, None] - logp_z0
+        return jnp.exp(logp_x)
+
+    @jax.jit
+    def _integral(params, x):
+        p_x = jax.vmap(rho_rev, in_axes=(0, None))(params, x)
+        return jax.vmap(lambda p: jnp.trapz(p.ravel(), x.ravel()))(p_x), p_x
+
+    t_functional = _kinetic(tw_kin)
+    v_functional = _nuclear(v_pot)
+    vh_functional = _hartree(h_pot)
+    xc_functional = _exchange_correlation(xc_pot)
+
+    def loss(params, u_samples, R, Z_alpha, Z_beta):
+        den_all, x_all, score_all = rho_x_score(params, u_samples)
+
+        den, denp = den_all[:batch_size], den_all[batch_size:]
+        x, xp = x_all[:batch_size], x_all[batch_size:]
+        score, scorep = score_all[:batch_size], score_all[batch_size:]
+        e_t = t_functional(den, score, Ne)
+        e_h = vh_functional(x, xp, Ne)
+        e_nuc_v = v_functional(x, R, Z_alpha, Z_beta, Ne)
+        e_xc = xc_functional(den, Ne)
+
+        e = e_t + e_h + e_nuc_v + e_xc
+        energy = jnp.mean(e)
+        f_values = F_values(energy=energy,
+                            kin=jnp.mean(e_t),
+                            vnuc=jnp.mean(e_nuc_v),
+                            hart=jnp.mean(e_h),
+                            xc=jnp.mean(e_xc),
+                            )
+        return energy, f_values
+
+    def _step(params, opt_state, batch, R, Z_alpha, Z_beta):
+        loss_value, grads = jax.value_and_grad(
+            loss, has_aux=True)(params, batch, R, Z_alpha, Z_beta)
+        updates, opt_state = optimizer.update(grads, opt_state, params)
+        params = optax.apply_updates(params, updates)
+        return params, opt_state, loss_value
+
+    step = jax.jit(jax.vmap(_step, in_axes=(0, 0, None, 0, 0, 0)))
+
+    df = pd.DataFrame()
+    df_ema = pd.DataFrame()
+    _, key = jrnd.split(key)
+    gen_batches = batche_generator_1D(key, batch_size, prior_dist)
+    zt = jnp.linspace(-20., 20., num=2048)[:, jnp.newaxis]
+
+    for i in range(epochs+1):
+        batch = next(gen_batches)
+        params, opt_state, loss_value = step(
+            params, opt_state, batch, R, Z_alpha, Z_beta)
+        loss_epoch, losses = loss_value
+
+        energies_i_ema, energies_state = energies_ema.update(
+            losses, energies_state)
+        norm_val, rho_pred = _integral(params, zt)
+
+        if monitors is not None:
+            for k, monitor in enumerate(monitors):
+                if not monitor.converged:
+                    monitor.update(i, energies_i_ema.energy[k], loss_epoch[k], norm_val[k])
+
+        r_ = {'epoch': i, 'R': R, 'Z_alpha': Z_alpha, 'Z_beta': Z_beta,
+              'E': loss_epoch,
+              'T': losses.kin, 'V': losses.vnuc, 'H': losses.hart, 'XC': losses.xc,
+              'I': norm_val,
+              }
+        df = pd.concat([df, pd.DataFrame(r_)], ignore_index=True)
+        df.to_csv(
+            f"{CKPT_DIR}/training_trajectory_{mol_name}.csv", index=False)
+
+        r_ema = {'epoch': i, 'R': R, 'Z_alpha': Z_alpha, 'Z_beta': Z_beta,
+                 'E': energies_i_ema.energy,
+                 'T': energies_i_ema.kin, 'V': energies_i_ema.vnuc, 'H': energies_i_ema.hart, 'XC': energies_i_ema.xc,
+                 'I': norm_val,
+                 }
+        df_ema = pd.concat([df_ema, pd.DataFrame(r_ema)], ignore_index=True)
+        df_ema.to_csv(
+            f"{CKPT_DIR}/training_trajectory_{mol_name}_ema.csv", index=False)
+
+        for k, params_k in enumerate(unstack_trees(params)):
+            checkpoints.save_checkpoint(
+                ckpt_dir=os.path.abspath(
+                    f"{CKPT_DIR}/R_{float(R[k]):.4f}_Z_{int(Z_alpha[k])}_{int(Z_beta[k])}/checkpoints_all/"),
+                target=params_k, step=i, keep_every_n_steps=10, overwrite=True)
+
+        if i % 10 == 0:
+            plt.clf()
+            fig, ax = plt.subplots()
+            ax.text(0.075, 0.92,
+                    f'({i})', transform=ax.transAxes, va='top', fontsize=10)
+            for k in range(n_points):
+                ax.plot(zt, Ne*rho_pred[k], label=f'R={float(R[k]):.2f}')
+            plt.xlabel('X [Bhor]')
+            plt.ylabel(r'$N_{e}\;\rho_{NF}(x)$')
+            plt.legend(fontsize=6)
+            plt.tight_layout()
+            plt.savefig(f'{FIG_DIR}/epoch_rho_z_{i}.svg', transparent=True)
+            plt.savefig(f'{FIG_DIR}/epoch_rho_z_{i}.png')
+            plt.close('all')
+
+        if monitors is not None and all(monitor.converged for monitor in monitors):
+            print(f'all points converged at epoch {i}')
+            break
+
+    # energy vs R (EMA values of the last epoch)
+    df_R = pd.DataFrame({'R': R, 'Z_alpha': Z_alpha, 'Z_beta': Z_beta,
+                         'E': energies_i_ema.energy,
+                         'T': energies_i_ema.kin, 'V': energies_i_ema.vnuc,
+                         'H': energies_i_ema.hart, 'XC': energies_i_ema.xc,
+                         'I': norm_val})
+    if monitors is not None:
+        df_R['converged_epoch'] = [m.epoch for m in monitors]
+        df_R['reason'] = [m.reason for m in monitors]
+    df_R = df_R.sort_values('R')
+    df_R.to_csv(f"{CKPT_DIR}/energy_vs_R_{mol_name}.csv", index=False)
+    return df_R
+
+
+def parse_scan(values: str) -> tuple:
+    """Parses '0.5,1.,1.5' or 'start:stop:num' into a tuple of floats."""
+    if ':' in values:
+        start, stop, num = values.split(':')
+        return tuple(float(v) for v in jnp.linspace(float(start), float(stop), int(num)))
+    return tuple(float(v) for v in values.split(','))
+
 
 def main():
     parser = argparse.ArgumentParser(description="Density fitting training")
@@ -221,7 +589,36 @@ def main():
     parser.add_argument("--R", type=float, default=0.7, help="R parameter")
     parser.add_argument("--Z_alpha", type=int, default=3,help="Nuclei of charges")
     parser.add_argument("--Z_beta", type=int, default=1,help="Nucleis of charges")
+    parser.add_argument("--R_scan", type=str, default=None,
+                        help="bond-length scan, 'R1,R2,...' or 'start:stop:num'")
+    parser.add_argument("--Z_alpha_scan", type=str, default=None,
+                        help="per-point Z_alpha of the scan, comma separated")
+    parser.add_argument("--Z_beta_scan", type=str, default=None,
+                        help="per-point Z_beta of the scan, comma separated")
+    parser.add_argument("--continuation", action='store_true',
+                        help="warm-start each point of '--R_scan'/'--xc_scan' from its neighbour")
+    parser.add_argument("--xc_scan", type=str, default=None,
+                        help="exchange-correlation mixing path, 'w1,w2,...' or 'start:stop:num'")
+    parser.add_argument("--extrapolate", action='store_true',
+                        help="extrapolate the initial parameters from the two previous points")
+    parser.add_argument("--compare_cold", action='store_true',
+                        help="continuation, also train every point from scratch and report the epochs/wall time of both")
+    parser.add_argument("--hartree_est", type=str, default='pair',
+                        help="Hartree estimator, 'pair' (x_i, x_i+B), 'ustat' (all pairs) or 'grid' (FFT)")
+    parser.add_argument("--hartree_tile", type=int, default=256,
+                        help="tile size of the 'ustat' Hartree estimator")
+    parser.add_argument("--n_grid", type=int, default=512,
+                        help="grid points of the 'grid' Hartree estimator")
+    parser.add_argument("--loss", type=str, default='mc', choices=['mc', 'quad'],
+                        help="energy by Monte Carlo over samples or by quadrature of the density")
+    parser.add_argument("--quad_rule", type=str, default='gauss', choices=['gauss', 'trapz'],
+                        help="rule of '--loss quad', Gauss-Legendre or trapezoid on [-20, 20]")
+    parser.add_argument("--n_quad", type=int, default=256,
+                        help="nodes of '--loss quad'")
+    add_convergence_args(parser)
+    add_compilation_args(parser)
     args = parser.parse_args()
+    cache_from_args(args)
 
     batch_size = args.bs
     epochs = args.epochs
@@ -242,9 +639,36 @@ def main():
     global FIG_DIR
     global mol_name
     mol_name = 'LiH'
-    CKPT_DIR = f"Results/{mol_name}_{tw_kin.upper()}_{v_pot.upper()}_{h_pot.upper()}_{xc_pot.upper()}_lr_{lr:.1e}"
-    if scheduler_type.lower() != 'c' or scheduler_type.lower() != 'const':
-        CKPT_DIR = CKPT_DIR + f"_sched_{scheduler_type.upper()}"
+
+    if args.compile_only and (args.continuation or args.R_scan is not None):
+        parser.error("'--compile_only' is only available for single runs")
+    if args.loss == 'quad' and (args.continuation or args.R_scan is not None):
+        parser.error("'--loss quad' is only available for single runs")
+    if args.loss == 'quad' and args.hartree_est != 'pair':
+        parser.error("'--loss quad' computes the Hartree energy by quadrature, drop '--hartree_est'")
+
+    if args.continuation:
+        Rs = parse_scan(args.R_scan) if args.R_scan else (R,)
+        xc_ws = parse_scan(args.xc_scan) if args.xc_scan else (1.,)
+        # continuation always stops on convergence, '--early_stop ema' by default
+        args.early_stop = args.early_stop or 'ema'
+        training_continuation(tw_kin, v_pot, h_pot, xc_pot, Ne, batch_size, epochs, lr,
+                              scheduler_type, Rs, xc_ws, Z_alpha, Z_beta,
+                              args.extrapolate, lambda: monitor_from_args(args), args.compare_cold)
+        return
+
+    if args.R_scan is not None:
+        Rs = parse_scan(args.R_scan)
+        Zs_alpha = parse_scan(args.Z_alpha_scan) if args.Z_alpha_scan else (Z_alpha,)
+        Zs_beta = parse_scan(args.Z_beta_scan) if args.Z_beta_scan else (Z_beta,)
+        n_points = max(len(Rs), len(Zs_alpha), len(Zs_beta))
+        monitors = [monitor_from_args(args) for _ in range(n_points)] if args.early_stop else None
+        training_scan(tw_kin, v_pot, h_pot, xc_pot, Ne, batch_size, epochs, lr,
+                      scheduler_type, Rs, Zs_alpha, Zs_beta, monitors)
+        return
+
+    CKPT_DIR = get_ckpt_dir(tw_kin, v_pot, h_pot, xc_pot, scheduler_type, f"lr_{lr:.1e}",
+                            args.hartree_est, args.loss, args.quad_rule, args.n_quad)
     FIG_DIR = f"{CKPT_DIR}/Figures"
     CKPT_DIR_ALL = f"{CKPT_DIR}/checkpoints_all/"
 
@@ -256,7 +680,10 @@ def main():
     if not os.path.exists(fwd):
         os.makedirs(fwd)
 
-    training(tw_kin, v_pot, h_pot, xc_pot,Ne, batch_size, epochs, lr, bool_params, scheduler_type,R,Z_alpha,Z_beta)
+    training(tw_kin, v_pot, h_pot, xc_pot,Ne, batch_size, epochs, lr, bool_params, scheduler_type,R,Z_alpha,Z_beta,
+             monitor=monitor_from_args(args), hartree_est=args.hartree_est, hartree_tile=args.hartree_tile,
+             n_grid=args.n_grid, compile_only=args.compile_only,
+             loss_mode=args.loss, quad_rule=args.quad_rule, n_quad=args.n_quad)
 
 
 if __name__ == "__main__":
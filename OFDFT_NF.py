@@ -23,6 +23,16 @@ from ofdft_normflows.equiv_flows import Gen_EqvFlow as GCNF
 from ofdft_normflows import ProMolecularDensity
 from ofdft_normflows import get_scheduler, batch_generator
 from ofdft_normflows.utils import one_hot_encode, coordinates
+from ofdft_normflows.ensemble import stack_trees, unstack_trees, broadcast_members, ensemble_batch_generator
+from ofdft_normflows.convergence import add_convergence_args, monitor_from_args
+from ofdft_normflows.compilation import WarmUp, batch_spec, add_compilation_args, cache_from_args
+from ofdft_normflows.bucketing import BucketedFunction
+from ofdft_normflows.composite_functionals import composite_functional, group_energies
+from ofdft_normflows.hartree_estimators import hartree_ustat
+from ofdft_normflows.tree_code import hartree_tree
+from ofdft_normflows.poisson import hartree_grid
+from ofdft_normflows.hgh_pseudopotentials import HGH_PARAMS, valence_electrons, compile_projectors, hgh_nonlocal
+from ofdft_normflows.quadrature import becke_quadrature, quadrature_energy
 
 import matplotlib.pyplot as plt
 
@@ -59,13 +69,32 @@ def training(mol_name: str,
             lr: float = 1E-5,
             nn_arch: tuple = (512, 512,),
             bool_load_params: bool = False,
-            scheduler_type: str = 'ones'):
+            scheduler_type: str = 'ones',
+            monitor: Any = None,
+            spec: str = None,
+            hartree_est: str = 'pair',
+            hartree_tile: int = 256,
+            theta: float = 0.5,
+            n_grid: int = 64,
+            poisson: str = 'hockney',
+            compile_only: bool = False,
+            norm_every: int = 1,
+            loss_mode: str = 'mc',
+            quad_level: int = 1):
     
-    CKPT_DIR_ALL = f"{CKPT_DIR}/checkpoints_all/"
+    CKPT_DIR_ALL = os.path.abspath(f"{CKPT_DIR}/checkpoints_all/")
+    CKPT_DIR_FINAL = os.path.abspath(f"{CKPT_DIR}/checkpoints/")
 
     Ne,atoms,z,coords = coordinates(mol_name)
     mol = {'coords': coords, 'z': z}
     mu = coords
+    z_prior = z.ravel()
+    bool_hgh = v_pot.lower() in ('hgh', 'nuclei_potential_hgh')
+    if bool_hgh:
+        # the core electrons are replaced by the pseudopotentials
+        Ne = valence_electrons(mol, Ne)
+        z_prior = jnp.array([float(HGH_PARAMS[int(zi)][1]) for zi in z.ravel()])
+        hgh_projectors = compile_projectors(mol)
     
     png = jrnd.PRNGKey(0)
     _, key = jrnd.split(png)
@@ -94,7 +123,7 @@ def training(mol_name: str,
     def NODE_fwd_score(params, batch): return neural_ode_score(
         params, batch, model_fwd, 0., 1., 3)    
    
-    prior_dist =ProMolecularDensity(z.ravel(), mu)
+    prior_dist =ProMolecularDensity(z_prior, mu)
    
     m = DFTDistribution(atoms, coords)
     normalization_array = (m.coords, m.weights)
@@ -130,6 +159,11 @@ def training(mol_name: str,
         logp_x = prior_dist.log_prob(z0) - logp_z0
         return jnp.exp(logp_x)  # logp_x
 
+    def log_rho_rev(params, x):
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = NODE_rev(params, zt)
+        return jnp.reshape(prior_dist.log_prob(z0) - logp_z0, (-1,))
+
     @jax.jit
     def T(params, samples):
         zt, _ = NODE_fwd(params, samples)
@@ -140,6 +174,9 @@ def training(mol_name: str,
     vh_functional = _hartree(h_pot)
     x_functional = _exchange_correlation(x_pot)
     c_functional = _exchange_correlation(c_pot)
+    if spec is not None:
+        # single fused kernel for all the terms, replaces '--kin', '--nuc', '--hart', '--x' and '--c'
+        e_functional = composite_functional(spec, Ne, mol)
 
     @jax.jit
     def loss(params, u_samples):
@@ -149,9 +186,32 @@ def training(mol_name: str,
         x, xp = x_all[:batch_size], x_all[batch_size:]
         score, scorep = score_all[:batch_size], score_all[batch_size:]
 
+        if spec is not None:
+            e, terms = e_functional(den, score, x, xp)
+            groups = group_energies(terms)
+            energy = jnp.mean(e)
+            f_values = F_values(energy=energy,
+                                kin=jnp.mean(groups['kin']),
+                                vnuc=jnp.mean(groups['vnuc']),
+                                hart=jnp.mean(groups['hart']),
+                                xc=jnp.mean(groups['xc']))
+            return energy, f_values
+
         e_t = t_functional(den, score, Ne)
-        e_h = vh_functional(x, xp, Ne)
+        if hartree_est == 'ustat':
+            # all distinct pairs of the 2B samples instead of (x_i, x_{i+B})
+            e_h = hartree_ustat(x_all, Ne, vh_functional, hartree_tile)
+        elif hartree_est == 'tree':
+            # Barnes-Hut all-pairs estimate (softened Coulomb kernel of 'hartree')
+            e_h = hartree_tree(x_all, Ne, theta)
+        elif hartree_est == 'grid':
+            # particle-mesh all-pairs estimate, Poisson equation solved with FFTs
+            e_h = hartree_grid(x_all, Ne, h_pot, n_grid, poisson)
+        else:
+            e_h = vh_functional(x, xp, Ne)
         e_nuc_v = v_functional(x, Ne, mol)
+        if bool_hgh:
+            e_nuc_v = e_nuc_v + hgh_nonlocal(x, xp, den, denp, Ne, hgh_projectors)
         e_x = x_functional(den,score,Ne)
         e_c = c_functional(den,Ne)
       
@@ -164,6 +224,25 @@ def training(mol_name: str,
                             hart=jnp.mean(e_h),
                             xc=jnp.mean(e_x + e_c))
         return energy, f_values
+
+    if loss_mode == 'quad':
+        # deterministic energy on a Becke grid built once (screened with the prior), the score is
+        # the gradient of log rho_rev, see 'quadrature.quadrature_energy'; the batches are not used
+        q = becke_quadrature(coords, z, quad_level, lambda x: jnp.exp(prior_dist.log_prob(x)))
+        print(f'quadrature loss: Becke grid level {quad_level}, {q.n} points')
+
+        def local_terms(den, score, x):
+            return {'kin': t_functional(den, score, Ne),
+                    'vnuc': v_functional(x, Ne, mol),
+                    'xc': x_functional(den, score, Ne) + c_functional(den, Ne)}
+
+        @jax.jit
+        def loss(params, u_samples):
+            terms = quadrature_energy(log_rho_rev, params, q, local_terms, vh_functional, Ne, hartree_tile)
+            energy = terms['kin'] + terms['vnuc'] + terms['hart'] + terms['xc']
+            f_values = F_values(energy=energy, kin=terms['kin'], vnuc=terms['vnuc'],
+                                hart=terms['hart'], xc=terms['xc'])
+            return energy, f_values
     
     @jax.jit
     def step(params, opt_state, batch):
@@ -176,6 +255,17 @@ def training(mol_name: str,
     _, key = jrnd.split(key)
     gen_batches = batch_generator(key, batch_size, prior_dist) 
 
+    # ahead-of-time compilation with the shapes of this run (loaded from the persistent cache if available)
+    warmup = WarmUp()
+    step = warmup.compile('step', step, params, opt_state, batch_spec(batch_size, 3))
+    # normalization and figures share one 'rho_rev' executable per bucket size
+    rho_bucketed = BucketedFunction(rho_rev)
+    rho_bucketed.compile(params, jax.ShapeDtypeStruct((1, 3), normalization_array[0].dtype), warmup=warmup)
+    print(warmup.summary())
+    warmup.write(CKPT_DIR)
+    if compile_only:
+        return
+
     df = pd.DataFrame()
     df_ema = pd.DataFrame()
     for i in range(epochs+1):
@@ -190,8 +280,9 @@ def training(mol_name: str,
         energies_i_ema, energies_state = energies_ema.update(
             losses, energies_state)
         ei_ema = energies_i_ema.energy
-        norm_val = compute_integral(
-            params, normalization_array, rho_rev, Ne, 0)
+        # with 'norm_every' > 1 the other epochs are left to 'offline_metrics'
+        norm_val = Ne*rho_bucketed.integral(params, *normalization_array) \
+            if i % norm_every == 0 or i == epochs else jnp.nan
     
         r_ = {'epoch': i,
               'E': loss_epoch,
@@ -226,7 +317,7 @@ def training(mol_name: str,
             X = jnp.array(
                 [xx.ravel(), y*jnp.ones_like(xx.ravel()), zz.ravel()]).T
             
-            rho_pred = Ne*rho_rev(params, X)
+            rho_pred = Ne*rho_bucketed(params, X)
 
             vmin = 0.
             vmax = Ne
@@ -252,7 +343,7 @@ def training(mol_name: str,
             xt = jnp.linspace(-4.5, 4.5, 1000)
             yz = jnp.zeros((xt.shape[0], 2))
             zt = lax.concatenate((yz, xt[:, None]), 1)
-            rho_pred = rho_rev(params, zt)
+            rho_pred = rho_bucketed(params, zt)
 
             if i == 0:
                 rho_exact = m.prob(m, zt)
@@ -271,10 +362,254 @@ def training(mol_name: str,
             plt.tight_layout()
             plt.savefig(f'{FIG_DIR}/epoch_rho_z_{i}.svg', transparent=True)
             plt.savefig(f'{FIG_DIR}/epoch_rho_z_{i}.png')
+            plt.close('all')
+
+        if monitor is not None and monitor.update(i, ei_ema, loss_epoch, norm_val/Ne):
+            print(f'converged at epoch {i}: {monitor.reason}')
+            break
+
+    checkpoints.save_checkpoint(
+        ckpt_dir=CKPT_DIR_FINAL, target=params, step=i, overwrite=True)
+    if jnp.isnan(norm_val):
+        norm_val = Ne*rho_bucketed.integral(params, *normalization_array)
+    write_completed(CKPT_DIR, {'epoch': i, 'E': energies_i_ema.energy, 'I': norm_val,
+                               'converged': monitor is not None and monitor.converged,
+                               'reason': None if monitor is None else monitor.reason})
+
+
+def write_completed(ckpt_dir: str, results: dict):
+    """Marks a run as finished, used by the sweep runner to skip completed configurations."""
+    results = {k: v if v is None or isinstance(v, (str, bool)) else jnp.asarray(v).tolist()
+               for k, v in results.items()}
+    with open(f"{ckpt_dir}/completed.json", "w") as outfile:
+        json.dump(results, outfile, indent=4)
+
+
+def training_ensemble(mol_name: str,
+                      tw_kin: str = 'TF',
+                      v_pot: str = 'HGH',
+                      h_pot: str = 'MT',
+                      x_pot: str = 'dirac',
+                      c_pot: str = 'vwn_c_e',
+                      batch_size: int = 256,
+                      epochs: int = 100,
+                      seeds: tuple = (0,),
+                      lrs: tuple = (1E-5,),
+                      weights: tuple = ((1., 1., 1., 1., 1.),),
+                      nn_arch: tuple = (512, 512,),
+                      scheduler_type: str = 'ones',
+                      monitors: Any = None,
+                      norm_every: int = 1):
+    """
+    Trains K flows for the same molecule in a single compiled program. The
+    parameters and optimizer states of all members are stacked along a leading
+    axis and 'step' is vmapped over them, so every member shares the same XLA
+    executables. Per-member hyperparameters (PRNG seed, learning rate and the
+    weights of the kinetic, nuclear, Hartree, exchange and correlation terms)
+    are passed as arrays.
+    With 'monitors' (one convergence monitor per member), training stops once
+    every member is converged.
+    """
+
+    CKPT_DIR_ALL = os.path.abspath(f"{CKPT_DIR}/checkpoints_all/")
+
+    n_members = max(len(seeds), len(lrs), len(weights))
+    seeds = broadcast_members(seeds, n_members)
+    lrs = jnp.array(broadcast_members(lrs, n_members))
+    weights = jnp.array(broadcast_members(weights, n_members))
+
+    Ne, atoms, z, coords = coordinates(mol_name)
+    mol = {'coords': coords, 'z': z}
+    mu = coords
+    z_prior = z.ravel()
+    bool_hgh = v_pot.lower() in ('hgh', 'nuclei_potential_hgh')
+    if bool_hgh:
+        # same valence model as 'training'
+        Ne = valence_electrons(mol, Ne)
+        z_prior = jnp.array([float(HGH_PARAMS[int(zi)][1]) for zi in z.ravel()])
+        hgh_projectors = compile_projectors(mol)
 
+    z_one_hot = one_hot_encode(z)
 
+    model_rev = GCNF(3, nn_arch, xyz_nuclei=mu, z_one_hot=z_one_hot, bool_neg=False)
+    model_fwd = GCNF(3, nn_arch, xyz_nuclei=mu, z_one_hot=z_one_hot, bool_neg=True)
 
-def main():
+    test_inputs = lax.concatenate((jnp.ones((1, 3)), jnp.ones((1, 1))), 1)
+    keys, keys_batch = [], []
+    for seed in seeds:
+        _, key = jrnd.split(jrnd.PRNGKey(seed))
+        keys.append(key)
+        _, key = jrnd.split(key)
+        keys_batch.append(key)
+    params = stack_trees([model_rev.init(key, jnp.array(0.), test_inputs)
+                          for key in keys])
+
+    @jax.jit
+    def NODE_rev(params, batch): return neural_ode(
+        params, batch, model_rev, -1., 0., 3)
+
+    @jax.jit
+    def NODE_fwd_score(params, batch): return neural_ode_score(
+        params, batch, model_fwd, 0., 1., 3)
+
+    prior_dist = ProMolecularDensity(z_prior, mu)
+
+    m = DFTDistribution(atoms, coords)
+    normalization_array = (m.coords, m.weights)
+
+    # the learning rate is applied in 'step' so that it can differ between members
+    optimizer = optax.chain(
+        optax.clip_by_global_norm(1.0),
+        optax.scale_by_adam(),
+    )
+    opt_state = jax.vmap(optimizer.init)(params)
+
+    energies_ema = ema(decay=0.99)
+    zeros = jnp.zeros(n_members)
+    energies_state = energies_ema.init(
+        F_values(energy=zeros, kin=zeros, vnuc=zeros, hart=zeros, xc=zeros))
+
+    @jax.jit
+    def rho_x_score(params, samples):
+        zt, logp_zt, score_zt = NODE_fwd_score(params, samples)
+        return jnp.exp(logp_zt), zt, score_zt
+
+    @jax.jit
+    def rho_rev(params, x):
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = NODE_rev(params, zt)
+        logp_x = prior_dist.log_prob(z0) - logp_z0
+        return jnp.exp(logp_x)  # logp_x
+
+    t_functional = _kinetic(tw_kin)
+    v_functional = _nuclear(v_pot)
+    vh_functional = _hartree(h_pot)
+    x_functional = _exchange_correlation(x_pot)
+    c_functional = _exchange_correlation(c_pot)
+
+    def loss(params, u_samples, w):
+        den_all, x_all, score_all = rho_x_score(params, u_samples)
+
+        den, denp = den_all[:batch_size], den_all[batch_size:]
+        x, xp = x_all[:batch_size], x_all[batch_size:]
+        score, scorep = score_all[:batch_size], score_all[batch_size:]
+
+        e_t = t_functional(den, score, Ne)
+        e_h = vh_functional(x, xp, Ne)
+        e_nuc_v = v_functional(x, Ne, mol)
+        if bool_hgh:
+            e_nuc_v = e_nuc_v + hgh_nonlocal(x, xp, den, denp, Ne, hgh_projectors)
+        e_x = x_functional(den, score, Ne)
+        e_c = c_functional(den, Ne)
+
+        e = w[0]*e_t + w[1]*e_nuc_v + w[2]*e_h + w[3]*e_x + w[4]*e_c
+        energy = jnp.mean(e)
+        f_values = F_values(energy=energy,
+                            kin=jnp.mean(e_t),
+                            vnuc=jnp.mean(e_nuc_v),
+                            hart=jnp.mean(e_h),
+                            xc=jnp.mean(e_x + e_c))
+        return energy, f_values
+
+    def _step(params, opt_state, batch, lr, w, i):
+        loss_value, grads = jax.value_and_grad(
+            loss, has_aux=True)(params, batch, w)
+        updates, opt_state = optimizer.update(grads, opt_state, params)
+        lr_i = get_scheduler(epochs, scheduler_type, lr)(i)
+        updates = jax.tree_util.tree_map(lambda u: -lr_i*u, updates)
+        params = optax.apply_updates(params, updates)
+        return params, opt_state, loss_value
+
+    step = jax.jit(jax.vmap(_step, in_axes=(0, 0, 0, 0, 0, None)))
+
+    @jax.jit
+    def v_compute_integral(params):
+        return jax.vmap(lambda p: compute_integral(
+            p, normalization_array, rho_rev, Ne, 0))(params)
+
+    gen_batches = ensemble_batch_generator(
+        jnp.stack(keys_batch), batch_size, prior_dist)
+
+    members = [{'member': k, 'seed': int(seeds[k]), 'lr': float(lrs[k]),
+                'weights': dict(zip(['kin', 'vnuc', 'hart', 'x', 'c'],
+                                    [float(wi) for wi in weights[k]]))}
+               for k in range(n_members)]
+    with open(f"{CKPT_DIR}/ensemble_members.json", "w") as outfile:
+        json.dump(members, outfile, indent=4)
+
+    df = pd.DataFrame()
+    df_ema = pd.DataFrame()
+    for i in range(epochs+1):
+        batch = next(gen_batches)
+        start_time = time.time()
+        params, opt_state, loss_value = step(
+            params, opt_state, batch, lrs, weights, i)
+        jax.block_until_ready(params)
+        end_time = time.time()
+        loss_epoch, losses = loss_value
+
+        elapsed_time_seconds = end_time - start_time
+
+        energies_i_ema, energies_state = energies_ema.update(
+            losses, energies_state)
+        norm_val = v_compute_integral(params) if i % norm_every == 0 or i == epochs \
+            else jnp.full(n_members, jnp.nan)
+
+        if monitors is not None:
+            for k, monitor in enumerate(monitors):
+                if not monitor.converged:
+                    monitor.update(i, energies_i_ema.energy[k], loss_epoch[k], norm_val[k]/Ne)
+
+        r_ = {'epoch': i,
+              'member': jnp.arange(n_members),
+              'E': loss_epoch,
+              'T': losses.kin, 'V': losses.vnuc, 'H': losses.hart, 'XC': losses.xc,
+              'I': norm_val
+              }
+        df = pd.concat([df, pd.DataFrame(r_)], ignore_index=True)
+        df.to_csv(
+            f"{CKPT_DIR}/training_trajectory_{mol_name}_ensemble.csv", index=False)
+
+        r_ema = {'epoch': i,
+                 'member': jnp.arange(n_members),
+                 'E': energies_i_ema.energy,
+                 'T': energies_i_ema.kin, 'V': energies_i_ema.vnuc, 'H': energies_i_ema.hart, 'XC': energies_i_ema.xc,
+                 'I': norm_val, 't': elapsed_time_seconds
+                 }
+        df_ema = pd.concat([df_ema, pd.DataFrame(r_ema)], ignore_index=True)
+        df_ema.to_csv(
+            f"{CKPT_DIR}/training_trajectory_{mol_name}_{c_pot}_ensemble_ema.csv", index=False)
+
+        # one checkpoint per member so they can be restored like single runs
+        for k, params_k in enumerate(unstack_trees(params)):
+            checkpoints.save_checkpoint(
+                ckpt_dir=os.path.abspath(f"{CKPT_DIR}/member_{k}/checkpoints_all/"), target=params_k,
+                step=i, keep_every_n_steps=10)
+
+        if monitors is not None and all(monitor.converged for monitor in monitors):
+            print(f'all members converged at epoch {i}')
+            break
+
+    for k, params_k in enumerate(unstack_trees(params)):
+        checkpoints.save_checkpoint(
+            ckpt_dir=os.path.abspath(f"{CKPT_DIR}/member_{k}/checkpoints/"), target=params_k,
+            step=i, overwrite=True)
+    if jnp.any(jnp.isnan(norm_val)):
+        norm_val = v_compute_integral(params)
+    results = {'epoch': i, 'E': energies_i_ema.energy, 'I': norm_val}
+    if monitors is not None:
+        results.update({'converged_epoch': [m.epoch for m in monitors],
+                        'reason': [m.reason for m in monitors]})
+    write_completed(CKPT_DIR, results)
+    return params
+
+
+def parse_list(values: str, dtype: Any = float) -> tuple:
+    """Parses a comma separated CLI list, e.g. '1e-4,3e-4'."""
+    return tuple(dtype(v) for v in values.split(','))
+
+
+def get_args_parser():
     parser = argparse.ArgumentParser(description="Density fitting training")
     parser.add_argument("--mol_name", type=str, default='H2',
                         help="molecule name")
@@ -300,7 +635,59 @@ def main():
                         help="Hartree integral scheduler")
     parser.add_argument("--nn", type=str, default='2',
                         help="Neural network architecture")
+    parser.add_argument("--ens_seeds", type=str, default=None,
+                        help="Ensemble mode, comma separated PRNG seeds (one per member)")
+    parser.add_argument("--ens_lrs", type=str, default=None,
+                        help="Ensemble mode, comma separated learning rates")
+    parser.add_argument("--ens_weights", type=str, default=None,
+                        help="Ensemble mode, ';' separated 'kin,vnuc,hart,x,c' functional weights")
+    parser.add_argument("--spec", type=str, default=None,
+                        help="composite functional, e.g. 'tf+w, nuclei, hartree, dirac+b88, pw92' (overrides --kin/--nuc/--hart/--x/--c)")
+    parser.add_argument("--hartree_est", type=str, default='pair',
+                        help="Hartree estimator, 'pair' (x_i, x_i+B), 'ustat' (all pairs), 'tree' (Barnes-Hut) or 'grid' (FFT Poisson)")
+    parser.add_argument("--hartree_tile", type=int, default=256,
+                        help="tile size of the 'ustat' Hartree estimator")
+    parser.add_argument("--theta", type=float, default=0.5,
+                        help="opening angle of the 'tree' Hartree estimator")
+    parser.add_argument("--n_grid", type=int, default=64,
+                        help="grid points per dimension of the 'grid' Hartree estimator")
+    parser.add_argument("--poisson", type=str, default='hockney',
+                        help="free-space Poisson solver of the 'grid' Hartree estimator, 'hockney' or 'mt'")
+    parser.add_argument("--norm_every", type=int, default=1,
+                        help="epochs between normalization integrals, the others can be computed "
+                             "afterwards with 'python -m ofdft_normflows.offline_metrics'")
+    parser.add_argument("--loss", type=str, default='mc', choices=['mc', 'quad'],
+                        help="energy by Monte Carlo over samples or by quadrature of the density on a Becke grid")
+    parser.add_argument("--quad_level", type=int, default=1,
+                        help="Becke grid level of '--loss quad' (small molecules)")
+    add_convergence_args(parser)
+    add_compilation_args(parser)
+    return parser
+
+
+def get_ckpt_dir(args: argparse.Namespace) -> str:
+    """Results directory of a run, named from its CLI arguments."""
+    kin, v_pot, h_pot, x_pot, c_pot = args.kin, args.nuc, args.hart, args.x, args.c
+    sched_type = args.sched
+    ckpt_dir = f"Results_{args.nn}layer/{args.mol_name}_{kin.upper()}_{v_pot.upper()}_{h_pot.upper()}_{x_pot.upper()}_{c_pot.upper()}_lr_{args.lr:.1e}"
+    if args.spec is not None:
+        spec_name = '_'.join(g.strip().replace(' ', '').replace('*', 'x') for g in args.spec.split(','))
+        ckpt_dir = f"Results_{args.nn}layer/{args.mol_name}_{spec_name.upper()}_lr_{args.lr:.1e}"
+    if sched_type.lower() != 'c' or sched_type.lower() != 'const':
+        ckpt_dir = ckpt_dir + f"_sched_{sched_type.upper()}"
+    if args.hartree_est != 'pair':
+        ckpt_dir = ckpt_dir + f"_{args.hartree_est}"
+    if args.loss == 'quad':
+        ckpt_dir = ckpt_dir + f"_quad{args.quad_level}"
+    if any(v is not None for v in (args.ens_seeds, args.ens_lrs, args.ens_weights)):
+        ckpt_dir = ckpt_dir + "_ensemble"
+    return ckpt_dir
+
+
+def main():
+    parser = get_args_parser()
     args = parser.parse_args()
+    cache_from_args(args)
 
     mol_name = args.mol_name    
     batch_size = args.bs
@@ -330,9 +717,37 @@ def main():
     global CKPT_DIR
     global FIG_DIR
     
-    CKPT_DIR = f"Results_{layers}layer/{mol_name}_{kin.upper()}_{v_pot.upper()}_{h_pot.upper()}_{x_pot.upper()}_{c_pot.upper()}_lr_{lr:.1e}"
-    if sched_type.lower() != 'c' or sched_type.lower() != 'const':
-        CKPT_DIR = CKPT_DIR + f"_sched_{sched_type.upper()}"
+    bool_ensemble = any(v is not None for v in (args.ens_seeds, args.ens_lrs, args.ens_weights))
+
+    if bool_ensemble and args.spec is not None:
+        parser.error("'--spec' is not supported in ensemble mode, use '--ens_weights'")
+    if args.hartree_est != 'pair' and (bool_ensemble or args.spec is not None):
+        parser.error("'--hartree_est' is only available with '--hart'")
+    if bool_ensemble and args.compile_only:
+        parser.error("'--compile_only' is not supported in ensemble mode")
+    if args.norm_every > 1 and args.early_stop and 'norm' in args.early_stop:
+        parser.error("the 'norm' convergence criterion needs '--norm_every 1'")
+    if args.loss == 'quad' and (bool_ensemble or args.spec is not None or args.hartree_est != 'pair'):
+        parser.error("'--loss quad' is only available for single runs with '--kin/--nuc/--hart/--x/--c'")
+    if args.loss == 'quad' and v_pot.lower() in ('hgh', 'nuclei_potential_hgh'):
+        parser.error("'--loss quad' does not support the HGH pseudopotentials")
+
+    if bool_ensemble:
+        try:
+            seeds = parse_list(args.ens_seeds, int) if args.ens_seeds else (0,)
+            lrs = parse_list(args.ens_lrs) if args.ens_lrs else (lr,)
+            weights = tuple(parse_list(wi) for wi in args.ens_weights.split(';')) \
+                if args.ens_weights else ((1., 1., 1., 1., 1.),)
+        except ValueError as e:
+            parser.error(f"invalid ensemble list, {e}")
+        if any(len(wi) != 5 for wi in weights):
+            parser.error("each '--ens_weights' member needs 5 'kin,vnuc,hart,x,c' weights")
+        n_members = max(len(seeds), len(lrs), len(weights))
+        for name, values in (('--ens_seeds', seeds), ('--ens_lrs', lrs), ('--ens_weights', weights)):
+            if len(values) not in (1, n_members):
+                parser.error(f"'{name}' has {len(values)} members, expected 1 or {n_members}")
+
+    CKPT_DIR = get_ckpt_dir(args)
     FIG_DIR = f"{CKPT_DIR}/Figures"
 
     cwd = os.getcwd()
@@ -354,14 +769,36 @@ def main():
                 'c_pot': c_pot,
                 'nn': tuple(nn),
                 'sched': sched_type,
+                'early_stop': args.early_stop,
+                'spec': args.spec,
+                'hartree_est': args.hartree_est,
+                'hartree_tile': args.hartree_tile,
+                'theta': args.theta,
+                'n_grid': args.n_grid,
+                'norm_every': args.norm_every,
+                'poisson': args.poisson,
+                'loss': args.loss,
+                'quad_level': args.quad_level,
                   }
+    if bool_ensemble:
+        job_params.update({'ens_seeds': seeds, 'ens_lrs': lrs, 'ens_weights': weights})
     with open(f"{CKPT_DIR}/job_params.json", "w") as outfile:
         json.dump(job_params, outfile, indent=4)
 
 
+    if bool_ensemble:
+        monitors = None
+        if args.early_stop:
+            monitors = [monitor_from_args(args) for _ in range(n_members)]
+        training_ensemble(mol_name, kin, v_pot, h_pot, x_pot, c_pot, batch_size,
+                          epochs, seeds, lrs, weights, nn, sched_type, monitors, args.norm_every)
+        return
+
     training(mol_name,kin, v_pot, h_pot, x_pot,c_pot, batch_size,
              
-             epochs, lr, nn, bool_params, sched_type)
+             epochs, lr, nn, bool_params, sched_type, monitor_from_args(args), args.spec,
+             args.hartree_est, args.hartree_tile, args.theta, args.n_grid, args.poisson, args.compile_only,
+             args.norm_every, args.loss, args.quad_level)
 
 
 if __name__ == "__main__":
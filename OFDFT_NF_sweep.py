@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import argparse
+
+from ofdft_normflows.sweep import load_configs, config_to_argv, run_sweep
+
+from OFDFT_NF import get_args_parser, get_ckpt_dir
+
+
+def results_dir(config: dict) -> str:
+    """Results directory that 'OFDFT_NF.py' writes for a configuration."""
+    args = get_args_parser().parse_args(config_to_argv(config))
+    return get_ckpt_dir(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local sweep of OFDFT_NF.py runs")
+    parser.add_argument("configs", type=str,
+                        help="JSON file with a list of configurations or a {'grid': ..., 'fixed': ...} spec")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent runs")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="cores and XLA threads per run")
+    parser.add_argument("--cores", type=str, default=None,
+                        help="comma separated cores to use, by default all")
+    parser.add_argument("--index", type=str, default='sweep_index.csv',
+                        help="CSV file recording the status of every configuration")
+    parser.add_argument("--logs", type=str, default='sweep_logs',
+                        help="directory for the output of each run")
+    parser.add_argument("--skip_failed", action='store_true',
+                        help="do not re-run configurations that failed before")
+    parser.add_argument("--precompile", action='store_true',
+                        help="run every configuration with '--compile_only' first to fill the compilation cache")
+    args = parser.parse_args()
+
+    configs = load_configs(args.configs)
+    cores = [int(c) for c in args.cores.split(',')] if args.cores else None
+
+    summary = run_sweep(configs, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'OFDFT_NF.py')], results_dir,
+                        index_file=args.index,
+                        n_workers=args.workers,
+                        threads_per_worker=args.threads,
+                        cores=cores,
+                        log_dir=args.logs,
+                        bool_rerun_failed=not args.skip_failed,
+                        bool_precompile=args.precompile)
+    print(json.dumps(summary, indent=4))
+    with open(args.index.replace('.csv', '_summary.json'), "w") as outfile:
+        json.dump(summary, outfile, indent=4)
+
+
+if __name__ == "__main__":
+    main()
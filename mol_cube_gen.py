@@ -1,5 +1,8 @@
 import argparse
 
+import numpy as onp
+import pandas as pd
+
 import jax
 import jax.numpy as jnp
 from jax import lax
@@ -8,7 +11,8 @@ import jax.random as jrnd
 from flax.training import checkpoints
 from distrax import MultivariateNormalDiag
 
-from ofdft_normflows.utils_cubegen import cube_generator
+from ofdft_normflows.utils_cubegen import cube_generator, cube_generator_epochs, adaptive_cube_generator
+from ofdft_normflows.checkpoint_analysis import restore_checkpoints, CachedDensities, density_tag
 from ofdft_normflows.jax_ode import neural_ode
 from ofdft_normflows.cn_flows import Gen_CNFSimpleMLP as CNF
 
@@ -53,10 +57,8 @@ def get_mol_info(mol_name: str):
     return mol
 
 
-def _plot(mol_name: str, rwd: str, nn_arch: any, nn_id: int):
-
-    CKPT_DIR = rwd
-    mol_info = get_mol_info(mol_name)
+def _density_model(mol_info: dict, nn_arch: any):
+    """Initial CNF parameters and the density 'rho(params, x)' (Ne rho_NF) of a molecule."""
     Ne = mol_info['Ne']
 
     # init CNF model
@@ -64,13 +66,8 @@ def _plot(mol_name: str, rwd: str, nn_arch: any, nn_id: int):
     _, key = jrnd.split(png)
 
     model_rev = CNF(3, nn_arch, bool_neg=False)
-    model_fwd = CNF(3, nn_arch, bool_neg=True)
     test_inputs = lax.concatenate((jnp.ones((1, 3)), jnp.ones((1, 1))), 1)
     params = model_rev.init(key, jnp.array(0.), test_inputs)
-    # load pretrained model
-    restored_state = checkpoints.restore_checkpoint(
-        ckpt_dir=f"{CKPT_DIR}/checkpoints_all/", target=params, step=nn_id)
-    params = restored_state
 
     # init prior distribution
     mean = jnp.zeros((3,))
@@ -78,42 +75,111 @@ def _plot(mol_name: str, rwd: str, nn_arch: any, nn_id: int):
     prior_dist = MultivariateNormalDiag(mean, cov,)
 
     # CNF functions
-    @jax.jit
     def NODE_rev(params, batch): return neural_ode(
         params, batch, model_rev, -1., 0., 3)
 
-    @jax.jit
     def _rho_rev(params, x):
         zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
         z0, logp_z0 = NODE_rev(params, zt)
         logp_x = prior_dist.log_prob(z0)[:, None] - logp_z0
         return Ne*jnp.exp(logp_x)  # logp_x
 
-    @jax.jit
-    def rho_rev(x): return _rho_rev(params, x)
+    return params, _rho_rev
+
+
+def _plot(mol_name: str, rwd: str, nn_arch: any, nn_id: int, formats: tuple = ('cube', 'npz'),
+          bool_adaptive: bool = False):
+
+    CKPT_DIR = rwd
+    mol_info = get_mol_info(mol_name)
+    params, _rho_rev = _density_model(mol_info, nn_arch)
+
+    # load pretrained model
+    restored_state = checkpoints.restore_checkpoint(
+        ckpt_dir=f"{CKPT_DIR}/checkpoints_all/", target=params, step=nn_id)
+    params = restored_state
 
     # generate cube files
-    cube_array = cube_generator(
-        rho_rev, mol_info, f'{mol_name}_CNF_{nn_id}', CKPT_DIR,
-        nx=80, ny=80, nz=80)
-    cube_array_file = f"{mol_name}_CNF_{nn_id}_data.npy"
-    jnp.save(cube_array_file, cube_array, allow_pickle=True)
+    # (rho, vnuc and mep also in '{mol_name}_CNF_{nn_id}.npz/.vol', see ofdft_normflows.volumetric)
+    if bool_adaptive:
+        # density on an adaptive octree (refined at the nuclei), resampled to the cube,
+        # the octree points differ at every level, so they are not cached
+        _rho_rev = jax.jit(_rho_rev)
+
+        @jax.jit
+        def rho_rev(x): return _rho_rev(params, x)
+
+        cube_array = adaptive_cube_generator(
+            rho_rev, mol_info, f'{mol_name}_CNF_{nn_id}', CKPT_DIR,
+            nx=80, ny=80, nz=80, formats=formats)
+    else:
+        # density of every grid chunk read from (or written to) the density cache
+        rho_rev = CachedDensities(_rho_rev, [params], density_tag(mol_info, 'CNF'))
+        cube_array = cube_generator(
+            rho_rev, mol_info, f'{mol_name}_CNF_{nn_id}', CKPT_DIR,
+            nx=80, ny=80, nz=80, formats=formats)
 
     # print(cube_array['mep'].shape, cube_array['rho'].shape)
 
 
+def _plot_epochs(mol_name: str, rwd: str, nn_arch: any, nn_ids: list, formats: tuple = ('cube', 'npz'),
+                 n_threads: int = None, bool_mep: bool = True):
+    """
+    Cube files and density profiles of several checkpoints at once, the checkpoints are
+    restored in parallel threads and all the densities are evaluated by one compiled
+    function over the grid chunks, or read from the density cache if they were
+    computed before (see 'checkpoint_analysis.CachedDensities').
+    """
+    CKPT_DIR = rwd
+    mol_info = get_mol_info(mol_name)
+    params, _rho_rev = _density_model(mol_info, nn_arch)
+
+    params_epochs = restore_checkpoints(f"{CKPT_DIR}/checkpoints_all/", nn_ids, params, n_threads)
+    # densities of every grid chunk read from (or written to) the density cache
+    rho_epochs = CachedDensities(_rho_rev, params_epochs, density_tag(mol_info, 'CNF'))
+
+    # cubes, 'rho_{mol_name}_CNF_{nn_id}.cube' (and 'mep_...') for every checkpoint
+    cube_generator_epochs(rho_epochs, mol_info, nn_ids,
+                          f'{mol_name}_CNF', CKPT_DIR, nx=80, ny=80, nz=80, chunk_size=65536,
+                          formats=formats, bool_mep=bool_mep)
+
+    # line profiles along z
+    zt = jnp.linspace(-4.5, 4.5, 1000)
+    x = lax.concatenate((jnp.zeros((zt.shape[0], 2)), zt[:, None]), 1)
+    rho_z = onp.asarray(rho_epochs(x))
+    df = pd.DataFrame({'z': onp.asarray(zt), **{f'rho_{i}': rho_z[:, k] for k, i in enumerate(nn_ids)}})
+    df.to_csv(f"{CKPT_DIR}/{mol_name}_CNF_rho_z_epochs.csv", index=False)
+
+
 def main():
     import os
     parser = argparse.ArgumentParser(description="CUBE GEN CALCULATIONS")
     parser.add_argument("--mol", type=str, default='H',
                         help="molecule name")
     parser.add_argument("--i", type=int, default=1, help="epoch number ")
+    parser.add_argument("--formats", type=str, default='cube,npz',
+                        help="comma separated output formats, cube, npz and/or vol")
+
+    parser.add_argument("--rwd", type=str, default=None,
+                        help="results directory (with checkpoints_all/) of the batch mode")
+    parser.add_argument("--epochs", type=str, default=None,
+                        help="comma separated checkpoint steps, all generated in one batch")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="threads restoring the checkpoints")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="evaluate the density on an adaptive octree and resample it to the cube")
 
     args = parser.parse_args()
     mol_name = args.mol
     nnid = args.i
     nn = (512, 512, 512,)
 
+    if args.epochs is not None:
+        _plot_epochs(mol_name=mol_name, rwd=args.rwd, nn_arch=nn,
+                     nn_ids=[int(e) for e in args.epochs.split(',')],
+                     formats=tuple(args.formats.split(',')), n_threads=args.threads)
+        return
+
     cwd = '/u/rvargas/ofdft_normflows/Results/'
     mols_ = ['H', 'H2', 'H2O']
     rwd_ = ['H_TF-W_V_H_X_lr_3.0e-04', 'H2_TF-W_V_H_X_lr_3.0e-04_sched_MIX',
@@ -124,7 +190,8 @@ def main():
         for rwdi in rwd_[::-2]:
             for nnid in nnid_[::-1]:
                 rwdi = os.path.join(cwd, rwdi)
-                _plot(mol_name=mi, rwd=rwdi, nn_arch=nn, nn_id=nnid)
+                _plot(mol_name=mi, rwd=rwdi, nn_arch=nn, nn_id=nnid,
+                      formats=tuple(args.formats.split(',')), bool_adaptive=args.adaptive)
                 assert 0
 
 
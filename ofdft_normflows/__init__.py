@@ -1,8 +1,33 @@
-from ofdft_normflows.functionals import _kinetic, _nuclear, _hartree, _exchange_correlation
-from ofdft_normflows.dft_distrax import DFTDistribution,MixGaussian
-from ofdft_normflows.jax_ode import neural_ode, neural_ode_score
-from ofdft_normflows.equiv_flows import Gen_EqvFlow as GCNF
-from ofdft_normflows.promolecular_distrax import ProMolecularDensity
-from ofdft_normflows.utils import get_scheduler, batch_generator
+import importlib
 
+# public names and the submodule that defines them, resolved on first access
+# (PySCF, distrax, flax and optax are only imported by the code that needs them)
+_LAZY_ATTRS = {
+    '_kinetic': ('ofdft_normflows.functionals', '_kinetic'),
+    '_nuclear': ('ofdft_normflows.functionals', '_nuclear'),
+    '_hartree': ('ofdft_normflows.functionals', '_hartree'),
+    '_exchange_correlation': ('ofdft_normflows.functionals', '_exchange_correlation'),
+    'DFTDistribution': ('ofdft_normflows.dft_distrax', 'DFTDistribution'),
+    'MixGaussian': ('ofdft_normflows.dft_distrax', 'MixGaussian'),
+    'neural_ode': ('ofdft_normflows.jax_ode', 'neural_ode'),
+    'neural_ode_score': ('ofdft_normflows.jax_ode', 'neural_ode_score'),
+    'GCNF': ('ofdft_normflows.equiv_flows', 'Gen_EqvFlow'),
+    'ProMolecularDensity': ('ofdft_normflows.promolecular_distrax', 'ProMolecularDensity'),
+    'get_scheduler': ('ofdft_normflows.utils', 'get_scheduler'),
+    'batch_generator': ('ofdft_normflows.utils', 'batch_generator'),
+}
 
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRS:
+        module, attr = _LAZY_ATTRS[name]
+        value = getattr(importlib.import_module(module), attr)
+        globals()[name] = value  # later lookups do not go through __getattr__
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
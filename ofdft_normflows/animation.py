@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+import multiprocessing
+from dataclasses import dataclass, asdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Optional, Sequence
+
+import numpy as onp
+
+# only NumPy at import time, the rendering processes never import JAX, flax or PySCF
+
+PLANES = {'xy': (0, 1, 2), 'xz': (0, 2, 1), 'yz': (1, 2, 0)}
+
+
+@dataclass
+class FrameSpec:
+    """
+    Density frames of a run, everything that changes the densities (and so the cache).
+
+    'steps' selects the checkpoints ('checkpoint_analysis.select_steps', e.g.
+    'log:40', 'stride:5' or '0,1,11'); 'kind' is 'plane' (slice 'plane' through the
+    origin, n x n points in [-extent, extent]^2) or 'line' (n points along 'axis');
+    'member' selects 'member_<k>/checkpoints_all' of an ensemble run.
+    """
+    steps: str = 'log:40'
+    kind: str = 'plane'
+    plane: str = 'yz'
+    axis: int = 2
+    extent: float = 4.5
+    n: int = 128
+    member: Optional[int] = None
+    reference: bool = False
+
+
+@dataclass
+class FrameStyle:
+    """
+    Styling of the rendered frames, changing it re-renders the cached densities.
+    'vmax' None uses the largest density of all the frames (a fixed colour scale).
+    """
+    cmap: str = 'viridis'
+    vmax: Optional[float] = None
+    log: bool = False
+    dpi: int = 100
+    figsize: tuple = (6.4, 4.8)
+    title: str = '{mol_name}, epoch {step}'
+    color: str = 'tab:blue'
+
+
+def _key(*objs: Any) -> str:
+    return hashlib.sha1(json.dumps(objs, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def _ckpt_dir(rwd: str, spec: FrameSpec) -> str:
+    if spec.member is not None:
+        return os.path.join(rwd, f'member_{spec.member}', 'checkpoints_all')
+    return os.path.join(rwd, 'checkpoints_all')
+
+
+def frame_points(spec: FrameSpec) -> tuple:
+    """Points of the frames, (n or n^2, 3), and the frame axes."""
+    t = onp.linspace(-spec.extent, spec.extent, spec.n)
+    if spec.kind == 'line':
+        x = onp.zeros((spec.n, 3))
+        x[:, spec.axis] = t
+        return x, (t,)
+    if spec.kind != 'plane':
+        raise ValueError(f"Unknown frame kind '{spec.kind}'.")
+    i, j, _ = PLANES[spec.plane]
+    a, b = onp.meshgrid(t, t, indexing='ij')
+    x = onp.zeros((spec.n*spec.n, 3))
+    x[:, i], x[:, j] = a.ravel(), b.ravel()
+    return x, (t, t)
+
+
+def compute_frames(rwd: str, spec: FrameSpec, cache_dir: Optional[str] = None,
+                   epochs_per_batch: int = 8, n_threads: Optional[int] = None) -> dict:
+    """
+    Densities of all the frames, (n_frames, n) or (n_frames, n, n), cached in
+    '{cache_dir}/frames_{key}.npz' (the key hashes the run, its checkpoints and 'spec').
+
+    The checkpoints are restored in parallel threads and 'epochs_per_batch' of them
+    are evaluated at once by one compiled function, the densities of checkpoints seen
+    before (e.g. by another spec with the same points) come from the density cache
+    ('checkpoint_analysis.checkpoint_densities').
+    """
+    from ofdft_normflows.checkpoint_analysis import checkpoint_steps, select_steps
+
+    ckpt_dir = _ckpt_dir(rwd, spec)
+    steps = select_steps(checkpoint_steps(ckpt_dir), spec.steps)
+    cache_dir = os.path.join(rwd, 'Figures', 'frames') if cache_dir is None else cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    mtimes = [os.path.getmtime(os.path.join(ckpt_dir, f'checkpoint_{s}')) for s in steps
+              if os.path.exists(os.path.join(ckpt_dir, f'checkpoint_{s}'))]
+    key = _key(os.path.abspath(rwd), steps, mtimes, asdict(spec))
+    fname = os.path.join(cache_dir, f'frames_{key}.npz')
+    if os.path.exists(fname):
+        d = onp.load(fname, allow_pickle=False)
+        return {k: d[k] for k in d.files} | {'key': key}
+
+    import jax
+    import jax.numpy as jnp
+    from ofdft_normflows.checkpoint_analysis import (load_job, density_model, restore_checkpoints,
+                                                     checkpoint_densities, density_tag)
+
+    job = load_job(rwd)
+    params, rho, mol = density_model(job)
+    x, axes = frame_points(spec)
+    x = jnp.asarray(x)
+    frames = []
+    for start in range(0, len(steps), epochs_per_batch):
+        batch = steps[start:start + epochs_per_batch]
+        params_batch = restore_checkpoints(ckpt_dir, batch, params, n_threads)
+        rho_batch = checkpoint_densities(rho, params_batch, x, density_tag(mol))
+        frames.append(onp.asarray(rho_batch).T)
+    shape = (len(steps),) + tuple(t.shape[0] for t in axes)
+    out = {'rho': onp.concatenate(frames).reshape(shape), 'steps': onp.array(steps),
+           'axes': onp.stack(axes), 'atom_coords': onp.asarray(mol['coords']),
+           'mol_name': onp.array(mol['mol_name'])}
+    if spec.reference and spec.kind == 'line':
+        from ofdft_normflows.dft_distrax import DFTDistribution
+        m = DFTDistribution(mol['atoms'], mol['coords'])
+        out['reference'] = onp.asarray(m.prob(m, x)).ravel()
+    onp.savez(fname, **out)
+    return out | {'key': key}
+
+
+def _render_frame(job: tuple) -> str:
+    """Renders one frame to a PNG (runs in the worker processes)."""
+    fname, rho, step, axes, atom_coords, mol_name, spec, style, vmax, reference = job
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm, Normalize
+
+    fig, ax = plt.subplots(figsize=style['figsize'])
+    if spec['kind'] == 'line':
+        if reference is not None:
+            ax.plot(axes[0], reference, color='k', ls=':', label=r'$\hat{\rho}_{{\cal M}}$')
+        ax.plot(axes[0], rho, color=style['color'], label=r'$\rho_{{\cal M}}$')
+        ax.set_ylim(0., 1.05*vmax)
+        ax.set_xlabel(f"{'xyz'[spec['axis']]} [Bohr]")
+        ax.legend(loc='upper right')
+    else:
+        i, j, _ = PLANES[spec['plane']]
+        norm = LogNorm(vmax*1E-4, vmax) if style['log'] else Normalize(0., vmax)
+        im = ax.imshow(onp.maximum(rho.T, vmax*1E-4) if style['log'] else rho.T, origin='lower',
+                       extent=(axes[0][0], axes[0][-1], axes[1][0], axes[1][-1]),
+                       cmap=style['cmap'], norm=norm)
+        ax.scatter(atom_coords[:, i], atom_coords[:, j], s=12, c='w', marker='x')
+        fig.colorbar(im, ax=ax)
+        ax.set_xlabel(f"{spec['plane'][0]} [Bohr]")
+        ax.set_ylabel(f"{spec['plane'][1]} [Bohr]")
+    ax.set_title(style['title'].format(mol_name=mol_name, step=step))
+    fig.tight_layout()
+    fig.savefig(fname, dpi=style['dpi'])
+    plt.close(fig)
+    return fname
+
+
+def render_frames(frames: dict, spec: FrameSpec, style: FrameStyle, frame_dir: str,
+                  workers: Optional[int] = None) -> list:
+    """
+    Renders every frame to '{frame_dir}/{key}_{i:04d}.png' in a process pool
+    ('workers' processes, by default one per core); the frames that already exist
+    for the same densities and style are reused.
+    """
+    os.makedirs(frame_dir, exist_ok=True)
+    key = _key(str(frames['key']), asdict(style))
+    reference = frames.get('reference')
+    vmax = style.vmax
+    if vmax is None:
+        vmax = float(max(onp.max(frames['rho']), -onp.inf if reference is None else onp.max(reference)))
+    jobs, fnames = [], []
+    for i, (rho, step) in enumerate(zip(frames['rho'], frames['steps'])):
+        fname = os.path.join(frame_dir, f'{key}_{i:04d}.png')
+        fnames.append(fname)
+        if not os.path.exists(fname):
+            jobs.append((fname, rho, int(step), frames['axes'], frames['atom_coords'], str(frames['mol_name']),
+                         asdict(spec), asdict(style), vmax, reference))
+    workers = os.cpu_count() if workers is None else workers
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            _render_frame(job)
+    elif jobs:
+        # 'spawn', the parent process runs JAX threads and must not be forked
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            list(pool.map(_render_frame, jobs))
+    return fnames
+
+
+def assemble(fnames: Sequence[str], out: str, fps: float = 10.):
+    """Writes the frames to a GIF (Pillow) or, for any other extension (e.g. '.mp4'), with ffmpeg."""
+    if out.lower().endswith('.gif'):
+        from PIL import Image
+        images = [Image.open(f).convert('RGB') for f in fnames]
+        images[0].save(out, save_all=True, append_images=images[1:], duration=int(1000/fps), loop=0)
+        return out
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError(f"ffmpeg is needed to write '{out}', use a '.gif' output instead.")
+    pattern = fnames[0][:-len('0000.png')] + '%04d.png'
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps), '-i', pattern,
+                    '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', out], check=True)
+    return out
+
+
+def animate(rwd: str, out: str, spec: FrameSpec = FrameSpec(), style: FrameStyle = FrameStyle(),
+            fps: float = 10., workers: Optional[int] = None, cache_dir: Optional[str] = None) -> dict:
+    """
+    Animation of the density during training from the checkpoints of a run: densities
+    of all the frames in batch ('compute_frames'), rendering in a process pool
+    ('render_frames') and assembly ('assemble'). Densities and rendered frames are
+    cached in 'cache_dir' (default '{rwd}/Figures/frames'), a new style only
+    re-renders and a new 'fps' or output format only re-assembles.
+
+    Returns
+    -------
+    dict
+        Wall time of every stage.
+    """
+    cache_dir = os.path.join(rwd, 'Figures', 'frames') if cache_dir is None else cache_dir
+    times = {}
+    start = time.time()
+    frames = compute_frames(rwd, spec, cache_dir)
+    times['compute'] = time.time() - start
+    start = time.time()
+    fnames = render_frames(frames, spec, style, cache_dir, workers)
+    times['render'] = time.time() - start
+    start = time.time()
+    assemble(fnames, out, fps)
+    times['assemble'] = time.time() - start
+    times['n_frames'] = len(fnames)
+    return times
+
+
+if __name__ == '__main__':
+    import argparse
+    import jax
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Training animation of the density from the checkpoints of a run")
+    parser.add_argument("--rwd", type=str, required=True, help="results directory (job_params.json, checkpoints_all/)")
+    parser.add_argument("--out", type=str, default=None, help="output .gif or .mp4, by default '{rwd}/Figures/rho_{kind}.gif'")
+    parser.add_argument("--steps", type=str, default='log:40', help="'all', 'stride:k', 'log:n' or '0,1,11,...'")
+    parser.add_argument("--kind", type=str, default='plane', help="'plane' (2D slice) or 'line' (1D profile)")
+    parser.add_argument("--plane", type=str, default='yz', help="plane of the slice, 'xy', 'xz' or 'yz'")
+    parser.add_argument("--axis", type=int, default=2, help="axis of the line profile")
+    parser.add_argument("--extent", type=float, default=4.5, help="half width of the frames (Bohr)")
+    parser.add_argument("--n", type=int, default=128, help="points per frame axis")
+    parser.add_argument("--member", type=int, default=None, help="member of an ensemble run")
+    parser.add_argument("--reference", action="store_true", help="DFT density in the line profiles")
+    parser.add_argument("--cmap", type=str, default='viridis', help="colour map of the slices")
+    parser.add_argument("--vmax", type=float, default=None, help="upper limit of the colour scale / y axis")
+    parser.add_argument("--log", action="store_true", help="logarithmic colour scale")
+    parser.add_argument("--dpi", type=int, default=100, help="resolution of the frames")
+    parser.add_argument("--fps", type=float, default=10., help="frames per second")
+    parser.add_argument("--workers", type=int, default=None, help="rendering processes, by default one per core")
+    args = parser.parse_args()
+
+    spec = FrameSpec(steps=args.steps, kind=args.kind, plane=args.plane, axis=args.axis,
+                     extent=args.extent, n=args.n, member=args.member, reference=args.reference)
+    style = FrameStyle(cmap=args.cmap, vmax=args.vmax, log=args.log, dpi=args.dpi)
+    out = args.out if args.out is not None else os.path.join(args.rwd, 'Figures', f'rho_{args.kind}.gif')
+    times = animate(args.rwd, out, spec, style, args.fps, args.workers)
+    print(f"{out}: {times['n_frames']} frames, densities {times['compute']:.1f} s, "
+          f"rendering {times['render']:.1f} s, assembly {times['assemble']:.1f} s")
@@ -0,0 +1,257 @@
+from typing import Any, Tuple
+
+import numpy as onp
+import jax
+import jax.numpy as jnp
+
+Array = jax.Array
+
+# Treutler-Ahlrichs radial scaling \xi (J. Chem. Phys. 102, 346 (1995)), H-Ar
+TREUTLER_XI = {1: 0.8, 2: 0.9, 3: 1.8, 4: 1.4, 5: 1.3, 6: 1.1, 7: 0.9, 8: 0.9, 9: 0.9, 10: 0.9,
+               11: 1.4, 12: 1.3, 13: 1.3, 14: 1.2, 15: 1.1, 16: 1.0, 17: 1.0, 18: 1.0}
+
+# Bragg-Slater radii (Angstrom) of Becke's atomic size adjustment, H-Ar
+BRAGG_RADII = {1: 0.35, 2: 0.35, 3: 1.45, 4: 1.05, 5: 0.85, 6: 0.70, 7: 0.65, 8: 0.60, 9: 0.50, 10: 0.45,
+               11: 1.80, 12: 1.50, 13: 1.25, 14: 1.10, 15: 1.00, 16: 1.00, 17: 1.00, 18: 1.00}
+
+# level -> radial points (1st, 2nd, 3rd row) and Gauss-Legendre points in cos(theta),
+# close to the sizes of the PySCF levels (e.g. level 3, (50/75/80, 302) Lebedev points)
+GRID_LEVELS = {0: ((10, 15, 20), 6),
+               1: ((30, 40, 50), 8),
+               2: ((40, 60, 65), 11),
+               3: ((50, 75, 80), 15),
+               4: ((60, 90, 95), 18),
+               5: ((70, 105, 110), 21)}
+
+
+def _euler_zyz(a: float, b: float, c: float) -> onp.ndarray:
+    ca, sa, cb, sb, cc, sc = onp.cos(a), onp.sin(a), onp.cos(b), onp.sin(b), onp.cos(c), onp.sin(c)
+    rz_a = onp.array([[ca, -sa, 0.], [sa, ca, 0.], [0., 0., 1.]])
+    ry_b = onp.array([[cb, 0., sb], [0., 1., 0.], [-sb, 0., cb]])
+    rz_c = onp.array([[cc, -sc, 0.], [sc, cc, 0.], [0., 0., 1.]])
+    return rz_a @ ry_b @ rz_c
+
+
+# fixed orientation of the angular grids, keeps the rings of the product grid (equator,
+# poles) out of the symmetry planes and axes of the molecules
+ANGULAR_ROTATION = _euler_zyz(1., 2., 3.)
+
+
+def _row(z: int) -> int:
+    return 0 if z <= 2 else (1 if z <= 10 else 2)
+
+
+def radial_grid(n: int, xi: float = 1., alpha: float = 0.6) -> Tuple[onp.ndarray, onp.ndarray]:
+    r"""
+    Treutler-Ahlrichs M4 radial grid, Gauss-Chebyshev (2nd kind) nodes in x \in (-1, 1) mapped by
+
+    r(x) = \frac{\xi}{\ln 2} (1 + x)^{\alpha} \ln\frac{2}{1 - x}.
+
+    Returns
+    -------
+    tuple
+        Radii (n,) and weights (n,) of \int_0^\infty f(r) r^2 dr.
+    """
+    i = onp.arange(1, n + 1)
+    x = onp.cos(i*onp.pi/(n + 1))
+    # \int_{-1}^{1} f(x) dx with the Chebyshev 2nd kind weights over \sqrt{1 - x^2}
+    wx = onp.pi/(n + 1)*onp.sin(i*onp.pi/(n + 1))**2/onp.sqrt(1. - x**2)
+    c = xi/onp.log(2.)
+    r = c*(1. + x)**alpha*onp.log(2./(1. - x))
+    dr = c*(alpha*(1. + x)**(alpha - 1.)*onp.log(2./(1. - x)) + (1. + x)**alpha/(1. - x))
+    return r, wx*dr*r**2
+
+
+def angular_grid(n_theta: int) -> Tuple[onp.ndarray, onp.ndarray]:
+    """
+    Product angular grid, Gauss-Legendre in cos(theta) and 2 n_theta uniform points in phi,
+    exact for spherical harmonics up to degree 2 n_theta - 1, rotated by ANGULAR_ROTATION.
+
+    Returns
+    -------
+    tuple
+        Unit vectors (2 n_theta^2, 3) and weights (summing to 4 pi).
+    """
+    ct, wt = onp.polynomial.legendre.leggauss(n_theta)
+    n_phi = 2*n_theta
+    phi = 2.*onp.pi*onp.arange(n_phi)/n_phi
+    st = onp.sqrt(1. - ct**2)
+    u = onp.stack([(st[:, None]*onp.cos(phi)[None]).ravel(),
+                   (st[:, None]*onp.sin(phi)[None]).ravel(),
+                   onp.repeat(ct, n_phi)], axis=1) @ ANGULAR_ROTATION.T
+    w = onp.repeat(wt, n_phi)*2.*onp.pi/n_phi
+    return u, w
+
+
+def atomic_grid(n_rad: int, n_theta: int, xi: float = 1., prune: bool = True) -> Tuple[onp.ndarray, onp.ndarray]:
+    """
+    Atom-centred grid, radial x angular. With 'prune', Treutler-Ahlrichs pruning of the
+    inner shells, the third of the radial points closest to the nucleus use n_theta = 3
+    and the next sixth n_theta = 6.
+
+    Returns
+    -------
+    tuple
+        Points relative to the nucleus (P, 3) and weights (P,).
+    """
+    r, w_rad = radial_grid(n_rad, xi)
+    order = onp.argsort(r)
+    r, w_rad = r[order], w_rad[order]
+    n_thetas = onp.full(n_rad, n_theta)
+    if prune:
+        n_thetas[n_rad//2:] = n_theta
+        n_thetas[:n_rad//2] = min(6, n_theta)
+        n_thetas[:n_rad//3] = min(3, n_theta)
+    points, weights = [], []
+    for nt in onp.unique(n_thetas):
+        u, w_ang = angular_grid(int(nt))
+        shells = n_thetas == nt
+        points.append((r[shells, None, None]*u[None]).reshape(-1, 3))
+        weights.append((w_rad[shells, None]*w_ang[None]).ravel())
+    return onp.concatenate(points), onp.concatenate(weights)
+
+
+def _becke_step(mu: Array) -> Array:
+    """Becke's cell function s(mu), three iterations of p(x) = 3x/2 - x^3/2."""
+    for _ in range(3):
+        mu = 1.5*mu - 0.5*mu**3
+    return 0.5*(1. - mu)
+
+
+@jax.jit
+def becke_partition(points: Array, coords: Array, a: Array) -> Array:
+    """
+    Becke's fuzzy-cell weights of every atom at 'points', (P, Na), rows sum to one.
+
+    Parameters
+    ----------
+    points : Array
+        Grid points, (P, 3).
+    coords : Array
+        Nuclear coordinates, (Na, 3).
+    a : Array
+        Atomic size adjustments a_AB, (Na, Na).
+    """
+    d = jnp.linalg.norm(points[:, None, :] - coords[None], axis=-1)  # (P, Na)
+    r_ab = jnp.linalg.norm(coords[:, None] - coords[None], axis=-1)
+    na = coords.shape[0]
+    eye = jnp.eye(na, dtype=bool)
+    mu = (d[:, :, None] - d[:, None, :])/jnp.where(eye, 1., r_ab)[None]
+    nu = mu + a[None]*(1. - mu**2)
+    s = jnp.where(eye[None], 1., _becke_step(nu))
+    cell = jnp.prod(s, axis=-1)  # (P, Na)
+    return cell/jnp.sum(cell, axis=-1, keepdims=True)
+
+
+def _size_adjustment(z: onp.ndarray) -> onp.ndarray:
+    """Becke's a_AB with Treutler's square root of the Bragg radii (the PySCF default)."""
+    radii = onp.sqrt(onp.array([BRAGG_RADII.get(int(zi), 1.) for zi in z]))
+    chi = radii[:, None]/radii[None]
+    u = (chi - 1.)/(chi + 1.)
+    a = u/(u**2 - 1.)
+    return onp.clip(a, -0.5, 0.5)
+
+
+def becke_grid(coords: Any, z: Any, level: int = 3, prune: bool = True,
+               chunk_size: int = 65536) -> Tuple[Array, Array]:
+    """
+    Molecular integration grid, atom-centred Treutler-Ahlrichs radial x product angular
+    grids combined with Becke's partition (with atomic size adjustment), no SCF needed.
+
+    Parameters
+    ----------
+    coords : Any
+        Nuclear coordinates in Bohr, (Na, 3).
+    z : Any
+        Nuclear charges, (Na,) or (Na, 1).
+    level : int, optional
+        Grid size, see GRID_LEVELS, by default 3
+    prune : bool, optional
+        Treutler-Ahlrichs pruning of the inner shells, by default True
+    chunk_size : int, optional
+        Points per evaluation of the partition, by default 65536
+
+    Returns
+    -------
+    tuple
+        Grid points (P, 3) and weights (P,).
+    """
+    coords = onp.asarray(coords, dtype=float).reshape(-1, 3)
+    z = onp.asarray(z).ravel().astype(int)
+    n_rad, n_theta = GRID_LEVELS[level]
+
+    points, weights, owner = [], [], []
+    for ia, (ra, za) in enumerate(zip(coords, z)):
+        xa, wa = atomic_grid(n_rad[_row(za)], n_theta, TREUTLER_XI.get(int(za), 1.), prune)
+        points.append(xa + ra)
+        weights.append(wa)
+        owner.append(onp.full(wa.shape[0], ia))
+    points = jnp.asarray(onp.concatenate(points))
+    weights = jnp.asarray(onp.concatenate(weights))
+    owner = jnp.asarray(onp.concatenate(owner))
+
+    if coords.shape[0] == 1:
+        return points, weights
+
+    a = jnp.asarray(_size_adjustment(z))
+    coords = jnp.asarray(coords)
+    p_owner = []
+    for start in range(0, points.shape[0], chunk_size):
+        p = becke_partition(points[start:start + chunk_size], coords, a)
+        p_owner.append(jnp.take_along_axis(p, owner[start:start + chunk_size, None], axis=1)[:, 0])
+    return points, weights*jnp.concatenate(p_owner)
+
+
+def screen_grid(points: Array, weights: Array, rho: Array, threshold: float = 1E-12):
+    """
+    Drops the points whose contribution to the density integral, |w rho|, is below 'threshold'.
+
+    Returns
+    -------
+    tuple
+        Screened points, weights and density values.
+    """
+    rho = jnp.reshape(rho, (points.shape[0], -1))
+    keep = onp.asarray(jnp.abs(weights*rho[:, 0]) > threshold)
+    return points[keep], weights[keep], rho[keep]
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    from ofdft_normflows.promolecular_distrax import ProMolecularDensity
+    from ofdft_normflows.utils import coordinates
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Becke grid vs PySCF grid (with and without SCF)")
+    parser.add_argument("--mol_name", type=str, default='H2O', help="molecule name")
+    parser.add_argument("--level", type=int, default=3, help="grid level")
+    parser.add_argument("--threshold", type=float, default=1E-12, help="density screening threshold")
+    args = parser.parse_args()
+
+    Ne, atoms, z, coords = coordinates(args.mol_name)
+    prior_dist = ProMolecularDensity(z.ravel(), coords)
+    f_rho = jax.jit(lambda x: Ne*jnp.exp(prior_dist.log_prob(x)).reshape(-1))
+
+    start = time.time()
+    x, w = becke_grid(coords, z, args.level)
+    t_grid = time.time() - start
+    rho = f_rho(x)
+    xs, ws, rhos = screen_grid(x, w, rho, args.threshold)
+    print(f'becke_grid: {x.shape[0]} points ({xs.shape[0]} after screening), {t_grid:.2f} s, '
+          f'N = {jnp.vdot(w, rho):.8f} ({jnp.vdot(ws, rhos[:, 0]):.8f} screened)')
+
+    from pyscf import gto, dft
+    mol = gto.M(atom=[(a, tuple(map(float, c))) for a, c in zip(atoms, coords)], basis='sto-3g', unit='B', verbose=0)
+    start = time.time()
+    grids = dft.gen_grid.Grids(mol)
+    grids.level = args.level
+    grids.build()
+    t_pyscf = time.time() - start
+    print(f'pyscf Grids: {grids.weights.shape[0]} points, {t_pyscf:.2f} s, '
+          f'N = {jnp.vdot(grids.weights, f_rho(jnp.asarray(grids.coords))):.8f}')
+    start = time.time()
+    mf = dft.RKS(mol)
+    mf.kernel()
+    print(f'pyscf RKS (grid of the previous cube generation): {time.time() - start:.2f} s')
@@ -0,0 +1,108 @@
+from typing import Any, Callable, Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+
+Array = jax.Array
+
+# number of points of the compiled executables, larger inputs are split in chunks of the largest bucket
+BUCKETS = (1024, 4096)
+
+
+def bucket_sizes(n: int, buckets: Sequence[int] = BUCKETS) -> list:
+    """
+    Splits 'n' points in chunks, full chunks of the largest bucket and a last
+    chunk padded to the smallest bucket that holds it, e.g. 9000 -> [4096, 4096, 1024].
+    """
+    buckets = sorted(buckets)
+    sizes = [buckets[-1]]*(n//buckets[-1])
+    rem = n - sum(sizes)
+    if rem > 0:
+        sizes.append(next(b for b in buckets if b >= rem))
+    return sizes
+
+
+def pad_to(x: Array, size: int) -> Array:
+    """Pads the rows of 'x' to 'size' by repeating the last row (a valid point, no nan in masked rows)."""
+    pad = size - x.shape[0]
+    if pad == 0:
+        return x
+    return jnp.concatenate((x, jnp.repeat(x[-1:], pad, axis=0)), 0)
+
+
+class BucketedFunction:
+    """
+    Evaluates 'f(*args, x)' for any number of points 'x' (N, d) with one compiled
+    executable per bucket size, instead of one per distinct N.
+
+    The points are split in chunks (see 'bucket_sizes'), the last chunk is padded
+    and the padded rows are dropped from the results (or get zero weight in
+    'integral'). The executables are compiled ahead of time on first use of a
+    bucket, or all at once with 'compile'; the other arguments ('args', e.g. the
+    parameters of the flow) keep the shapes of the first call.
+
+    Parameters
+    ----------
+    f : Callable
+        Function of the points, the leading axis of every output is the point axis.
+    buckets : Sequence[int], optional
+        Bucket sizes, by default BUCKETS
+    """
+
+    def __init__(self, f: Callable, buckets: Sequence[int] = BUCKETS):
+        self.f = f if hasattr(f, 'lower') else jax.jit(f)
+        self.buckets = tuple(sorted(buckets))
+        self.executables = {}
+
+    def executable(self, size: int, args: tuple, x: Any, warmup: Optional[Any] = None) -> Callable:
+        key = (size, tuple(x.shape[1:]), jnp.dtype(x.dtype))
+        if key not in self.executables:
+            spec = jax.ShapeDtypeStruct((size,) + tuple(x.shape[1:]), x.dtype)
+            if warmup is not None:
+                self.executables[key] = warmup.compile(f'{getattr(self.f, "__name__", "f")}_{size}',
+                                                       self.f, *args, spec)
+            else:
+                self.executables[key] = self.f.lower(*args, spec).compile()
+        return self.executables[key]
+
+    def compile(self, *args: Any, warmup: Optional[Any] = None):
+        """Compiles every bucket for 'args' (the last one only needs 'shape' and 'dtype', e.g. 'jax.ShapeDtypeStruct')."""
+        *args, x = args
+        for size in self.buckets:
+            self.executable(size, tuple(args), x, warmup)
+
+    def chunks(self, x: Array):
+        """Yields (start, number of valid rows, padded chunk)."""
+        start = 0
+        for size in bucket_sizes(x.shape[0], self.buckets):
+            m = min(size, x.shape[0] - start)
+            yield start, m, pad_to(x[start:start + m], size)
+            start += m
+
+    def __call__(self, *args: Any) -> Any:
+        *args, x = args
+        if isinstance(x, jax.core.Tracer):
+            # inside another transformation (e.g. a bucketed caller), no executables
+            return self.f(*args, x)
+        x = jnp.asarray(x)
+        outs = []
+        for _, m, xc in self.chunks(x):
+            y = self.executable(xc.shape[0], tuple(args), x)(*args, xc)
+            outs.append(jax.tree_util.tree_map(lambda a: a[:m], y))
+        if len(outs) == 1:
+            return outs[0]
+        return jax.tree_util.tree_map(lambda *a: jnp.concatenate(a, 0), *outs)
+
+    def integral(self, *args: Any) -> Array:
+        """
+        Quadrature of 'f', sum_i w_i f(x_i), with the arguments '(*args, x, w)';
+        the padded rows get zero weight.
+        """
+        *args, x, w = args
+        x, w = jnp.asarray(x), jnp.ravel(jnp.asarray(w))
+        total = 0.
+        for start, m, xc in self.chunks(x):
+            y = self.executable(xc.shape[0], tuple(args), x)(*args, xc)
+            wc = jnp.zeros(xc.shape[0], w.dtype).at[:m].set(w[start:start + m])
+            total = total + jnp.vdot(wc, y)
+        return total
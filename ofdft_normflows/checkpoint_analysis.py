@@ -0,0 +1,286 @@
+import os
+import re
+import json
+from typing import Any, Callable, Optional, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as onp
+import jax
+import jax.numpy as jnp
+
+from ofdft_normflows.bucketing import BucketedFunction, BUCKETS
+from ofdft_normflows.ensemble import stack_trees
+
+Array = jax.Array
+
+
+def checkpoint_steps(ckpt_dir: str) -> list:
+    """Sorted steps of the checkpoints 'checkpoint_<step>' saved in 'ckpt_dir' (e.g. '{CKPT_DIR}/checkpoints_all/')."""
+    steps = [int(m.group(1)) for m in (re.fullmatch(r'checkpoint_(\d+)', f) for f in os.listdir(ckpt_dir)) if m]
+    return sorted(steps)
+
+
+def select_steps(steps: Sequence[int], spec: str = 'all') -> list:
+    """
+    Subset of the saved 'steps',
+    'all';
+    'last', the last saved step;
+    'stride:k', every k-th saved checkpoint;
+    'log:n', about n checkpoints log-spaced in the step number;
+    '0,1,11,...', the listed steps.
+    The first and the last saved steps are always part of 'stride' and 'log'.
+    """
+    steps = sorted(steps)
+    spec = spec.strip().lower()
+    if spec == 'all' or len(steps) == 0:
+        return list(steps)
+    if spec == 'last':
+        return steps[-1:]
+    if spec.startswith('stride:'):
+        k = int(spec.split(':')[1])
+        return sorted(set(steps[::k]) | {steps[-1]})
+    if spec.startswith('log:'):
+        n = int(spec.split(':')[1])
+        arr = onp.array(steps)
+        targets = onp.geomspace(arr[0] + 1, arr[-1] + 1, n) - 1
+        idx = onp.abs(arr[None] - targets[:, None]).argmin(1)
+        return sorted(set(arr[idx].tolist()) | {steps[0], steps[-1]})
+    wanted = [int(s) for s in spec.split(',')]
+    missing = sorted(set(wanted) - set(steps) - {0})
+    if missing:
+        raise ValueError(f'No checkpoints for steps {missing}.')
+    return wanted
+
+
+def load_job(rwd: str) -> dict:
+    """The 'job_params.json' of a run directory (written by OFDFT_NF.py)."""
+    with open(os.path.join(rwd, 'job_params.json')) as f:
+        return json.load(f)
+
+
+def flow_model(job: dict) -> dict:
+    """
+    Flow of a run rebuilt from its 'job_params.json', the model of 'OFDFT_NF.training'
+    (equivariant CNF and promolecular prior, valence electrons only with HGH).
+
+    Returns
+    -------
+    dict
+        'params' (initial parameters, the target of the checkpoints), 'model_rev' and
+        'model_fwd', 'prior_dist', 'Ne', 'bool_hgh' and the molecule 'mol'
+        ('mol_name', 'atoms', 'z', 'coords', 'Ne').
+    """
+    import jax.random as jrnd
+    from jax import lax
+    from ofdft_normflows.equiv_flows import Gen_EqvFlow as GCNF
+    from ofdft_normflows.promolecular_distrax import ProMolecularDensity
+    from ofdft_normflows.utils import one_hot_encode, coordinates
+    from ofdft_normflows.hgh_pseudopotentials import HGH_PARAMS, valence_electrons
+
+    mol_name = job['mol_name']
+    Ne, atoms, z, coords = coordinates(mol_name)
+    z_prior = z.ravel()
+    bool_hgh = str(job.get('v_nuc', '')).lower() in ('hgh', 'nuclei_potential_hgh')
+    if bool_hgh:
+        Ne = valence_electrons({'coords': coords, 'z': z}, Ne)
+        z_prior = jnp.array([float(HGH_PARAMS[int(zi)][1]) for zi in z.ravel()])
+
+    _, key = jrnd.split(jrnd.PRNGKey(0))
+    z_one_hot = one_hot_encode(z)
+    model_rev = GCNF(3, tuple(job['nn']), xyz_nuclei=coords, z_one_hot=z_one_hot, bool_neg=False)
+    model_fwd = GCNF(3, tuple(job['nn']), xyz_nuclei=coords, z_one_hot=z_one_hot, bool_neg=True)
+    test_inputs = lax.concatenate((jnp.ones((1, 3)), jnp.ones((1, 1))), 1)
+    params = model_rev.init(key, jnp.array(0.), test_inputs)
+    return {'params': params, 'model_rev': model_rev, 'model_fwd': model_fwd,
+            'prior_dist': ProMolecularDensity(z_prior, coords), 'Ne': Ne, 'bool_hgh': bool_hgh,
+            'mol': {'mol_name': mol_name, 'atoms': atoms, 'z': z, 'coords': coords, 'Ne': Ne}}
+
+
+def density_model(job: dict, flow: Optional[dict] = None) -> Tuple[Any, Callable, dict]:
+    """
+    Density of a run rebuilt from its 'job_params.json' (see 'flow_model'),
+    or of an already built 'flow'.
+
+    Returns
+    -------
+    tuple
+        Initial parameters (the target of the checkpoints), the density
+        'rho(params, x)' -> (N,), Ne rho_NF, and the molecule.
+    """
+    from jax import lax
+    from ofdft_normflows.jax_ode import neural_ode
+
+    flow = flow_model(job) if flow is None else flow
+    model_rev, prior_dist, Ne = flow['model_rev'], flow['prior_dist'], flow['Ne']
+
+    def rho(params, x):
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = neural_ode(params, zt, model_rev, -1., 0., 3)
+        return Ne*jnp.exp(prior_dist.log_prob(z0) - logp_z0).reshape(-1)
+
+    return flow['params'], rho, flow['mol']
+
+
+def restore_checkpoints(ckpt_dir: str, steps: Sequence[int], target: Any,
+                        n_threads: Optional[int] = None) -> list:
+    """
+    Restores the checkpoints of several training steps in parallel threads
+    (deserialization is I/O bound and releases the GIL).
+
+    Parameters
+    ----------
+    ckpt_dir : str
+        Directory of the checkpoints, e.g. '{CKPT_DIR}/checkpoints_all/'.
+    steps : Sequence[int]
+        Training steps (epochs) to restore.
+    target : Any
+        Parameter tree with the structure of the checkpoints, the initial parameters;
+        step 0 falls back to 'target' if it was not saved, other missing steps raise.
+    n_threads : Optional[int], optional
+        Number of threads, by default one per step (at most 16)
+
+    Returns
+    -------
+    list
+        Parameter trees in the order of 'steps'.
+    """
+    from flax.training import checkpoints
+
+    def _restore(step):
+        if step == 0 and not os.path.exists(os.path.join(ckpt_dir, 'checkpoint_0')):
+            return target
+        return checkpoints.restore_checkpoint(ckpt_dir=ckpt_dir, target=target, step=step)
+
+    if n_threads is None:
+        n_threads = min(16, len(steps))
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+        return list(pool.map(_restore, steps))
+
+
+def batched_density(rho: Callable, params: Sequence[Any], bool_vmap: Optional[bool] = None) -> Callable:
+    """
+    Densities of several parameter sets in one compiled function, 'f(x)' -> (N, n_epochs).
+
+    The parameters are closed over (compile-time constants). On GPU/TPU the density is
+    vmapped over the stacked parameters; on CPU the per-checkpoint densities are unrolled
+    in the same executable, XLA folds the constant weights of every network and runs the
+    independent integrations in parallel (H2, (64, 64), 6 checkpoints, 4096 points:
+    7.3 s vs 12.8 s for the vmapped function, same densities).
+
+    Parameters
+    ----------
+    rho : Callable
+        Density of one parameter set, 'rho(params, x)' -> (N,) or (N, 1).
+    params : Sequence[Any]
+        Parameter trees, e.g. from 'restore_checkpoints'.
+    bool_vmap : Optional[bool], optional
+        vmap over the stacked parameters, by default everywhere but on CPU
+    """
+    def _rho(params, x):
+        return jnp.reshape(rho(params, x), (x.shape[0],))
+
+    if bool_vmap is None:
+        bool_vmap = jax.default_backend() != 'cpu'
+    if bool_vmap:
+        stacked = stack_trees(params)
+
+        @jax.jit
+        def rho_epochs(x):
+            return jax.vmap(_rho, in_axes=(0, None), out_axes=1)(stacked, x)
+    else:
+        params = list(params)
+
+        @jax.jit
+        def rho_epochs(x):
+            return jnp.stack([_rho(p, x) for p in params], axis=1)
+    return rho_epochs
+
+
+def density_tag(mol: dict, model: str = 'GCNF') -> str:
+    """Model part of the density cache keys, the flow ('GCNF' for 'flow_model'), the molecule and its (valence) electrons."""
+    return f"{model}_{mol['mol_name']}_Ne{int(mol['Ne'])}"
+
+
+class CachedDensities:
+    """
+    Densities of several parameter sets, 'f(x)' -> (N, n_epochs), through the density
+    cache ('density_cache.default_cache'): for every call only the checkpoints without
+    an entry for (checkpoint, 'x', ODE tolerances, 'tag') are evaluated, all in one
+    compiled function ('batched_density', reused by later calls, e.g. the chunks of
+    a grid), and stored.
+
+    Parameters
+    ----------
+    rho : Callable
+        Density of one parameter set, 'rho(params, x)'.
+    params : Sequence[Any]
+        Parameter trees, e.g. from 'restore_checkpoints'.
+    tag : Optional[str], optional
+        Model of the parameters ('density_tag'), by default None, which bypasses the cache
+    cache : Optional[Any], optional
+        'density_cache.DensityCache', by default the shared one
+    buckets : Sequence[int], optional
+        Bucket sizes of the compiled functions, by default BUCKETS
+    """
+
+    def __init__(self, rho: Callable, params: Sequence[Any], tag: Optional[str] = None,
+                 cache: Optional[Any] = None, buckets: Sequence[int] = BUCKETS):
+        from ofdft_normflows.density_cache import default_cache, params_hash
+
+        self.rho = rho
+        self.params = list(params)
+        self.tag = tag
+        self.cache = default_cache() if cache is None else cache
+        self.buckets = buckets
+        self.bool_cache = tag is not None and self.cache.enabled
+        self.hashes = [params_hash(p) for p in self.params] if self.bool_cache else None
+        self.functions = {}
+
+    def function(self, idx: tuple) -> Callable:
+        """Compiled densities of the parameter sets 'idx'."""
+        if idx not in self.functions:
+            self.functions[idx] = BucketedFunction(batched_density(self.rho, [self.params[i] for i in idx]),
+                                                   self.buckets)
+        return self.functions[idx]
+
+    def __call__(self, x: Array) -> Array:
+        if not self.bool_cache:
+            return self.function(tuple(range(len(self.params))))(x)
+        from ofdft_normflows.density_cache import grid_hash, density_key
+
+        g = grid_hash(x)
+        keys = [density_key(h, g, self.tag) for h in self.hashes]
+        values = [self.cache.get(k) for k in keys]
+        missing = tuple(i for i, v in enumerate(values) if v is None)
+        if missing:
+            y = onp.asarray(self.function(missing)(x))
+            for j, i in enumerate(missing):
+                values[i] = y[:, j]
+                self.cache.put(keys[i], values[i])
+        return jnp.asarray(onp.stack(values, 1))
+
+
+def checkpoint_densities(rho: Callable, params: Sequence[Any], x: Array, tag: Optional[str] = None,
+                         cache: Optional[Any] = None, buckets: Sequence[int] = BUCKETS) -> Array:
+    """Densities of all the parameter sets on the points 'x', (N, n_epochs), see 'CachedDensities'."""
+    return CachedDensities(rho, params, tag, cache, buckets)(x)
+
+
+def density_profiles(rho: Callable, params: Sequence[Any], x: Array, tag: Optional[str] = None,
+                     buckets: Sequence[int] = BUCKETS) -> onp.ndarray:
+    """
+    Densities of all the parameter sets on the points 'x', (n_epochs, N), cached
+    with 'tag' (see 'checkpoint_densities').
+
+    Parameters
+    ----------
+    rho : Callable
+        Density of one parameter set, 'rho(params, x)'.
+    params : Sequence[Any]
+        Parameter trees, e.g. from 'restore_checkpoints'.
+    x : Array
+        Points, (N, 3).
+    tag : Optional[str], optional
+        Model of the parameters ('density_tag'), by default None (not cached)
+    """
+    return onp.asarray(checkpoint_densities(rho, params, x, tag, buckets=buckets)).T
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import argparse
+from typing import Any, Callable, Optional
+
+import jax
+import jax.numpy as jnp
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'ofdft_normflows', 'xla')
+CPU_RUNTIME_FLAG = '--xla_cpu_use_xla_runtime=true'
+
+
+def enable_compilation_cache(cache_dir: Optional[str] = None, min_compile_time: float = 0.) -> str:
+    """
+    Turns on JAX's persistent compilation cache, executables compiled by a previous
+    process with the same program, shapes and flags are loaded from disk.
+
+    JAX 0.4.23 only caches GPU/TPU executables. On CPU the cache also requires the
+    XLA CPU runtime ('--xla_cpu_use_xla_runtime=true' in 'XLA_FLAGS'), which does
+    not compile the 'odeint' loops of the flows, so CPU runs only get the AOT warm-up.
+
+    Parameters
+    ----------
+    cache_dir : Optional[str], optional
+        Cache directory, by default '$OFDFT_CACHE_DIR' or '~/.cache/ofdft_normflows/xla'
+    min_compile_time : float, optional
+        Only executables that took longer to compile are written, by default 0.
+
+    Returns
+    -------
+    str
+        Absolute path of the cache directory.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('OFDFT_CACHE_DIR', DEFAULT_CACHE_DIR)
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_time)
+    return cache_dir
+
+
+def executables_persist(env: Optional[dict] = None) -> bool:
+    """True if a process with the environment 'env' (by default this one) can write its executables to the cache."""
+    env = os.environ if env is None else env
+    return jax.default_backend() != 'cpu' or CPU_RUNTIME_FLAG in env.get('XLA_FLAGS', '')
+
+
+def cache_active() -> bool:
+    """True if executables of the default backend are written to/read from the persistent cache."""
+    if jax.config.jax_compilation_cache_dir is None:
+        return False
+    return executables_persist()
+
+
+def batch_spec(batch_size: int, dim: int) -> jax.ShapeDtypeStruct:
+    """Shape of the batches of 'utils.batch_generator', samples, log-density and score of 2B samples."""
+    return jax.ShapeDtypeStruct((2*batch_size, 2*dim + 1), jax.dtypes.canonicalize_dtype(jnp.float64))
+
+
+def _n_entries(cache_dir: Optional[str]) -> int:
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return 0
+    return len(os.listdir(cache_dir))
+
+
+class WarmUp:
+    """
+    Ahead-of-time compilation of the jitted functions of a driver,
+    'jit(f).lower(*args).compile()', with the time of every phase.
+
+    An executable is reported as loaded from the cache if compiling it did not
+    add new entries to the cache directory.
+    """
+
+    def __init__(self):
+        self.cache_dir = jax.config.jax_compilation_cache_dir
+        self.bool_cache = cache_active()
+        self.report = {}
+
+    def compile(self, name: str, fn: Callable, *args: Any) -> Callable:
+        """Lowers and compiles 'fn' for 'args' (arrays or 'jax.ShapeDtypeStruct'), returns the executable."""
+        n0 = _n_entries(self.cache_dir)
+        start = time.time()
+        lowered = fn.lower(*args)
+        t_lower = time.time()
+        compiled = lowered.compile()
+        t_compile = time.time()
+        self.report[name] = {'lower': t_lower - start,
+                             'compile': t_compile - t_lower,
+                             'cached': self.bool_cache and _n_entries(self.cache_dir) == n0}
+        return compiled
+
+    @property
+    def total(self) -> float:
+        return sum(r['lower'] + r['compile'] for r in self.report.values())
+
+    def summary(self) -> str:
+        lines = [f"{k}: lower {r['lower']:.2f} s, compile {r['compile']:.2f} s"
+                 + (' (cache)' if r['cached'] else '') for k, r in self.report.items()]
+        cache = self.cache_dir if self.bool_cache else 'off'
+        return '\n'.join(lines + [f'total: {self.total:.2f} s, persistent cache: {cache}'])
+
+    def write(self, ckpt_dir: str):
+        with open(f"{ckpt_dir}/compile_times.json", "w") as outfile:
+            json.dump({'cache_dir': self.cache_dir if self.bool_cache else None,
+                       'total': self.total, **self.report}, outfile, indent=4)
+
+
+def add_compilation_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """Adds the compilation-cache flags shared by the training drivers."""
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="persistent compilation cache, by default $OFDFT_CACHE_DIR or ~/.cache/ofdft_normflows/xla")
+    parser.add_argument("--no_cache", action='store_true',
+                        help="do not use the persistent compilation cache")
+    parser.add_argument("--compile_only", "--compile-only", action='store_true',
+                        help="compile the training step, report the compile times and exit (pre-populates the cache)")
+    return parser
+
+
+def cache_from_args(args: argparse.Namespace) -> Optional[str]:
+    if args.no_cache:
+        return None
+    return enable_compilation_cache(args.cache_dir)
@@ -0,0 +1,345 @@
+from typing import Any, Callable, Optional
+
+import jax
+import jax.numpy as jnp
+from jax import lax
+
+Array = jax.Array
+
+
+# ------------------------------------------------------------------------------------------------------------
+# COMPOSITE FUNCTIONAL
+# ------------------------------------------------------------------------------------------------------------
+# The total energy of a batch is evaluated by a single fused kernel: the intermediates shared by several terms
+# (clipped density, rho^(1/3), r_s, |score|^2, ...) are computed once and the backward pass is written by hand
+# (jax.custom_vjp) from the analytic derivatives of every term with respect to the density, the score and the
+# sample positions. The values (and constants) are the same as the ones of 'functionals.py'.
+
+# name -> (group, aliases)
+TERMS = {
+    'tf': ('kin', ('tf', 'thomas_fermi')),
+    'tf1d': ('kin', ('tf1d', 'thomas_fermi_1d')),
+    'w': ('kin', ('w', 'weizsacker', 'w1d', 'weizsacker1d')),
+    'dirac': ('x', ('dirac', 'lda', 'local_density_approximation')),
+    'b88': ('x', ('b88', 'b88_x_e')),
+    'pw92': ('c', ('pw92', 'pw92_c_e', 'correlation_pw92_c_e')),
+    'vwn': ('c', ('vwn', 'vwn_c_e', 'correlation_vwn_c_e')),
+    'xc_1d': ('xc', ('xc_1d', 'exchange_correlation_1d')),
+    'nuclei': ('vnuc', ('nuclei', 'nuclei_potential')),
+    'attr': ('vnuc', ('attr', 'attraction')),
+    'hartree': ('hart', ('hartree', 'hartree_potential')),
+    'hartree_mt': ('hart', ('hartree_mt',)),
+    'softc': ('hart', ('softc', 'soft_coulomb')),
+}
+_ALIASES = {a: name for name, (_, aliases) in TERMS.items() for a in aliases}
+
+CLIP_CTE = 1e-30
+
+
+def parse_spec(spec: str) -> list:
+    """
+    Parses a composite functional spec, e.g. "tf+w, nuclei, hartree, dirac+0.5*b88, pw92".
+    Terms are separated by ',' or '+' and can be scaled with '<weight>*<name>'.
+
+    Parameters
+    ----------
+    spec : str
+        Composite functional spec.
+
+    Returns
+    -------
+    list
+        List of (name, weight) pairs.
+    """
+    terms = []
+    for group in spec.split(','):
+        for term in group.split('+'):
+            term = term.strip().lower()
+            if term == '':
+                continue
+            w = 1.
+            if '*' in term:
+                w, term = term.split('*')
+                w, term = float(w), term.strip()
+            if term not in _ALIASES:
+                raise ValueError(f"Unknown functional '{term}' in '{spec}'.")
+            name = _ALIASES[term]
+            if name in [t[0] for t in terms]:
+                raise ValueError(f"Functional '{name}' appears twice in '{spec}'.")
+            terms.append((name, w))
+    return terms
+
+
+def _local_terms(names: list, den: Array, score: Array, Ne: int, bool_grad: bool) -> dict:
+    """
+    Local (density and score dependent) terms, returns name -> (e, de/dden, de/dscore).
+    Derivatives are None if 'bool_grad' is False or the term does not depend on the variable.
+    """
+    out = {}
+    den_c = jnp.clip(den, a_min=CLIP_CTE)
+    score_sqr = jnp.sum(score*score, axis=-1, keepdims=True)
+    den_13 = den**(1/3)
+    den_c_13 = den_c**(1/3)
+    rs = (3/(4*jnp.pi))**(1/3)/den_c_13
+
+    if 'tf' in names:
+        c = (3./10.)*(3.*jnp.pi**2)**(2/3)*(Ne**(5/3))
+        e = c*den_13*den_13
+        out['tf'] = (e, (2/3)*e/den if bool_grad else None, None)
+
+    if 'tf1d' in names:
+        c = (jnp.pi*jnp.pi)/24*(Ne**3)
+        out['tf1d'] = (c*den*den, 2*c*den if bool_grad else None, None)
+
+    if 'w' in names:
+        c = 0.2*Ne/8.
+        out['w'] = (c*score_sqr, None, 2*c*score if bool_grad else None)
+
+    if 'dirac' in names:
+        c = -(3/4)*(Ne**(4/3))*(3/jnp.pi)**1/3  # same constant as 'functionals.lda'
+        e = c*den_13
+        out['dirac'] = (e, e/(3*den) if bool_grad else None, None)
+
+    if 'b88' in names:
+        beta = 0.0042
+        c = -beta*Ne**(2/3)
+        grad_den_norm_sq = jnp.clip(score_sqr*den_c*den_c, a_min=CLIP_CTE)
+        x = jnp.sqrt(grad_den_norm_sq)/(den_c_13*den_c)
+        asinh_x = jnp.arcsinh(x)
+        d = 1 + 6*beta*x*asinh_x
+        x_sqr_d = x*x/d
+        e = c*den_c*den_c_13*x_sqr_d
+        e_den, e_score = None, None
+        if bool_grad:
+            # f(x) = x^2/D(x), f'(x) = x g(x), g = (2D - x D')/D^2
+            d_prime = 6*beta*(asinh_x + x/jnp.sqrt(1 + x*x))
+            g = (2*d - x*d_prime)/(d*d)
+            e_den = c*den_c_13*((4/3)*x_sqr_d - (1/3)*x*x*g)
+            e_score = c*den_c_13*den_c_13*g*score
+        out['b88'] = (e, e_den, e_score)
+
+    if 'pw92' in names:
+        A_ = 0.031091
+        alpha1 = 0.21370
+        beta1 = 7.5957
+        beta2 = 3.5876
+        beta3 = 1.6382
+        beta4 = 0.49294
+        rs_12 = jnp.sqrt(rs)
+        p = beta1*rs_12 + beta2*rs + beta3*rs*rs_12 + beta4*rs*rs
+        log_p = jnp.log(1 + (1/(2*A_))/p)
+        e = -2*A_*Ne*(1 + alpha1*rs)*log_p
+        e_den = None
+        if bool_grad:
+            p_prime = beta1/(2*rs_12) + beta2 + 1.5*beta3*rs_12 + 2*beta4*rs
+            de_drs = Ne*(-2*A_*alpha1*log_p + (1 + alpha1*rs)*p_prime/(p*p + p/(2*A_)))
+            e_den = -de_drs*rs/(3*den_c)
+        out['pw92'] = (e, e_den, None)
+
+    if 'vwn' in names:
+        A = 0.0621814
+        b = 3.72744
+        c = 12.9352
+        x0 = -0.10498
+        Q = jnp.sqrt(4*c - b**2)
+        X0 = x0**2 + b*x0 + c
+        x = jnp.sqrt(rs)
+        X = x*x + b*x + c
+        atan = jnp.arctan(Q/(2.*x + b))
+        e_PF = A/2.*(2.*jnp.log(x) - jnp.log(X) + 2.*b/Q*atan
+                     - b*x0/X0*(jnp.log((x - x0)**2./X) + 2.*(2.*x0 + b)/Q*atan))
+        e_den = None
+        if bool_grad:
+            X_prime = 2*x + b
+            de_dx = A/2.*(2./x - X_prime/X - b/X
+                          - b*x0/X0*(2./(x - x0) - X_prime/X - (2.*x0 + b)/X))
+            e_den = -Ne*de_dx*x/(6*den_c)
+        out['vwn'] = (Ne*e_PF, e_den, None)
+
+    if 'xc_1d' in names:
+        a0, b0, c0 = -0.8862269, -2.1414101, 0.4721355
+        d0, e0, f0 = 2.81423, 0.529891, 0.458513
+        g0, h0 = -0.202642, 0.470876
+        alpha0, beta0 = 0.104435, 4.11613
+        rs_1d = 1/(2*Ne*den)
+        n1 = a0 + b0*rs_1d + c0*rs_1d**2
+        d1 = 1 + d0*rs_1d + e0*rs_1d**2 + f0*rs_1d**3
+        u = rs_1d + alpha0*rs_1d**beta0
+        n2 = g0*rs_1d*jnp.log(u)
+        d2 = 1 + h0*rs_1d**2
+        e = Ne*(n1/d1 + n2/d2)
+        e_den = None
+        if bool_grad:
+            n1_prime = b0 + 2*c0*rs_1d
+            d1_prime = d0 + 2*e0*rs_1d + 3*f0*rs_1d**2
+            n2_prime = g0*jnp.log(u) + g0*rs_1d*(1 + alpha0*beta0*rs_1d**(beta0 - 1))/u
+            d2_prime = 2*h0*rs_1d
+            de_drs = Ne*((n1_prime*d1 - n1*d1_prime)/(d1*d1) + (n2_prime*d2 - n2*d2_prime)/(d2*d2))
+            e_den = -de_drs*rs_1d/den
+        out['xc_1d'] = (e, e_den, None)
+
+    return out
+
+
+def _position_terms(names: list, x: Array, xp: Array, Ne: int, mol: Any, bool_grad: bool) -> dict:
+    """
+    Terms that depend on the sample positions, returns name -> (e, de/dx, de/dxp).
+    """
+    out = {}
+
+    if 'nuclei' in names:
+        eps = 1E-4
+        diff = x[:, None, :] - mol['coords'][None]  # (B, A, 3)
+        dist = jnp.sqrt(jnp.sum(diff*diff, axis=-1))
+        r = dist + eps
+        z = jnp.ravel(mol['z'])
+        e = -Ne*jnp.sum(z/r, axis=-1, keepdims=True)
+        e_x = None
+        if bool_grad:
+            w = z/(jnp.clip(dist, a_min=CLIP_CTE)*r*r)
+            e_x = Ne*jnp.einsum('ba,bad->bd', w, diff)
+        out['nuclei'] = (e, e_x, None)
+
+    if 'attr' in names:
+        R, Z_alpha, Z_beta = mol['R'], mol['Z_alpha'], mol['Z_beta']
+        u_a = 1 + (x + R/2)**2
+        u_b = 1 + (x - R/2)**2
+        e = Ne*(-Z_alpha/jnp.sqrt(u_a) - Z_beta/jnp.sqrt(u_b))
+        e_x = None
+        if bool_grad:
+            e_x = Ne*(Z_alpha*(x + R/2)/(u_a*jnp.sqrt(u_a)) + Z_beta*(x - R/2)/(u_b*jnp.sqrt(u_b)))
+        out['attr'] = (e, e_x, None)
+
+    diff = x - xp
+    if 'hartree' in names:
+        eps = 1E-5
+        q = jnp.sum(diff*diff + eps, axis=-1, keepdims=True)
+        e = 0.5*(Ne**2)/jnp.sqrt(q)
+        e_x = -e*diff/q if bool_grad else None
+        out['hartree'] = (e, e_x, None if e_x is None else -e_x)
+
+    if 'hartree_mt' in names:
+        alpha = 0.5
+        r = jnp.sqrt(jnp.sum(diff*diff, axis=-1, keepdims=True))
+        e = 0.5*(Ne**2)*(lax.erf(alpha*r)/r + lax.erfc(alpha*r)/r)
+        e_x = -0.5*(Ne**2)*diff/(r*r*r) if bool_grad else None
+        out['hartree_mt'] = (e, e_x, None if e_x is None else -e_x)
+
+    if 'softc' in names:
+        q = 1 + diff*diff
+        e = (Ne**2)/jnp.sqrt(q)
+        e_x = -e*diff/q if bool_grad else None
+        out['softc'] = (e, e_x, None if e_x is None else -e_x)
+
+    return out
+
+
+def composite_functional(spec: str, Ne: int, mol: Optional[Any] = None) -> Callable:
+    """
+    Builds the fused per-sample kernel of a composite energy functional.
+
+    Parameters
+    ----------
+    spec : str
+        Composite functional spec, e.g. "tf+w, nuclei, hartree, dirac+b88, pw92", see 'parse_spec'.
+    Ne : int
+        Number of electrons.
+    mol : Optional[Any], optional
+        Molecular information, {'coords', 'z'} for 'nuclei' and {'R', 'Z_alpha', 'Z_beta'} for 'attr'.
+
+    Returns
+    -------
+    Callable
+        'f(den, score, x, xp) -> (e, terms)', with 'e' the per-sample total energy (B, 1)
+        and 'terms' a dict with the weighted per-sample contribution of every term.
+    """
+    terms = parse_spec(spec)
+    names = [t[0] for t in terms]
+    weights = dict(terms)
+    if any(TERMS[name][0] == 'vnuc' for name in names) and mol is None:
+        raise ValueError("The nuclear potential needs 'mol'.")
+
+    def _forward(den, score, x, xp, bool_grad):
+        values = _local_terms(names, den, score, Ne, bool_grad)
+        values.update(_position_terms(names, x, xp, Ne, mol, bool_grad))
+        contributions = {name: weights[name]*values[name][0] for name in names}
+        e = sum(contributions.values())
+        return e, contributions, values
+
+    @jax.custom_vjp
+    def kernel(den: Array, score: Array, x: Array, xp: Array):
+        e, contributions, _ = _forward(den, score, x, xp, False)
+        return e, contributions
+
+    def kernel_fwd(den, score, x, xp):
+        e, contributions, values = _forward(den, score, x, xp, True)
+        partials = {name: v[1:] for name, v in values.items()}
+        return (e, contributions), (partials, den, score, x, xp)
+
+    def kernel_bwd(res, g):
+        partials, den, score, x, xp = res
+        g_e, g_terms = g
+        g_den, g_score = jnp.zeros_like(den), jnp.zeros_like(score)
+        g_x, g_xp = jnp.zeros_like(x), jnp.zeros_like(xp)
+        for name in names:
+            ct = weights[name]*(g_e + g_terms[name])
+            d_1, d_2 = partials[name]
+            if TERMS[name][0] in ('vnuc', 'hart'):
+                g_x = g_x + ct*d_1 if d_1 is not None else g_x
+                g_xp = g_xp + ct*d_2 if d_2 is not None else g_xp
+            else:
+                g_den = g_den + ct*d_1 if d_1 is not None else g_den
+                g_score = g_score + ct*d_2 if d_2 is not None else g_score
+        return g_den, g_score, g_x, g_xp
+
+    kernel.defvjp(kernel_fwd, kernel_bwd)
+    return jax.jit(kernel)
+
+
+def group_energies(terms: dict) -> dict:
+    """
+    Sums the per-term contributions of a composite functional into the groups of
+    'F_values' ('kin', 'vnuc', 'hart', 'xc'); exchange and correlation go into 'xc'.
+    """
+    groups = {'kin': 0., 'vnuc': 0., 'hart': 0., 'xc': 0.}
+    for name, e in terms.items():
+        group = TERMS[name][0]
+        groups['xc' if group in ('x', 'c', 'xc') else group] += e
+    return groups
+
+
+if __name__ == '__main__':
+    from ofdft_normflows.functionals import _kinetic, _nuclear, _hartree, _exchange_correlation
+
+    jax.config.update("jax_enable_x64", True)
+
+    coords = jnp.array([[0., 0., -1.4008538753/2], [0., 0., 1.4008538753/2]])
+    z = jnp.array([1, 1])
+    mol = {'coords': coords, 'z': z}
+    Ne = 2
+    bs = 64
+
+    key = jax.random.PRNGKey(0)
+    k0, k1, k2, k3 = jax.random.split(key, 4)
+    den = jnp.exp(jax.random.normal(k0, (bs, 1)))
+    score = jax.random.normal(k1, (bs, 3))
+    x = jax.random.normal(k2, (bs, 3))
+    xp = jax.random.normal(k3, (bs, 3))
+
+    def reference(den, score, x, xp):
+        e = _kinetic('tf-w')(den, score, Ne) + _nuclear('nuclei')(x, Ne, mol) + \
+            _hartree('hartree')(x, xp, Ne) + _exchange_correlation('dirac_b88_x_e')(den, score, Ne) + \
+            _exchange_correlation('pw92_c_e')(den, Ne)
+        return jnp.mean(e)
+
+    f = composite_functional("tf+w, nuclei, hartree, dirac+b88, pw92", Ne, mol)
+
+    def fused(den, score, x, xp):
+        e, _ = f(den, score, x, xp)
+        return jnp.mean(e)
+
+    e_ref, g_ref = jax.value_and_grad(reference, argnums=(0, 1, 2, 3))(den, score, x, xp)
+    e_f, g_f = jax.value_and_grad(fused, argnums=(0, 1, 2, 3))(den, score, x, xp)
+    print(f'E reference = {e_ref:.10f}, E fused = {e_f:.10f}')
+    for name, gi_ref, gi_f in zip(['den', 'score', 'x', 'xp'], g_ref, g_f):
+        print(f'max |dE/d{name} error| = {jnp.max(jnp.abs(gi_ref - gi_f)):.2e}')
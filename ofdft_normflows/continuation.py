@@ -0,0 +1,155 @@
+import time
+from typing import Any, Callable, Optional, Sequence
+
+import numpy as onp
+import jax
+
+
+def order_path(points: Sequence[Any], start: Optional[int] = None) -> list:
+    """
+    Orders the points of a continuation path so that consecutive points are neighbours.
+
+    One dimensional paths (e.g. a list of interatomic distances) are sorted.
+    Multi dimensional paths (e.g. (R, mixing) pairs) are chained greedily from
+    'start' by nearest neighbour after scaling each coordinate to [0, 1].
+
+    Parameters
+    ----------
+    points : Sequence[Any]
+        Points of the path, scalars or tuples of floats.
+    start : Optional[int], optional
+        Index of the first point, by default the smallest point. For one dimensional
+        paths it has to be one of the ends (smallest or largest point).
+
+    Returns
+    -------
+    list
+        Indices of 'points' in path order.
+    """
+    x = onp.asarray(points, dtype=float)
+    if x.ndim == 1:
+        order = list(onp.argsort(x, kind='stable'))
+        if start is not None and start != order[0]:
+            if start != order[-1]:
+                raise ValueError(f"A one dimensional path starts at one of its ends, point {start} "
+                                 f"({x[start]}) is an interior point.")
+            order = order[::-1]
+        return [int(i) for i in order]
+
+    span = x.max(axis=0) - x.min(axis=0)
+    x = (x - x.min(axis=0))/onp.where(span > 0, span, 1.)
+    if start is None:
+        start = int(onp.lexsort(x.T[::-1])[0])
+    order = [start]
+    remaining = set(range(len(x))) - {start}
+    while remaining:
+        idx = onp.array(sorted(remaining))
+        d = onp.linalg.norm(x[idx] - x[order[-1]], axis=1)
+        order.append(int(idx[onp.argmin(d)]))
+        remaining.remove(order[-1])
+    return order
+
+
+def extrapolate_params(params_1: Any, params_2: Any, s_1: Any, s_2: Any, s: Any) -> Any:
+    r"""
+    Linear extrapolation of the flow parameters from the two previous points of the path,
+
+    \theta(s) = \theta_1 + \frac{|s - s_1|}{|s_1 - s_2|}(\theta_1 - \theta_2)
+
+    Parameters
+    ----------
+    params_1 : Any
+        Converged parameters of the previous point 's_1'.
+    params_2 : Any
+        Converged parameters of the point before 's_1', 's_2'.
+    s_1, s_2, s : Any
+        Path coordinates (scalars or tuples).
+
+    Returns
+    -------
+    Any
+        Extrapolated parameters for 's'.
+    """
+    s_1, s_2, s = (onp.atleast_1d(onp.asarray(v, dtype=float))
+                   for v in (s_1, s_2, s))
+    h_12 = onp.linalg.norm(s_1 - s_2)
+    if h_12 == 0.:
+        return params_1
+    c = onp.linalg.norm(s - s_1)/h_12
+    return jax.tree_util.tree_map(lambda p1, p2: p1 + c*(p1 - p2), params_1, params_2)
+
+
+def run_continuation(train_point: Callable,
+                     points: Sequence[Any],
+                     params_init: Any,
+                     bool_extrapolate: bool = False,
+                     start: Optional[int] = None,
+                     train_cold: Optional[Callable] = None) -> list:
+    """
+    Continuation driver, trains the flow along a path of geometries or functional
+    mixings. Each point is warm-started from the converged parameters of its
+    neighbour on the path (or from a linear extrapolation of the two previous
+    points) instead of the identity-initialized flow.
+
+    Parameters
+    ----------
+    train_point : Callable
+        'train_point(point, params) -> (params, info)', trains one point starting
+        from 'params', 'info' is a dict that should contain the number of 'epochs' used.
+    points : Sequence[Any]
+        Points of the path.
+    params_init : Any
+        Initial parameters of the first point.
+    bool_extrapolate : bool, optional
+        Extrapolate the initial parameters from the two previous points, by default False
+    start : Optional[int], optional
+        Index of the first point, see 'order_path'.
+    train_cold : Optional[Callable], optional
+        'train_cold(point, params_init) -> (params, info)', if given every point is also
+        trained from 'params_init' (cold start) for the time-to-accuracy comparison, by
+        default None. The first point is the same in both modes and is not trained again.
+
+    Returns
+    -------
+    list
+        One dict per point (in path order) with the 'point', its 'index' in 'points',
+        the converged 'params' and the 'info' returned by 'train_point' ('wall_time' is
+        added if missing); with 'train_cold' also the 'info_cold' of the cold start.
+    """
+    results = []
+    for k, idx in enumerate(order_path(points, start)):
+        point = points[idx]
+        if k == 0:
+            params = params_init
+        elif k == 1 or not bool_extrapolate:
+            params = results[-1]['params']
+        else:
+            params = extrapolate_params(results[-1]['params'], results[-2]['params'],
+                                        results[-1]['point'], results[-2]['point'], point)
+        params, info = _timed(train_point, point, params)
+        results.append({'point': point, 'index': idx,
+                       'params': params, 'info': info})
+        if train_cold is not None:
+            results[-1]['info_cold'] = info if k == 0 else _timed(train_cold, point, params_init)[1]
+    return results
+
+
+def _timed(train_point: Callable, point: Any, params: Any):
+    start = time.time()
+    params, info = train_point(point, params)
+    info = {'wall_time': time.time() - start, **info}
+    return params, info
+
+
+def time_to_accuracy(results: list) -> dict:
+    """
+    Total epochs and wall time of the warm-started points of 'run_continuation(..., train_cold)'
+    and of their cold starts, and the ratios cold/warm.
+    """
+    out = {}
+    for mode, key in (('warm', 'info'), ('cold', 'info_cold')):
+        out[f'epochs_{mode}'] = int(sum(r[key]['epochs'] for r in results))
+        out[f'wall_time_{mode}'] = float(sum(r[key]['wall_time'] for r in results))
+    out['epochs_ratio'] = out['epochs_cold']/max(out['epochs_warm'], 1)
+    out['wall_time_ratio'] = out['wall_time_cold']/max(out['wall_time_warm'], 1E-9)
+    return out
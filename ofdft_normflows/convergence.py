@@ -0,0 +1,239 @@
+import argparse
+from abc import ABC, abstractmethod
+from typing import Optional, Sequence
+from collections import deque
+
+import numpy as onp
+
+
+class WindowCriterion(ABC):
+    """
+    Base class of the convergence criteria, keeps the last 'window' values of
+    one of the quantities logged during training ('key').
+
+    Parameters
+    ----------
+    tol : float
+        Tolerance of the criterion.
+    window : int, optional
+        Number of epochs the criterion is evaluated over, by default 200
+    """
+    key = None
+    name = None
+
+    def __init__(self, tol: float, window: int = 200):
+        self.tol = tol
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.history = deque(maxlen=self.window)
+
+    def update(self, value: float) -> Optional[str]:
+        """
+        Adds the value of an epoch.
+
+        Returns
+        -------
+        Optional[str]
+            Description of the criterion once it is satisfied, otherwise None.
+        """
+        self.history.append(float(value))
+        if len(self.history) < self.window:
+            return None
+        return self.check(onp.asarray(self.history))
+
+    @abstractmethod
+    def check(self, x: onp.ndarray) -> Optional[str]:
+        """Description of the criterion if the full window 'x' satisfies it, otherwise None."""
+
+
+class EMAChange(WindowCriterion):
+    """The EMA energy changed by less than 'tol' (max - min) over the window."""
+    key = 'e_ema'
+    name = 'ema'
+
+    def check(self, x: onp.ndarray) -> Optional[str]:
+        delta = x.max() - x.min()
+        if delta < self.tol:
+            return f'ema_energy: |dE| = {delta:.2e} < {self.tol:.1e} over {self.window} epochs'
+        return None
+
+
+class EnergyStdError(WindowCriterion):
+    """
+    Standard error of the mean energy over the window, estimated with 'n_blocks'
+    block averages of the per-epoch Monte Carlo energies, is below 'tol' and the
+    means of the two halves of the window agree within two standard errors (no drift).
+    """
+    key = 'energy'
+    name = 'stderr'
+
+    def __init__(self, tol: float, window: int = 200, n_blocks: int = 10):
+        self.n_blocks = n_blocks
+        super().__init__(tol, window)
+
+    @staticmethod
+    def _block_stderr(x: onp.ndarray, n_blocks: int) -> float:
+        n_blocks = max(2, min(n_blocks, x.shape[0]))
+        blocks = onp.array_split(x, n_blocks)
+        means = onp.array([b.mean() for b in blocks])
+        return means.std(ddof=1)/onp.sqrt(n_blocks)
+
+    def check(self, x: onp.ndarray) -> Optional[str]:
+        se = self._block_stderr(x, self.n_blocks)
+        x_1, x_2 = onp.array_split(x, 2)
+        se_12 = onp.sqrt(self._block_stderr(x_1, self.n_blocks//2)**2 +
+                         self._block_stderr(x_2, self.n_blocks//2)**2)
+        drift = abs(x_2.mean() - x_1.mean())
+        if se < self.tol and drift < 2.*se_12:
+            return f'energy_stderr: SE = {se:.2e} < {self.tol:.1e}, drift = {drift:.2e} over {self.window} epochs'
+        return None
+
+
+class NormFlatness(WindowCriterion):
+    """The normalization integral stayed within 'tol' of 1 over the window."""
+    key = 'norm'
+    name = 'norm'
+
+    def check(self, x: onp.ndarray) -> Optional[str]:
+        delta = onp.abs(x - 1.).max()
+        if delta < self.tol:
+            return f'norm: |I - 1| = {delta:.2e} < {self.tol:.1e} over {self.window} epochs'
+        return None
+
+
+class ConvergenceMonitor:
+    """
+    Combines several convergence criteria, used for early stopping.
+
+    Parameters
+    ----------
+    criteria : Sequence[WindowCriterion]
+        Convergence criteria.
+    mode : str, optional
+        'all' (every criterion has to be satisfied) or 'any', by default 'all'
+    min_epochs : int, optional
+        Epochs before convergence can be declared, by default 0
+    """
+
+    def __init__(self, criteria: Sequence[WindowCriterion], mode: str = 'all', min_epochs: int = 0):
+        if mode not in ('all', 'any'):
+            raise ValueError(f"Unknown convergence mode '{mode}', use 'all' or 'any'.")
+        self.criteria = list(criteria)
+        self.mode = mode
+        self.min_epochs = min_epochs
+        self.reset()
+
+    def reset(self):
+        for c in self.criteria:
+            c.reset()
+        self.epoch = None
+        self.reason = None
+
+    def update(self, epoch: int, e_ema: float = None, energy: float = None, norm: float = None) -> bool:
+        """
+        Adds the logged quantities of an epoch. Criteria whose quantity is not
+        given are left untouched.
+
+        Returns
+        -------
+        bool
+            True once the monitor is converged.
+        """
+        values = {'e_ema': e_ema, 'energy': energy, 'norm': norm}
+        reasons = []
+        for c in self.criteria:
+            if values[c.key] is None:
+                reasons.append(None)
+                continue
+            reasons.append(c.update(values[c.key]))
+
+        if epoch < self.min_epochs or len(self.criteria) == 0:
+            return False
+        satisfied = [r for r in reasons if r is not None]
+        if (self.mode == 'all' and len(satisfied) == len(reasons)) or \
+                (self.mode == 'any' and len(satisfied) > 0):
+            self.epoch = epoch
+            self.reason = '; '.join(satisfied)
+            return True
+        return False
+
+    @property
+    def converged(self) -> bool:
+        return self.reason is not None
+
+
+def get_monitor(criteria: str,
+                window: int = 200,
+                ema_tol: float = 1E-4,
+                se_tol: float = 1E-3,
+                norm_tol: float = 1E-3,
+                mode: str = 'all',
+                min_epochs: int = 0) -> Optional[ConvergenceMonitor]:
+    """
+    Builds a convergence monitor from a comma separated list of criteria,
+    'ema', 'stderr' and/or 'norm'.
+
+    Parameters
+    ----------
+    criteria : str
+        Criteria, e.g. 'ema,norm'. None or an empty string disables early stopping.
+    window : int, optional
+        Window (in epochs) of every criterion, by default 200
+    ema_tol : float, optional
+        Tolerance of the EMA energy change [Ha], by default 1E-4
+    se_tol : float, optional
+        Tolerance of the energy standard error [Ha], by default 1E-3
+    norm_tol : float, optional
+        Tolerance of |I - 1|, by default 1E-3
+    mode : str, optional
+        'all' or 'any', by default 'all'
+    min_epochs : int, optional
+        Epochs before convergence can be declared, by default 0
+
+    Returns
+    -------
+    Optional[ConvergenceMonitor]
+        Monitor, or None if no criterion is given.
+    """
+    if criteria is None or criteria.strip() == '':
+        return None
+
+    c = []
+    for name in criteria.lower().split(','):
+        name = name.strip()
+        if name in ('ema', 'ema_energy'):
+            c.append(EMAChange(ema_tol, window))
+        elif name in ('stderr', 'se', 'energy_stderr'):
+            c.append(EnergyStdError(se_tol, window))
+        elif name in ('norm', 'normalization'):
+            c.append(NormFlatness(norm_tol, window))
+        else:
+            raise ValueError(f"Unknown convergence criterion '{name}'.")
+    return ConvergenceMonitor(c, mode, min_epochs)
+
+
+def add_convergence_args(parser: argparse.ArgumentParser):
+    """Early-stopping arguments, shared by the training drivers."""
+    parser.add_argument("--early_stop", type=str, default=None,
+                        help="comma separated convergence criteria: 'ema', 'stderr', 'norm'")
+    parser.add_argument("--conv_mode", type=str, default='all',
+                        help="stop when 'all' or 'any' of the criteria are satisfied")
+    parser.add_argument("--conv_window", type=int, default=200,
+                        help="window (epochs) of the convergence criteria")
+    parser.add_argument("--conv_tol", type=float, default=1E-4,
+                        help="tolerance of the EMA energy change")
+    parser.add_argument("--se_tol", type=float, default=1E-3,
+                        help="tolerance of the energy standard error")
+    parser.add_argument("--norm_tol", type=float, default=1E-3,
+                        help="tolerance of the normalization |I - 1|")
+    parser.add_argument("--min_epochs", type=int, default=0,
+                        help="epochs before convergence can be declared")
+    return parser
+
+
+def monitor_from_args(args: argparse.Namespace):
+    """Convergence monitor of the CLI arguments, None without '--early_stop'."""
+    return get_monitor(args.early_stop, args.conv_window, args.conv_tol,
+                       args.se_tol, args.norm_tol, args.conv_mode, args.min_epochs)
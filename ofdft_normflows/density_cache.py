@@ -0,0 +1,163 @@
+import os
+import hashlib
+from typing import Any, Optional
+
+import numpy as onp
+import jax
+
+from ofdft_normflows.jax_ode import ODE_ATOL, ODE_RTOL
+
+DEFAULT_DENSITY_CACHE_DIR = os.path.join('~', '.cache', 'ofdft_normflows', 'density')
+DEFAULT_DENSITY_CACHE_SIZE = 2048  # MB
+
+
+def params_hash(params: Any) -> str:
+    """Hash of a parameter tree (structure, shapes, dtypes and values), the identity of a checkpoint."""
+    h = hashlib.sha1()
+    leaves, treedef = jax.tree_util.tree_flatten(params)
+    h.update(str(treedef).encode())
+    for leaf in leaves:
+        leaf = onp.ascontiguousarray(leaf)
+        h.update(f'{leaf.shape}{leaf.dtype}'.encode())
+        h.update(leaf.tobytes())
+    return h.hexdigest()
+
+
+def grid_hash(x: Any) -> str:
+    """Hash of the points of a grid (shape, dtype and values)."""
+    x = onp.ascontiguousarray(x)
+    h = hashlib.sha1(f'{x.shape}{x.dtype}'.encode())
+    h.update(x.tobytes())
+    return h.hexdigest()
+
+
+def density_key(checkpoint: str, grid: str, tag: str = '',
+                atol: float = ODE_ATOL, rtol: float = ODE_RTOL) -> str:
+    """
+    Key of the density of a checkpoint ('params_hash') on a grid ('grid_hash') for the
+    ODE solver tolerances; 'tag' identifies the model around the parameters (e.g. the molecule).
+    """
+    s = f'{checkpoint}|{grid}|{tag}|atol={atol:.3e}|rtol={rtol:.3e}'
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+class DensityCache:
+    """
+    Disk-backed cache of density arrays, one '{key}.npy' file per (checkpoint, grid,
+    solver tolerance), see 'density_key'. A hit touches the file, and after every
+    write the least recently used files are evicted until the cache holds at most
+    'max_size' MB. Writes are atomic, several processes can share a directory.
+
+    Parameters
+    ----------
+    cache_dir : Optional[str], optional
+        Cache directory, by default '$OFDFT_DENSITY_CACHE_DIR' or '~/.cache/ofdft_normflows/density'
+    max_size : Optional[float], optional
+        Size limit in MB, by default '$OFDFT_DENSITY_CACHE_SIZE' or 2048; 0 disables the cache
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_size: Optional[float] = None):
+        if cache_dir is None:
+            cache_dir = os.environ.get('OFDFT_DENSITY_CACHE_DIR', DEFAULT_DENSITY_CACHE_DIR)
+        if max_size is None:
+            max_size = float(os.environ.get('OFDFT_DENSITY_CACHE_SIZE', DEFAULT_DENSITY_CACHE_SIZE))
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_bytes = int(max_size*2**20)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key: str) -> Optional[onp.ndarray]:
+        if not self.enabled:
+            return None
+        fname = self._file(key)
+        try:
+            value = onp.load(fname)
+            os.utime(fname)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        value = onp.asarray(value)
+        if value.nbytes > self.max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fname = self._file(key)
+        tmp = f'{fname[:-len(".npy")]}_{os.getpid()}_tmp.npy'
+        onp.save(tmp, value)
+        os.replace(tmp, fname)
+        self.evict()
+
+    def entries(self) -> list:
+        """(last access, size, file) of every entry, least recently used first."""
+        out = []
+        if not os.path.isdir(self.cache_dir):
+            return out
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.npy') or f.endswith('_tmp.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, f))
+            except FileNotFoundError:
+                continue
+            out.append((st.st_mtime, st.st_size, f))
+        return sorted(out)
+
+    def size(self) -> int:
+        """Total size of the entries in bytes."""
+        return sum(s for _, s, _ in self.entries())
+
+    def evict(self, max_bytes: Optional[int] = None):
+        """Removes the least recently used entries until the cache holds at most 'max_bytes'."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(s for _, s, _ in entries)
+        for _, s, f in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, f))
+            except FileNotFoundError:
+                pass
+            total -= s
+
+    def clear(self):
+        self.evict(0)
+
+
+_DEFAULT_CACHE = None
+
+
+def default_cache() -> DensityCache:
+    """Cache shared by the analysis utilities, configured by the environment (see 'DensityCache')."""
+    global _DEFAULT_CACHE
+    if _DEFAULT_CACHE is None:
+        _DEFAULT_CACHE = DensityCache()
+    return _DEFAULT_CACHE
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Density cache of the analysis utilities")
+    parser.add_argument("--dir", type=str, default=None, help="cache directory")
+    parser.add_argument("--clear", action='store_true', help="remove every entry")
+    args = parser.parse_args()
+
+    cache = DensityCache(args.dir)
+    if args.clear:
+        cache.clear()
+    entries = cache.entries()
+    print(f'{cache.cache_dir}: {len(entries)} entries, {sum(s for _, s, _ in entries)/2**20:.1f} MB '
+          f'(limit {cache.max_bytes/2**20:.0f} MB)')
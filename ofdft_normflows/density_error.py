@@ -0,0 +1,270 @@
+import os
+import json
+import hashlib
+from typing import Any, Callable, Optional, Sequence
+
+import numpy as onp
+import pandas as pd
+import jax
+import jax.numpy as jnp
+
+from ofdft_normflows.becke_grid import becke_grid, screen_grid
+from ofdft_normflows.checkpoint_analysis import (checkpoint_steps, select_steps, load_job, flow_model, density_model,
+                                                 restore_checkpoints, CachedDensities, density_tag)
+
+Array = jax.Array
+
+DEFAULT_REFERENCE_DIR = os.path.join('~', '.cache', 'ofdft_normflows', 'reference')
+
+# N_NF, \int rho_NF on the screened grid; L1, \int |rho_NF - rho_DFT|; L2, \int (rho_NF - rho_DFT)^2;
+# dipole, |\int r (rho_NF - rho_DFT)|; radial, \int |D_NF(r) - D_DFT(r)| dr of the radial distributions
+ERROR_COLUMNS = ('N_NF', 'L1', 'L2', 'dipole', 'radial')
+
+
+def reference_key(mol: dict, level: int, threshold: float, dr: float, basis_set: str) -> str:
+    """Short hash of everything the reference values depend on."""
+    s = json.dumps({'atoms': list(mol['atoms']), 'coords': onp.round(onp.asarray(mol['coords'], dtype=float), 8).tolist(),
+                    'level': level, 'threshold': threshold, 'dr': dr, 'basis_set': basis_set}, sort_keys=True)
+    return hashlib.sha1(s.encode()).hexdigest()[:12]
+
+
+def reference_density(mol: dict, level: int = 3, threshold: float = 1E-10, dr: float = 0.05,
+                      basis_set: str = '6-31G(d,p)', cache_dir: Optional[str] = None,
+                      chunk_size: int = 32768) -> dict:
+    """
+    DFT density of the training ('DFTDistribution') on a Becke grid, screened and
+    cached in '{cache_dir}/{mol_name}_{key}.npz', so the SCF and the PySCF evaluation
+    run once per molecule and grid.
+
+    Parameters
+    ----------
+    mol : dict
+        Molecule, 'mol_name', 'atoms', 'z' and 'coords' (e.g. from 'density_model').
+    level : int, optional
+        Becke grid level ('becke_grid.GRID_LEVELS'), by default 3
+    threshold : float, optional
+        Points with |w rho_DFT| below 'threshold' are dropped, by default 1E-10
+    dr : float, optional
+        Bin width (Bohr) of the radial distribution, by default 0.05
+    basis_set : str, optional
+        Basis set of the DFT reference, by default '6-31G(d,p)'
+    cache_dir : Optional[str], optional
+        Cache directory, by default '$OFDFT_REFERENCE_DIR' or '~/.cache/ofdft_normflows/reference'
+    chunk_size : int, optional
+        Points per PySCF evaluation, by default 32768
+
+    Returns
+    -------
+    dict
+        'points' (P, 3), 'weights' (P,), 'rho' (P,), the origin of the dipole and of the
+        radial distribution (centre of nuclear charge), the radial 'bins' of the points (P,)
+        and the reference 'dipole' (3,) and radial distribution 'radial' (n_bins,).
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('OFDFT_REFERENCE_DIR', DEFAULT_REFERENCE_DIR)
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    fname = os.path.join(cache_dir, f"{mol['mol_name']}_{reference_key(mol, level, threshold, dr, basis_set)}.npz")
+    if os.path.exists(fname):
+        with onp.load(fname) as data:
+            return {k: data[k] for k in data.files}
+
+    from pyscf.dft import numint
+    from ofdft_normflows.dft_distrax import DFTDistribution
+
+    coords = onp.asarray(mol['coords'], dtype=float)
+    z = onp.asarray(mol['z'], dtype=float).ravel()
+    m = DFTDistribution(mol['atoms'], coords, basis_set=basis_set)
+    x, w = becke_grid(coords, z, level)
+    x = onp.asarray(x)
+    rho = onp.concatenate([numint.eval_rho(m.mol, numint.eval_ao(m.mol, x[i:i + chunk_size], deriv=0), m.rdm1)
+                           for i in range(0, x.shape[0], chunk_size)])
+    x, w, rho = screen_grid(jnp.asarray(x), w, jnp.asarray(rho), threshold)
+    x, w, rho = onp.asarray(x), onp.asarray(w), onp.asarray(rho).ravel()
+
+    origin = (z @ coords)/z.sum()
+    bins = onp.floor(onp.linalg.norm(x - origin, axis=1)/dr).astype(int)
+    ref = {'points': x, 'weights': w, 'rho': rho, 'origin': origin, 'bins': bins, 'dr': onp.array(dr),
+           'dipole': (w*rho) @ (x - origin), 'radial': onp.bincount(bins, weights=w*rho)}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = fname[:-len('.npz')] + '_tmp.npz'
+    onp.savez(tmp, **ref)
+    os.replace(tmp, fname)
+    return ref
+
+
+def density_errors(f_densities: Callable, ref: dict, chunk_size: int = 65536) -> dict:
+    r"""
+    Errors of the densities 'f_densities(x)' -> (N, n_epochs) (e.g. 'CachedDensities'
+    of a batch of checkpoints) with respect to the reference ('reference_density'), see ERROR_COLUMNS.
+
+    The grid is evaluated 'chunk_size' points at a time and only the sums of the
+    errors are kept, the memory does not grow with the grid.
+    The radial distribution, D(r) = 4 pi r^2 <rho>(r) about the centre of nuclear charge,
+    is binned with the widths of the reference, \int |D_NF - D_DFT| dr <= L1.
+
+    Returns
+    -------
+    dict
+        Column -> (n_epochs,) values.
+    """
+    x, w, rho, bins = ref['points'], ref['weights'], ref['rho'], ref['bins']
+    n_bins = ref['radial'].shape[0]
+    sums = None
+    for start in range(0, x.shape[0], chunk_size):
+        sl = slice(start, start + chunk_size)
+        y = onp.asarray(f_densities(jnp.asarray(x[sl])))
+        diff = y - rho[sl, None]
+        wd = w[sl, None]*diff
+        chunk = {'N_NF': w[sl] @ y, 'L1': w[sl] @ onp.abs(diff), 'L2': w[sl] @ diff**2,
+                 'dipole': (x[sl] - ref['origin']).T @ wd,
+                 'radial': onp.stack([onp.bincount(bins[sl], weights=wd[:, e], minlength=n_bins)
+                                      for e in range(wd.shape[1])], 1)}
+        sums = chunk if sums is None else {k: sums[k] + v for k, v in chunk.items()}
+    return {'N_NF': sums['N_NF'], 'L1': sums['L1'], 'L2': sums['L2'],
+            'dipole': onp.linalg.norm(sums['dipole'], axis=0),
+            'radial': onp.abs(sums['radial']).sum(0)}
+
+
+def error_store(run_dir: str, mol_name: str) -> str:
+    """CSV of the density errors of a run, next to 'training_trajectory_{mol_name}.csv' (one row per epoch)."""
+    return os.path.join(run_dir, f'density_errors_{mol_name}.csv')
+
+
+def evaluate_checkpoints(rwd: str, steps: str = 'last', member: Optional[int] = None, level: int = 3,
+                         threshold: float = 1E-10, dr: float = 0.05, cache_dir: Optional[str] = None,
+                         epochs_per_batch: int = 8, n_threads: Optional[int] = None,
+                         bool_store: bool = True) -> pd.DataFrame:
+    """
+    Density errors (ERROR_COLUMNS) of the checkpoints of a run selected by 'steps'
+    ('checkpoint_analysis.select_steps', 'last' for the final checkpoint, 'log:20' for a series).
+
+    The checkpoints are evaluated 'epochs_per_batch' at a time with one compiled function
+    ('CachedDensities', through the density cache). With 'bool_store' the results are merged in
+    '{rwd}/density_errors_{mol}.csv' ('member_<k>/' for a member of an ensemble run).
+    HGH runs are rejected with a ValueError, the flow only holds the valence density
+    and is not comparable to the all-electron reference.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per selected epoch, 'epoch' and ERROR_COLUMNS.
+    """
+    from ofdft_normflows.offline_metrics import update_store
+
+    job = load_job(rwd)
+    flow = flow_model(job)
+    if flow['bool_hgh']:
+        raise ValueError(f"{rwd} is an HGH run (valence density), it is not comparable to the all-electron reference.")
+    run_dir = rwd if member is None else os.path.join(rwd, f'member_{member}')
+    ckpt_dir = os.path.join(run_dir, 'checkpoints_all')
+    selected = select_steps(checkpoint_steps(ckpt_dir), steps)
+
+    params0, rho, mol = density_model(job, flow)
+    ref = reference_density(mol, level, threshold, dr, cache_dir=cache_dir)
+    rows = []
+    for start in range(0, len(selected), epochs_per_batch):
+        batch = selected[start:start + epochs_per_batch]
+        params = restore_checkpoints(ckpt_dir, batch, params0, n_threads)
+        values = {'epoch': onp.array(batch)}
+        values.update(density_errors(CachedDensities(rho, params, density_tag(mol)), ref))
+        rows.append(pd.DataFrame(values))
+    df = pd.concat(rows, ignore_index=True)
+    if bool_store:
+        update_store(error_store(run_dir, mol['mol_name']), df)
+    return df
+
+
+def rank_runs(rwds: Sequence[str], steps: str = 'last', sort_by: str = 'L1', reduce: str = 'last',
+              info: Optional[dict] = None, **kwargs: Any) -> pd.DataFrame:
+    """
+    Ranks runs by their density errors, one row per run.
+
+    Parameters
+    ----------
+    rwds : Sequence[str]
+        Results directories.
+    steps : str, optional
+        Checkpoints evaluated in every run, by default 'last'
+    sort_by : str, optional
+        Error column of the ranking, by default 'L1'
+    reduce : str, optional
+        Row of a run, 'last' (last selected checkpoint) or 'best' (lowest 'sort_by'), by default 'last'
+    info : Optional[dict], optional
+        Results directory -> dict of extra columns (e.g. 'config_id' and the configuration of a sweep)
+    kwargs : Any
+        Arguments of 'evaluate_checkpoints'.
+
+    Returns
+    -------
+    pd.DataFrame
+        'rank', 'rwd', 'epoch', ERROR_COLUMNS and the 'info' columns, sorted by 'sort_by';
+        runs that could not be evaluated are kept at the end with their 'error'.
+    """
+    rows = []
+    for rwd in rwds:
+        row = {'rwd': rwd}
+        row.update((info or {}).get(rwd, {}))
+        try:
+            df = evaluate_checkpoints(rwd, steps, **kwargs)
+            r = df.iloc[-1] if reduce == 'last' else df.loc[df[sort_by].idxmin()]
+            row.update({'epoch': int(r['epoch']), **{k: r[k] for k in ERROR_COLUMNS}})
+        except (OSError, ValueError, KeyError) as e:
+            row['error'] = f'{type(e).__name__}: {e}'
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    if sort_by not in df:
+        df[sort_by] = onp.nan
+    df = df.sort_values(sort_by, na_position='last').reset_index(drop=True)
+    df.insert(0, 'rank', onp.arange(1, len(df) + 1))
+    return df
+
+
+def sweep_runs(index_file: str) -> dict:
+    """Completed runs of a sweep ('sweep.SweepIndex'), results directory -> 'config_id' and configuration."""
+    from ofdft_normflows.sweep import SweepIndex
+
+    index = SweepIndex(index_file)
+    runs = {}
+    for cid, r in index.records.items():
+        if r['status'] != 'completed':
+            continue
+        config = json.loads(r['config']) if r['config'] else {}
+        runs[r['results_dir']] = {'config_id': cid, **config}
+    return runs
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Density errors of saved checkpoints against the DFT reference")
+    parser.add_argument("--rwd", type=str, nargs='*', default=[], help="results directories")
+    parser.add_argument("--index", type=str, default=None,
+                        help="sweep index (OFDFT_NF_sweep.py), evaluates every completed run")
+    parser.add_argument("--steps", type=str, default='last',
+                        help="'last', 'all', 'stride:k', 'log:n' or '0,1,11,...'")
+    parser.add_argument("--member", type=int, default=None, help="member of an ensemble run")
+    parser.add_argument("--level", type=int, default=3, help="Becke grid level")
+    parser.add_argument("--threshold", type=float, default=1E-10, help="screening threshold of |w rho_DFT|")
+    parser.add_argument("--dr", type=float, default=0.05, help="bin width of the radial distribution (Bohr)")
+    parser.add_argument("--sort_by", type=str, default='L1', help=f"ranking column, {', '.join(ERROR_COLUMNS)}")
+    parser.add_argument("--reduce", type=str, default='last', choices=['last', 'best'],
+                        help="checkpoint of each run in the ranking")
+    parser.add_argument("--epochs_per_batch", type=int, default=8, help="checkpoints evaluated at once")
+    parser.add_argument("--out", type=str, default='density_ranking.csv', help="ranking CSV")
+    args = parser.parse_args()
+
+    info = sweep_runs(args.index) if args.index else {}
+    rwds = list(dict.fromkeys(list(args.rwd) + list(info)))
+    if not rwds:
+        parser.error("no runs, use --rwd and/or --index")
+
+    start = time.time()
+    df = rank_runs(rwds, args.steps, args.sort_by, args.reduce, info, member=args.member, level=args.level,
+                   threshold=args.threshold, dr=args.dr, epochs_per_batch=args.epochs_per_batch)
+    df.to_csv(args.out, index=False)
+    print(df.to_string(index=False))
+    print(f'{len(rwds)} runs, {time.time() - start:.1f} s, ranking in {args.out}')
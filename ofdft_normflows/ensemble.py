@@ -0,0 +1,105 @@
+from typing import Any, Callable, Sequence
+
+import jax
+import jax.numpy as jnp
+from jax import lax, vmap
+import jax.random as jrnd
+from jax._src import prng
+
+Array = jax.Array
+
+
+def stack_trees(trees: Sequence[Any]) -> Any:
+    """
+    Stacks a list of pytrees with identical structure along a new leading axis.
+
+    Parameters
+    ----------
+    trees : Sequence[Any]
+        Pytrees (e.g. flow parameters or optimizer states) of the ensemble members.
+
+    Returns
+    -------
+    Any
+        A single pytree whose leaves have an extra leading axis of size len(trees).
+    """
+    return jax.tree_util.tree_map(lambda *xs: jnp.stack(xs), *trees)
+
+
+def unstack_trees(tree: Any) -> list:
+    """
+    Inverse of 'stack_trees', splits a stacked pytree into its members.
+
+    Parameters
+    ----------
+    tree : Any
+        Pytree whose leaves share the same leading (ensemble) axis.
+
+    Returns
+    -------
+    list
+        List of pytrees, one per ensemble member.
+    """
+    leaves, treedef = jax.tree_util.tree_flatten(tree)
+    n = leaves[0].shape[0]
+    return [jax.tree_util.tree_unflatten(treedef, [l[i] for l in leaves]) for i in range(n)]
+
+
+def broadcast_members(values: Sequence[Any], n: int) -> list:
+    """
+    Broadcasts a per-member hyperparameter list to 'n' members.
+    A single value is repeated, otherwise the length must match.
+
+    Parameters
+    ----------
+    values : Sequence[Any]
+        Hyperparameter values.
+    n : int
+        Number of ensemble members.
+
+    Returns
+    -------
+    list
+        List with exactly 'n' values.
+    """
+    values = list(values)
+    if len(values) == 1:
+        return values*n
+    if len(values) != n:
+        raise ValueError(
+            f"Expected 1 or {n} ensemble values, got {len(values)}.")
+    return values
+
+
+def ensemble_batch_generator(keys: prng.PRNGKeyArray, batch_size: int, prior_dist: Callable):
+    """
+    Vectorized version of 'utils.batch_generator', yields one batch per ensemble
+    member from a single compiled sampling call.
+
+    Parameters
+    ----------
+    keys : prng.PRNGKeyArray
+        Stacked keys, one per ensemble member.
+    batch_size : int
+        Size of the batch of each member.
+    prior_dist : Callable
+        Prior distribution.
+
+    """
+    v_score = vmap(jax.grad(lambda x: prior_dist.log_prob(x).sum()))
+
+    def _half(key):
+        samples = prior_dist.sample(seed=key, sample_shape=batch_size)
+        logp_samples = prior_dist.log_prob(samples)
+        score = v_score(samples)
+        return lax.concatenate((samples, logp_samples, score), 1)
+
+    def _batch(key):
+        _, key0 = jrnd.split(key)
+        _, key1 = jrnd.split(key0)
+        return lax.concatenate((_half(key0), _half(key1)), 0), key1
+
+    v_batch = jax.jit(vmap(_batch))
+    while True:
+        batch, keys = v_batch(keys)
+        yield batch
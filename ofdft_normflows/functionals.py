@@ -8,6 +8,8 @@ from jax import jit, vmap, hessian, jacrev, lax
 
 #from utils import *
 from ofdft_normflows.utils import *
+from ofdft_normflows.tree_code import nuclei_potential_tree
+from ofdft_normflows.nuclear import nuclei_coulomb, nuclei_smooth, nuclei_hgh
 
 
 Array = jax.Array
@@ -504,19 +506,22 @@ def Hartree_potential_MT(x: Any, xp: Any, Ne: int, alpha=0.5) -> jax.Array:
 def _nuclear(name: str = 'NP'):
     if name.lower() == 'nuclei_potential' or name.lower() == 'nuclei':
         def wrapper(*args):
-            return Nuclei_potential(*args)
+            return nuclei_coulomb(*args)
     elif name.lower() == 'madness' or name.lower() == 'mdns':
+        # scaled by the nuclear charge, Z u(r/c)/c, unlike 'Nuclei_potential_smooth' (same for hydrogen)
         def wrapper(*args):
-            return Nuclei_potential_smooth(*args)
+            return nuclei_smooth(*args)
     elif name.lower() == 'harmonic' or name.lower() == 'ho':
-        def wrapper(*args):
-            return Nuclei_potential_smooth(*args)
+        raise ValueError("'harmonic' has no (x, Ne, mol) form, use 'harmonic_potential(params, x, Ne, k)'.")
     elif name.lower() == 'attraction' or name.lower() == 'attr':
         def wrapper(*args):
             return attraction(*args)
     elif name.lower() == 'hgh' or name.lower() == 'nuclei_potential_hgh':
         def wrapper(*args):
-            return Nuclei_potential_HGH(*args)
+            return nuclei_hgh(*args)
+    elif name.lower() == 'nuclei_tree' or name.lower() == 'nuclei_potential_tree':
+        def wrapper(*args):
+            return nuclei_potential_tree(*args)
 
     return wrapper
 
@@ -614,45 +619,26 @@ def Nuclei_potential_smooth(params: Any, x: Any,  Ne: int, mol_info: Any):
     return -Ne*r  # lax.expand_dims(r, dimensions=(1,))
 
 
-@jit
 def Nuclei_potential_HGH(x: Any,  Ne: int, mol_info: Any):
-    # INCORRECT only Hydrogen parameters
-    #  Phys. Rev. B 58, 3641
-    two_sqrt = jnp.sqrt(2)
-    # H_pp_params = {'Zion': jnp.ones(1), 'rloc': 2*jnp.ones(1),
-    #                'C1': -4.180237*jnp.ones(1), 'C2': 0.725075*jnp.ones(1), 'C3': jnp.zeros(1), 'C4': jnp.zeros(1), }
-    H_pp_params = {'Zion': 1., 'rloc': 0.2,
-                   'C1': -4.180237, 'C2': 0.725075, 'C3': 0., 'C4': 0., }
-
-    @jax.jit
-    def _u(r: Any, params_pp: Any):
-        # eq 1
-        zion = params_pp['Zion']
-        rloc = params_pp['rloc']
-        c1 = params_pp['C1']
-        c2 = params_pp['C2']
-        c3 = params_pp['C3']
-        c4 = params_pp['C4']
-        r_rloc = r/rloc
-        r_rloc_2 = r_rloc*r_rloc
-        v0 = (-zion/r)*lax.erf(r_rloc/two_sqrt)
-        v1 = jnp.exp(-0.5*(r_rloc_2))
-        v2 = c1 + c2*r_rloc_2 + c3*(r_rloc**4) + c4*(r_rloc**6)
-        return v0 + v1*v2
+    r"""
+    Local part of the HGH pseudopotentials (Phys. Rev. B 58, 3641, eq 1) with the
+    parameters of every element, see 'hgh_pseudopotentials.HGH_PARAMS'.
 
-    @jax.jit
-    def _potential(x: Any, molecule: Any):
-        z = molecule['z']
-        # ai = molecule['atoms']
-        r = jnp.sqrt(
-            jnp.sum((x-molecule['coords'])*(x-molecule['coords']), axis=1))
-        params_p_zi = H_pp_params
-        v = _u(r, params_p_zi)
-        return v
+    Parameters
+    ----------
+    x : Any
+        A point where the potential is evaluated.
+    Ne : int
+        Number of (valence) electrons.
+    mol_info : Any
+        Molecular information.
 
-    r_all = vmap(_potential, in_axes=(None, 0), out_axes=-1)(x, mol_info)
-    r = jnp.sum(r_all, axis=-1, keepdims=True)
-    return Ne*r  # lax.expand_dims(r, dimensions=(1,))
+    Returns
+    -------
+    jax.Array
+        Electron-nuclei interaction potential.
+    """
+    return nuclei_hgh(x, Ne, mol_info)
 
 
 @jit
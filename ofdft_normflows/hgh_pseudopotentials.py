@@ -1,98 +1,213 @@
+from typing import Any
+
+import numpy as np
+import chex
 import jax
 import jax.numpy as jnp
-from jax import vmap
-from jax.scipy.special import sph_harm, gamma
-
-jax.config.update('jax_disable_jit', True)
-
-H_pp_params = {'Zion': 1., 'rloc': 0.2,
-               'C1': -4.180237, 'C2': 0.725075, 'C3': 0., 'C4': 0., }
-O_pp_params = {'Zion': 6., 'rloc': 0.247621,
-               'C1': -16.580318, 'C2': 2.395701, 'C3': 0., 'C4': 0., }
-
-#
-# UNDER CONSTRUCTION
-#
-
-@jax.jit
-def cartesian_to_spherical(cartesian_coords):
-    x, y, z = cartesian_coords[0], cartesian_coords[1], cartesian_coords[2]
-    r = jnp.sqrt(x**2 + y**2 + z**2)
-    # Clip the value to ensure it is within [-1, 1]
-    phi = jnp.arccos(jnp.clip(z / r, -1.0, 1.0))
-    theta = jnp.arctan2(y, x)
-
-    # Convert theta to the range [0, 2*pi]
-    theta = jnp.where(theta < 0, theta + 2*jnp.pi, theta)
-
-    # Convert phi to the range [0, pi]
-    phi = jnp.where(phi < 0, phi + jnp.pi, phi)
-
-    return jnp.stack((r, phi, theta), axis=-1)
-
-
-@jax.jit
-def _sph_harm(r_theta_phi, l, m):
-    _, theta, phi = r_theta_phi[0], r_theta_phi[2], r_theta_phi[1]
-    print(l, m)
-    return sph_harm(m, l, theta, phi)
-
-
-sph_harm_vmap_m = vmap(_sph_harm, in_axes=(None, None, 0))
-
-
-def p_l_i(r, rl, l, i):
-    # Phys. Rev. B 58, 3641 1998
-    # Eq. 3
-
-    sqrt_2 = jnp.sqrt(2)
+from jax.scipy.special import gamma
+
+from ofdft_normflows.nuclear import compile_molecule, nuclear_potential
+
+Array = jax.Array
+
+# HGH/GTH (LDA, Pade) pseudopotentials, Phys. Rev. B 58, 3641 (1998) and Phys. Rev. B 54, 1703 (1996).
+# Z: (symbol, Zion, rloc, (C1, C2, C3, C4), ((r_l, h^l), ...) for l = 0, 1, ...)
+# Li, Be, Na and Mg are the valence-only (no semicore) parametrizations.
+HGH_PARAMS = {
+    1: ('H', 1, 0.20000000, (-4.18023680, 0.72507482, 0., 0.), ()),
+    2: ('He', 2, 0.20000000, (-9.11202340, 1.69836797, 0., 0.), ()),
+    3: ('Li', 1, 0.78755305, (-1.89261247, 0.28605968, 0., 0.), ((0.66637518, ((1.85881111,),)), (1.07930561, ((-0.00589504,),)))),
+    4: ('Be', 2, 0.73900865, (-2.59295078, 0.35483893, 0., 0.), ((0.52879656, ((3.06166591,),)), (0.65815348, ((0.09246196,),)))),
+    5: ('B', 3, 0.43392956, (-5.57864173, 0.80425145, 0., 0.), ((0.37384326, ((6.23392822,),)),)),
+    6: ('C', 4, 0.34883045, (-8.51377110, 1.22843203, 0., 0.), ((0.30455321, ((9.52284179,),)),)),
+    7: ('N', 5, 0.28917923, (-12.23481988, 1.76640728, 0., 0.), ((0.25660487, ((13.55224272,),)),)),
+    8: ('O', 6, 0.24762086, (-16.58031797, 2.39570092, 0., 0.), ((0.22178614, ((18.26691718,),)),)),
+    9: ('F', 7, 0.21852465, (-21.30736112, 3.07286942, 0., 0.), ((0.19556721, ((23.58494211,),)),)),
+    10: ('Ne', 8, 0.19000000, (-27.69285182, 4.00590585, 0., 0.), ((0.17948804, ((28.50609828, 0.416828), (0.416828, -1.07624528))), (0.21491271, ((-8.991e-05,),)))),
+    11: ('Na', 1, 0.88550938, (-1.23886713, 0., 0., 0.), ((0.66110390, ((1.84727135, -0.22540903), (-0.22540903, 0.58200362))), (0.85711928, ((0.47113258,),)))),
+    12: ('Mg', 2, 0.65181169, (-2.86429746, 0., 0., 0.), ((0.55647814, ((2.97095712, -0.5150839), (-0.5150839, 1.32994091))), (0.67756881, ((1.04988101,),)))),
+    13: ('Al', 3, 0.45000000, (-8.49135116, 0., 0., 0.), ((0.46010427, ((5.08833953, -1.03784325), (-1.03784325, 2.67969975))), (0.53674439, ((2.19343827,),)))),
+    14: ('Si', 4, 0.44000000, (-7.33610297, 0., 0., 0.), ((0.42273813, ((5.90692831, -1.26189397), (-1.26189397, 3.25819622))), (0.48427842, ((2.72701346,),)))),
+    15: ('P', 5, 0.43000000, (-6.65421981, 0., 0., 0.), ((0.38980284, ((6.84213556, -1.4936909), (-1.4936909, 3.85669332))), (0.44079585, ((3.28260592,),)))),
+    16: ('S', 6, 0.42000000, (-6.55449184, 0., 0., 0.), ((0.36175665, ((7.9053025, -1.7318813), (-1.7318813, 4.4716983))), (0.40528502, ((3.866579,),)))),
+    17: ('Cl', 7, 0.41000000, (-6.86475431, 0., 0., 0.), ((0.33820832, ((9.06223968, -1.96193036), (-1.96193036, 5.0656824))), (0.37613709, ((4.4658764,),)))),
+    18: ('Ar', 8, 0.40000000, (-7.10000000, 0., 0., 0.), ((0.31738081, ((10.24948699, -2.16984522), (-2.16984522, 5.60251627))), (0.35161921, ((4.97880101,),)))),
+}
+
+# local part only, (Zion, rloc, C1, C2, C3, C4), used by 'nuclear.compile_molecule'
+HGH_LOCAL = {z: (float(p[1]), p[2]) + p[3] for z, p in HGH_PARAMS.items()}
+
+L_MAX = 2  # s, p and d projectors
+N_PROJ = 3  # projectors per angular momentum
+
+# real spherical harmonics up to l = 2, normalization constants are computed once
+_Y0 = 0.5*np.sqrt(1./np.pi)
+_Y1 = np.sqrt(3./(4*np.pi))
+_Y2 = (0.5*np.sqrt(15./np.pi), 0.25*np.sqrt(5./np.pi), 0.25*np.sqrt(15./np.pi))
+
+
+@chex.dataclass
+class Projectors:
+    """
+    Nonlocal part of the HGH pseudopotentials of a molecule as arrays over the atoms,
+    radii 'r_l' (Na, L_MAX + 1) and coupling matrices 'h' (Na, L_MAX + 1, N_PROJ, N_PROJ),
+    zero for the channels an element does not have.
+    """
+    coords: chex.ArrayDevice
+    r_l: chex.ArrayDevice
+    h: chex.ArrayDevice
+
+
+def valence_electrons(mol_info: Any, Ne: int) -> int:
+    """Number of electrons left once the core electrons of every atom are replaced by the pseudopotential."""
+    z = np.asarray(mol_info['z']).ravel()
+    return int(Ne - sum(int(zi) - HGH_PARAMS[int(zi)][1] for zi in z))
+
+
+def compile_projectors(mol_info: Any) -> Projectors:
+    """
+    Precomputes the nonlocal HGH parameters of a molecule.
+
+    Parameters
+    ----------
+    mol_info : Any
+        Molecular information, {'coords': (Na, 3), 'z': (Na,)}.
+
+    Returns
+    -------
+    Projectors
+    """
+    if isinstance(mol_info, Projectors):
+        return mol_info
+    z = np.asarray(mol_info['z']).ravel()
+    na = z.shape[0]
+    r_l = np.ones((na, L_MAX + 1))
+    h = np.zeros((na, L_MAX + 1, N_PROJ, N_PROJ))
+    for a, zi in enumerate(z):
+        if int(zi) not in HGH_PARAMS:
+            raise ValueError(f"no HGH parameters for Z = {int(zi)}")
+        for l, (rl, hl) in enumerate(HGH_PARAMS[int(zi)][4]):
+            hl = np.asarray(hl)
+            r_l[a, l] = rl
+            h[a, l, :hl.shape[0], :hl.shape[1]] = hl
+    coords = np.asarray(mol_info['coords'], dtype=float).reshape(-1, 3)
+    return Projectors(coords=jnp.asarray(coords), r_l=jnp.asarray(r_l), h=jnp.asarray(h))
+
+
+def p_l_i(r: Array, r_l: Array) -> jax.Array:
+    r"""
+    Radial projectors of all channels, Phys. Rev. B 58, 3641, Eq. 3,
+
+    p_i^l(r) = \frac{\sqrt{2} r^{l + 2(i-1)} e^{-r^2/2r_l^2}}{r_l^{l + (4i-1)/2} \sqrt{\Gamma(l + (4i-1)/2)}}.
+
+    Parameters
+    ----------
+    r : Array
+        Distances, (...).
+    r_l : Array
+        Radii of the channels, (..., L_MAX + 1).
+
+    Returns
+    -------
+    jax.Array
+        Projectors, (..., L_MAX + 1, N_PROJ).
+    """
+    l = jnp.arange(L_MAX + 1)[:, None]
+    i = jnp.arange(1, N_PROJ + 1)[None, :]
     c0 = l + (4*i - 1)/2
-    c1 = l+2*i - 1
-    val0 = jnp.exp(-(r*r)/(2*rl*rl))
-    val0 = sqrt_2*(r*c1)*val0
-    _sqrt_gamma = jnp.sqrt(gamma(c0))
-    val1 = (rl**c0)*_sqrt_gamma
-    return val0/val1
+    c1 = l + 2*(i - 1)
+    r = r[..., None, None]
+    rl = r_l[..., None]
+    return jnp.sqrt(2.)*(r**c1)*jnp.exp(-0.5*(r/rl)**2)/((rl**c0)*jnp.sqrt(gamma(c0)))
 
 
-def v_l(r, rp, l_max, hl_params):
+def real_sph_harm(u: Array) -> jax.Array:
+    """Real spherical harmonics Y_lm (l = 0, 1, 2) of unit vectors, (..., 3) -> (..., 9)."""
+    x, y, z = u[..., 0], u[..., 1], u[..., 2]
+    return jnp.stack((_Y0*jnp.ones_like(x),
+                      _Y1*y, _Y1*z, _Y1*x,
+                      _Y2[0]*x*y, _Y2[0]*y*z, _Y2[1]*(3*z*z - 1.), _Y2[0]*x*z, _Y2[2]*(x*x - y*y)),
+                     axis=-1)
 
-    r_sph = cartesian_to_spherical(r)
-    rp_sph = cartesian_to_spherical(rp)
 
-    m_ = jnp.arange(-l_max, l_max+1, dtype=int)
+def _overlaps(x: Array, proj: Projectors):
+    """p_i^l(|x - R_A|) Y_lm(x - R_A) for every sample and atom, one array per l, (N, Na, N_PROJ, 2l+1)."""
+    d = x[:, None, :] - proj.coords[None]
+    r = jnp.sqrt(jnp.sum(d*d, axis=-1))
+    u = d/jnp.where(r > 0., r, 1.)[..., None]
+    p = p_l_i(r, proj.r_l[None])
+    y = real_sph_harm(u)
+    slices = ((0, 1), (1, 4), (4, 9))
+    return [p[..., l, :, None]*y[..., None, a:b] for l, (a, b) in enumerate(slices)]
 
-    return sph_harm(-2, jnp.array([2]), r_sph[2], r_sph[1])
-    # y_lm_r = sph_harm_vmap_m(r_sph, l_max, m_)
-    # y_lm_rp = sph_harm_vmap_m(rp_sph, l_max, m_)
-    # return y_lm_r, y_lm_rp
 
+@jax.jit
+def hgh_nonlocal(x: Array, xp: Array, den: Array, denp: Array, Ne: int, proj: Projectors) -> jax.Array:
+    r"""
+    Nonlocal HGH energy of the bosonic orbital \phi = \sqrt{\rho_{\mathcal{M}}},
+
+    E_{\text{nl}} = \sum_{A,l,m} \sum_{ij} h^{l}_{ij} \langle \phi | p^l_i Y_{lm} \rangle \langle p^l_j Y_{lm} | \phi \rangle,
+
+    where every overlap is a Monte Carlo average over the samples of the shape
+    factor, \langle p Y | \phi \rangle = \sqrt{N_e} E_x[p Y / \sqrt{\rho_\phi(x)}].
+    The two overlaps use independent samples (x, xp), so the product is unbiased.
+
+    Parameters
+    ----------
+    x, xp : Array
+        Two independent batches of samples, (B, 3).
+    den, denp : Array
+        Shape factor at the samples, (B, 1).
+    Ne : int
+        Number of (valence) electrons.
+    proj : Projectors
+        See 'compile_projectors'.
+
+    Returns
+    -------
+    jax.Array
+        Per-sample contribution, (B, 1), its mean is the energy.
+    """
+    w = 1./jnp.sqrt(jnp.ravel(den))
+    wp = 1./jnp.sqrt(jnp.ravel(denp))
+    e = 0.
+    for l, (b, bp) in enumerate(zip(_overlaps(x, proj), _overlaps(xp, proj))):
+        b = b*w[:, None, None, None]
+        bp = jnp.mean(bp*wp[:, None, None, None], axis=0)
+        e = e + jnp.einsum('aij,naim,ajm->n', proj.h[:, l], b, bp)
+    return Ne*e[:, None]
+
+
+def hgh_local(x: Array, Ne: int, mol_info: Any) -> jax.Array:
+    """Local part of the HGH pseudopotentials of mixed elements, see 'nuclear.nuclear_potential'."""
+    return nuclear_potential(x, Ne, compile_molecule(mol_info, HGH_LOCAL), 'hgh')
 
 
 if __name__ == '__main__':
-
-    print(jax.__version__)
-    import jax.random as jrnd
-    rng = jrnd.PRNGKey(0)
-    _, key = jrnd.split(rng)
-    r_rp = jrnd.normal(key, (2, 3))
-    r = r_rp[0]
-    rp = r_rp[1]
-    print(rp, cartesian_to_spherical(rp))
-    l_max = 1
-    hl_params = 0.
-
-    # print(v_l(r, rp, l_max, hl_params))
-
-    import matplotlib.pyplot as plt
-    import jax.scipy.special as jp
-
-    l = jnp.array([1])
-    m = jnp.array([-1])
-    print(jp.sph_harm(m, l, 0., jnp.pi/2))
-    print(0.5*jnp.sqrt(3/(2*jnp.pi)))
-
-    r_shp = cartesian_to_spherical(r)
-    print(jp.sph_harm(m, l, r_shp[1][None], r_shp[2][None]))
-
-    # notes theta and phi must be arrays. also m and l
+    import argparse
+    from ofdft_normflows.promolecular_distrax import ProMolecularDensity
+    from ofdft_normflows.utils import coordinates
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="HGH pseudopotential energies of the promolecular density")
+    parser.add_argument("--mol_name", type=str, default='H2O', help="molecule name")
+    parser.add_argument("--n", type=int, default=4096, help="samples per batch")
+    args = parser.parse_args()
+
+    Ne, atoms, z, coords = coordinates(args.mol_name)
+    mol_info = {'coords': coords, 'z': z}
+    Nv = valence_electrons(mol_info, Ne)
+    # promolecular density of the valence electrons only
+    prior_dist = ProMolecularDensity(jnp.array([float(HGH_PARAMS[int(zi)][1]) for zi in z]), coords)
+    key_x, key_xp = jax.random.split(jax.random.PRNGKey(0))
+    x = prior_dist.sample(seed=key_x, sample_shape=args.n)
+    xp = prior_dist.sample(seed=key_xp, sample_shape=args.n)
+    den = jnp.exp(prior_dist.log_prob(x))
+    denp = jnp.exp(prior_dist.log_prob(xp))
+
+    proj = compile_projectors(mol_info)
+    e_loc = jnp.mean(hgh_local(x, Nv, mol_info))
+    e_nl = jnp.mean(hgh_nonlocal(x, xp, den, denp, Nv, proj))
+    print(f'{args.mol_name}: valence electrons {Nv} (of {Ne})')
+    print(f'E_loc: {e_loc:.6f}  E_nl: {e_nl:.6f}')
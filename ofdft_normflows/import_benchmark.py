@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import subprocess
+from typing import Optional, Sequence
+
+# heavy dependencies that should only be imported by the code paths that use them
+HEAVY_MODULES = ('pyscf', 'distrax', 'flax', 'optax', 'matplotlib', 'pandas')
+
+# statement -> dependencies it must not import
+DEFAULT_CHECKS = {
+    'import ofdft_normflows': HEAVY_MODULES,
+    'from ofdft_normflows import _kinetic': ('pyscf', 'distrax', 'flax'),
+    'import LiH': ('pyscf',),
+    'import OFDFT_NF': (),
+}
+
+_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+t = time.perf_counter() - start
+print(json.dumps({{'time': t, 'modules': [m for m in {modules!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(statement: str, repeat: int = 5, cwd: Optional[str] = None) -> dict:
+    """
+    Wall time of 'statement' in fresh interpreters (cold 'sys.modules', warm
+    file-system cache) and the heavy dependencies it pulled in.
+
+    Parameters
+    ----------
+    statement : str
+        Python statement, e.g. 'import ofdft_normflows'.
+    repeat : int, optional
+        Number of fresh processes, by default 5
+    cwd : Optional[str], optional
+        Working directory (the drivers are imported from the repository root).
+
+    Returns
+    -------
+    dict
+        Median and minimum time in seconds and the imported heavy modules.
+    """
+    code = _SNIPPET.format(statement=statement, modules=HEAVY_MODULES)
+    times, modules = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError(f"'{statement}' failed:\n{out.stderr}")
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(r['time'])
+        modules = r['modules']
+    times = sorted(times)
+    return {'median': times[len(times)//2], 'min': times[0], 'modules': modules}
+
+
+def run_checks(checks: dict = DEFAULT_CHECKS, repeat: int = 5, cwd: Optional[str] = None,
+               max_time: Optional[float] = None) -> Sequence[str]:
+    """
+    Measures every statement and returns the regressions, forbidden dependencies
+    that were imported or (with 'max_time') a median time above the budget.
+    """
+    failures = []
+    for statement, forbidden in checks.items():
+        r = measure_import(statement, repeat, cwd)
+        print(f"{statement:45s} median {r['median']:.3f} s  min {r['min']:.3f} s  "
+              f"imports: {', '.join(r['modules']) or '-'}")
+        bad = [m for m in forbidden if m in r['modules']]
+        if bad:
+            failures.append(f"'{statement}' imports {', '.join(bad)}")
+        if max_time is not None and statement == 'import ofdft_normflows' and r['median'] > max_time:
+            failures.append(f"'{statement}' takes {r['median']:.3f} s > {max_time:.3f} s")
+    return failures
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Import time of the package and the drivers")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh processes per statement")
+    parser.add_argument("--max_time", type=float, default=None,
+                        help="budget in seconds for 'import ofdft_normflows'")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    failures = run_checks(DEFAULT_CHECKS, args.repeat, root, args.max_time)
+    for f in failures:
+        print(f'REGRESSION: {f}')
+    sys.exit(1 if failures else 0)
@@ -5,6 +5,10 @@ from jax import numpy as jnp
 from jax.experimental.ode import odeint
 from typing import Any, Callable
 
+# tolerances of the training and density solves (part of the density cache keys)
+ODE_ATOL = 1e-7
+ODE_RTOL = 1e-7
+
 
 def neural_ode(params: Any, batch: Any, f: Callable, t0: float, t1: float, d_dim: int) -> Any:
     """
@@ -40,8 +44,8 @@ def neural_ode(params: Any, batch: Any, f: Callable, t0: float, t1: float, d_dim
         _evol_fun,
         batch,
         start_and_end_time,
-        atol=1e-7,
-        rtol=1e-7
+        atol=ODE_ATOL,
+        rtol=ODE_RTOL
     )
     z_t, logp_diff_t = outputs[:, :,
                                :d_dim], outputs[:, :, d_dim:]
@@ -101,8 +105,8 @@ def neural_ode_score(params: Any, batch: Any, f: Callable, t0: float, t1: float,
         _evol_fun,
         batch,
         start_and_end_time,
-        atol=1e-7,
-        rtol=1e-7
+        atol=ODE_ATOL,
+        rtol=ODE_RTOL
     )
     z_t, logp_diff_t, score_t = outputs[:, :,
                                         :d_dim], outputs[:, :, d_dim:d_dim+1], outputs[:, :, d_dim+1:]
@@ -0,0 +1,382 @@
+from typing import Any, Optional
+from functools import partial
+
+import numpy as np
+import chex
+import jax
+import jax.numpy as jnp
+from jax import lax
+
+Array = jax.Array
+
+# J. Chem. Phys. 121, 11587-11598 (2004), Eq 25-27
+SMOOTH_EPS = 1E-2
+SMOOTH_C0 = 0.00435
+
+_SQRT_PI = np.sqrt(np.pi)
+_SQRT_2 = np.sqrt(2.)
+
+
+@chex.dataclass
+class Molecule:
+    """
+    Structure-of-arrays representation of a molecule, every per-atom quantity
+    is an array over the atoms so the potentials are one batched kernel.
+
+    'group_*' hold the far-field expansion of groups of atoms (None without groups),
+    the charge-weighted centre, total charge and traceless quadrupole of every
+    group and the indices of its atoms (padded with -1).
+    """
+    coords: chex.ArrayDevice
+    charge: chex.ArrayDevice
+    smooth_c: chex.ArrayDevice
+    zion: Optional[chex.ArrayDevice] = None
+    rloc: Optional[chex.ArrayDevice] = None
+    c_loc: Optional[chex.ArrayDevice] = None
+    group_center: Optional[chex.ArrayDevice] = None
+    group_charge: Optional[chex.ArrayDevice] = None
+    group_quad: Optional[chex.ArrayDevice] = None
+    group_atoms: Optional[chex.ArrayDevice] = None
+
+
+def _group_atoms(coords: np.ndarray, group_size: int) -> np.ndarray:
+    """Splits the atoms in spatially compact groups by recursive bisection along the longest axis."""
+    def _split(idx):
+        if len(idx) <= group_size:
+            return [idx]
+        extent = np.ptp(coords[idx], axis=0)
+        order = idx[np.argsort(coords[idx, np.argmax(extent)], kind='stable')]
+        half = len(order)//2
+        return _split(order[:half]) + _split(order[half:])
+
+    groups = _split(np.arange(coords.shape[0]))
+    atoms = -np.ones((len(groups), group_size), dtype=int)
+    for i, g in enumerate(groups):
+        atoms[i, :len(g)] = g
+    return atoms
+
+
+def _multipoles(coords: np.ndarray, q: np.ndarray, atoms: np.ndarray):
+    """Charge-weighted centre (no dipole), total charge and traceless quadrupole of every group."""
+    centers, charges, quads = [], [], []
+    for g in atoms:
+        g = g[g >= 0]
+        qg, rg = q[g], coords[g]
+        c = np.sum(qg[:, None]*rg, 0)/np.sum(qg)
+        d = rg - c
+        quad = np.einsum('i,ia,ib->ab', qg, d, d)
+        quad = 3.*quad - np.trace(quad)*np.eye(3)
+        centers.append(c)
+        charges.append(np.sum(qg))
+        quads.append(quad)
+    return np.stack(centers), np.array(charges), np.stack(quads)
+
+
+def compile_molecule(mol_info: Any, pp_table: Optional[dict] = None,
+                     group_size: Optional[int] = None) -> Molecule:
+    """
+    Precomputes the per-atom arrays of a molecule.
+
+    Parameters
+    ----------
+    mol_info : Any
+        Molecular information, {'coords': (Na, 3), 'z': (Na,)}.
+    pp_table : Optional[dict], optional
+        Local HGH parameters per atomic number, by default 'hgh_pseudopotentials.HGH_LOCAL'.
+        The 'hgh' kernel is only available if every element is tabulated.
+    group_size : Optional[int], optional
+        Atoms per group of the multipole far-field, by default None (no groups).
+
+    Returns
+    -------
+    Molecule
+    """
+    if isinstance(mol_info, Molecule):
+        return mol_info
+    if any(isinstance(mol_info[k], jax.core.Tracer) for k in ('coords', 'z')):
+        return _traced_molecule(mol_info, pp_table, group_size)
+    coords = np.asarray(mol_info['coords'], dtype=float).reshape(-1, 3)
+    z = np.asarray(mol_info['z']).ravel()
+    charge = z.astype(float)
+    smooth_c = (SMOOTH_C0*SMOOTH_EPS/charge**5)**1.3
+
+    if pp_table is None:
+        from ofdft_normflows.hgh_pseudopotentials import HGH_LOCAL as pp_table
+    zion = rloc = c_loc = None
+    if all(int(zi) in pp_table for zi in z):
+        pp = np.array([pp_table[int(zi)] for zi in z], dtype=float)
+        zion, rloc, c_loc = pp[:, 0], pp[:, 1], pp[:, 2:]
+
+    mol = Molecule(coords=jnp.asarray(coords), charge=jnp.asarray(charge),
+                   smooth_c=jnp.asarray(smooth_c),
+                   zion=None if zion is None else jnp.asarray(zion),
+                   rloc=None if rloc is None else jnp.asarray(rloc),
+                   c_loc=None if c_loc is None else jnp.asarray(c_loc))
+    if group_size is not None and group_size < coords.shape[0]:
+        atoms = _group_atoms(coords, group_size)
+        # the far-field of every kernel is the Coulomb tail of the (ionic) charge
+        q_far = charge if zion is None else zion
+        center, q, quad = _multipoles(coords, q_far, atoms)
+        mol = mol.replace(group_center=jnp.asarray(center), group_charge=jnp.asarray(q),
+                          group_quad=jnp.asarray(quad), group_atoms=jnp.asarray(atoms))
+    return mol
+
+
+def _traced_molecule(mol_info: Any, pp_table: Optional[dict] = None,
+                     group_size: Optional[int] = None) -> Molecule:
+    """
+    'compile_molecule' of a molecule passed as a 'jit' argument (traced coordinates or
+    charges), as 'functionals.Nuclei_potential' accepts. The HGH parameters are only looked
+    up for concrete charges and the far-field groups need concrete coordinates.
+    """
+    if group_size is not None:
+        raise ValueError("Far-field groups need a static molecule, compile it outside of 'jit'.")
+    coords = jnp.reshape(jnp.asarray(mol_info['coords'], dtype=float), (-1, 3))
+    charge = jnp.ravel(jnp.asarray(mol_info['z'], dtype=float))
+    smooth_c = (SMOOTH_C0*SMOOTH_EPS/charge**5)**1.3
+    mol = Molecule(coords=coords, charge=charge, smooth_c=smooth_c)
+    if not isinstance(mol_info['z'], jax.core.Tracer):
+        pp = compile_molecule({'coords': np.zeros((charge.shape[0], 3)), 'z': mol_info['z']}, pp_table)
+        mol = mol.replace(zion=pp.zion, rloc=pp.rloc, c_loc=pp.c_loc)
+    return mol
+
+
+# ------------------------------------------------------------------------------------------------------------
+# RADIAL KERNELS, v(r) and dv/dr of a single nucleus
+# ------------------------------------------------------------------------------------------------------------
+
+def _coulomb(r: Array, mol: Molecule, eps: float):
+    # same regularization as 'functionals.Nuclei_potential', -Z/(r + eps)
+    q = mol.charge
+    v = -q/(r + eps)
+    return v, q/(r + eps)**2
+
+
+def _smooth(r: Array, mol: Molecule, eps: float):
+    c = mol.smooth_c
+    s = r/c
+    s2 = s*s
+    small = s < 1E-4
+    s_safe = jnp.where(small, 1., s)
+    erf_s = lax.erf(s_safe)
+    g1, g4 = jnp.exp(-s2), jnp.exp(-4*s2)
+    u = jnp.where(small, 2./_SQRT_PI, erf_s/s_safe) + (g1 + 16*g4)/(3*_SQRT_PI)
+    du = jnp.where(small, 0., (2./_SQRT_PI)*jnp.exp(-s_safe**2)/s_safe - erf_s/s_safe**2) \
+        - (2*s*g1 + 128*s*g4)/(3*_SQRT_PI)
+    q = mol.charge
+    return -q*u/c, -q*du/(c*c)
+
+
+def _hgh(r: Array, mol: Molecule, eps: float):
+    # Phys. Rev. B 58, 3641, eq 1
+    zion, rloc = mol.zion, mol.rloc
+    c1, c2, c3, c4 = (mol.c_loc[..., i] for i in range(4))
+    s = r/rloc
+    s2 = s*s
+    small = s < 1E-4
+    s_safe = jnp.where(small, 1., s)
+    erf_s = lax.erf(s_safe/_SQRT_2)
+    # -zion erf(s/sqrt2)/r and its derivative, with the r -> 0 limits
+    v0 = jnp.where(small, -zion*_SQRT_2/(_SQRT_PI*rloc), -zion*erf_s/(s_safe*rloc))
+    dv0 = jnp.where(small, 0., zion*(erf_s/s_safe**2 - (_SQRT_2/_SQRT_PI)*jnp.exp(-0.5*s_safe**2)/s_safe)/(rloc*rloc))
+    g = jnp.exp(-0.5*s2)
+    p = c1 + c2*s2 + c3*s2**2 + c4*s2**3
+    dp = 2*c2*s + 4*c3*s*s2 + 6*c4*s*s2**2
+    return v0 + g*p, dv0 + g*(dp - s*p)/rloc
+
+
+_KERNELS = {'coulomb': _coulomb, 'smooth': _smooth, 'hgh': _hgh}
+
+
+def _take_atoms(mol: Molecule, idx: Array) -> Molecule:
+    """Per-atom arrays gathered at 'idx', leading dimensions broadcast against the samples."""
+    fields = {k: getattr(mol, k)[idx] for k in ('coords', 'charge', 'smooth_c', 'zion', 'rloc', 'c_loc')
+              if getattr(mol, k) is not None}
+    return Molecule(**fields)
+
+
+def _near_field(x: Array, mol: Molecule, kind: str, eps: float, idx: Optional[Array] = None,
+                mask: Optional[Array] = None):
+    """Exact potential and gradient of the atoms 'idx' (all atoms by default) at every sample."""
+    atoms = mol if idx is None else _take_atoms(mol, idx)
+    d = x[:, None, :] - atoms.coords
+    r = jnp.sqrt(jnp.sum(d*d, axis=-1))
+    v, dv = _KERNELS[kind](r, atoms, eps)
+    # dv/dr (x - R)/r, the direction is set to zero on top of a nucleus
+    r_safe = jnp.where(r > 0., r, 1.)
+    grad = jnp.where((r > 0.)[..., None], (dv/r_safe)[..., None]*d, 0.)
+    if mask is not None:
+        v, grad = v*mask, grad*mask[..., None]
+    return jnp.sum(v, axis=-1), jnp.sum(grad, axis=-2)
+
+
+def _far_field(x: Array, mol: Molecule, mask: Array):
+    """Monopole + quadrupole potential and gradient of the groups where 'mask' is True."""
+    d = x[:, None, :] - mol.group_center[None]
+    r2 = jnp.sum(d*d, axis=-1)
+    r2 = jnp.where(mask, r2, 1.)
+    inv_r = lax.rsqrt(r2)
+    inv_r2 = inv_r*inv_r
+    q = mol.group_charge[None]
+    qd = jnp.einsum('gab,ngb->nga', mol.group_quad, d)
+    dqd = jnp.sum(d*qd, axis=-1)
+    v = -(q*inv_r + 0.5*dqd*inv_r2**2*inv_r)
+    grad = q[..., None]*inv_r[..., None]**3*d \
+        - qd*(inv_r2**2*inv_r)[..., None] + 2.5*(dqd*inv_r2**3*inv_r)[..., None]*d
+    v, grad = v*mask, grad*mask[..., None]
+    return jnp.sum(v, axis=-1), jnp.sum(grad, axis=-2)
+
+
+def _potential_and_grad(x: Array, mol: Molecule, kind: str, eps: float, n_near: int):
+    if mol.group_center is None:
+        return _near_field(x, mol, kind, eps)
+    n_groups, group_size = mol.group_atoms.shape
+    n_near = min(n_near, n_groups)
+    # the 'n_near' closest groups (by centre) are evaluated exactly, the others with multipoles
+    d2 = jnp.sum((x[:, None, :] - mol.group_center[None])**2, axis=-1)
+    _, near = lax.top_k(-d2, n_near)
+    idx = mol.group_atoms[near].reshape(x.shape[0], n_near*group_size)
+    v_near, g_near = _near_field(x, mol, kind, eps, jnp.maximum(idx, 0), idx >= 0)
+    far = jnp.ones((x.shape[0], n_groups), bool).at[jnp.arange(x.shape[0])[:, None], near].set(False)
+    v_far, g_far = _far_field(x, mol, far)
+    return v_near + v_far, g_near + g_far
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(2, 3, 4))
+def _nuclear_potential(x: Array, mol: Molecule, kind: str, eps: float, n_near: int):
+    return _potential_and_grad(x, mol, kind, eps, n_near)[0]
+
+
+def _nuclear_potential_fwd(x, mol, kind, eps, n_near):
+    v, grad = _potential_and_grad(x, mol, kind, eps, n_near)
+    return v, (grad, mol)
+
+
+def _zero_cotangent(a):
+    if jnp.issubdtype(a.dtype, jnp.integer):
+        return np.zeros(a.shape, jax.dtypes.float0)
+    return jnp.zeros_like(a)
+
+
+def _nuclear_potential_bwd(kind, eps, n_near, res, g):
+    # the nuclei are fixed, only the samples get a cotangent
+    grad, mol = res
+    return g[:, None]*grad, jax.tree_util.tree_map(_zero_cotangent, mol)
+
+
+_nuclear_potential.defvjp(_nuclear_potential_fwd, _nuclear_potential_bwd)
+
+
+def nuclear_potential(x: Array, Ne: int, mol: Any, kind: str = 'coulomb',
+                      eps: float = 1E-4, n_near: int = 2) -> jax.Array:
+    r"""
+    Electron-nuclei potential at every sample,
+
+    v(x) = \sum_{A} v_A(|x - R_A|),
+
+    evaluated for all atoms with one batched distance kernel, the gradient with
+    respect to the samples is analytic ('jax.custom_vjp').
+
+    For a molecule compiled with groups ('compile_molecule(..., group_size)'),
+    only the atoms of the 'n_near' closest groups are evaluated exactly, the
+    other groups contribute through the monopole and quadrupole of their
+    Coulomb tail, which is exact for 'smooth' and 'hgh' far from the nuclei.
+
+    Parameters
+    ----------
+    x : Array
+        Samples, (N, 3).
+    Ne : int
+        Number of electrons.
+    mol : Any
+        'Molecule' or molecular information ({'coords', 'z'}), compiled on the fly.
+    kind : str, optional
+        'coulomb', 'smooth' (J. Chem. Phys. 121, 11587) or 'hgh' (local part), by default 'coulomb'
+    eps : float, optional
+        Regularization of the Coulomb kernel, by default 1E-4
+    n_near : int, optional
+        Groups evaluated exactly per sample, by default 2
+
+    Returns
+    -------
+    jax.Array
+        Electron-nuclei interaction potential, (N, 1).
+    """
+    mol = compile_molecule(mol)
+    if kind == 'hgh' and mol.rloc is None:
+        raise ValueError("no HGH parameters for some of the elements of the molecule (or traced charges)")
+    v = _nuclear_potential(x, mol, kind, eps, n_near)
+    return Ne*v[:, None]
+
+
+def nuclei_coulomb(x: Array, Ne: int, mol: Any, eps: float = 1E-4) -> jax.Array:
+    """Vectorized 'functionals.Nuclei_potential'."""
+    return nuclear_potential(x, Ne, mol, 'coulomb', eps)
+
+
+def nuclei_smooth(x: Array, Ne: int, mol: Any) -> jax.Array:
+    """
+    Vectorized 'functionals.Nuclei_potential_smooth', without the unused 'params'
+    argument and scaled by the nuclear charge, Z u(r/c)/c (the same for hydrogen).
+    """
+    return nuclear_potential(x, Ne, mol, 'smooth')
+
+
+def nuclei_hgh(x: Array, Ne: int, mol: Any) -> jax.Array:
+    """Local HGH pseudopotential with per-element parameters ('hgh_pseudopotentials.HGH_LOCAL')."""
+    return nuclear_potential(x, Ne, mol, 'hgh')
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    from ofdft_normflows.functionals import Nuclei_potential, Nuclei_potential_smooth
+    from ofdft_normflows.promolecular_distrax import ProMolecularDensity
+    from ofdft_normflows.utils import coordinates
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Batched nuclear potentials")
+    parser.add_argument("--mol_name", type=str, default='C6H6', help="molecule name")
+    parser.add_argument("--n", type=int, default=16384, help="number of samples")
+    parser.add_argument("--group_size", type=int, default=4, help="atoms per far-field group")
+    parser.add_argument("--n_near", type=int, default=2, help="groups evaluated exactly")
+    args = parser.parse_args()
+
+    Ne, atoms, z, coords = coordinates(args.mol_name)
+    mol_info = {'coords': coords, 'z': z}
+    prior_dist = ProMolecularDensity(z.ravel(), coords)
+    x = prior_dist.sample(seed=jax.random.PRNGKey(0), sample_shape=args.n)
+
+    def _timed(f):
+        jax.block_until_ready(f(x))
+        start = time.time()
+        y = jax.block_until_ready(f(x))
+        return y, time.time() - start
+
+    def _energy(f): return jax.jit(jax.value_and_grad(lambda x: jnp.mean(f(x))))
+
+    (e0, g0), t0 = _timed(_energy(lambda x: Nuclei_potential(x, Ne, mol_info)))
+    mol = compile_molecule(mol_info)
+    (e1, g1), t1 = _timed(_energy(lambda x: nuclei_coulomb(x, Ne, mol)))
+    print(f'coulomb  vmap: {t0:.4f} s  soa: {t1:.4f} s  '
+          f'dE: {abs(e1 - e0)/abs(e0):.2e}  dgrad: {jnp.linalg.norm(g1 - g0)/jnp.linalg.norm(g0):.2e}')
+
+    z_atoms = np.asarray(z).ravel()
+
+    def _smooth_reference(x):
+        # 'Nuclei_potential_smooth' of every atom scaled by its charge, as 'nuclei_smooth'
+        return sum(z_a*Nuclei_potential_smooth(None, x, Ne, {'coords': coords[a:a + 1], 'z': z[a:a + 1]})
+                   for a, z_a in enumerate(z_atoms))
+
+    (e0, g0), t0 = _timed(_energy(_smooth_reference))
+    (e1, g1), t1 = _timed(_energy(lambda x: nuclei_smooth(x, Ne, mol)))
+    print(f'smooth   vmap: {t0:.4f} s  soa: {t1:.4f} s  '
+          f'dE: {abs(e1 - e0)/abs(e0):.2e}  dgrad: {jnp.linalg.norm(g1 - g0)/jnp.linalg.norm(g0):.2e}')
+
+    mol_g = compile_molecule(mol_info, group_size=args.group_size)
+    for kind in ('coulomb', 'smooth') if mol_g.group_atoms is not None else ():
+        (e1, g1), t1 = _timed(_energy(lambda x: nuclear_potential(x, Ne, mol, kind)))
+        (e2, g2), t2 = _timed(_energy(lambda x: nuclear_potential(x, Ne, mol_g, kind, n_near=args.n_near)))
+        print(f'{kind} far-field ({mol_g.group_atoms.shape[0]} groups, {args.n_near} exact): {t2:.4f} s  '
+              f'exact: {t1:.4f} s  dE: {abs(e2 - e1)/abs(e1):.2e}  dgrad: {jnp.linalg.norm(g2 - g1)/jnp.linalg.norm(g1):.2e}')
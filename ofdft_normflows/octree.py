@@ -0,0 +1,275 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Sequence
+
+import numpy as onp
+import jax
+import jax.numpy as jnp
+
+from ofdft_normflows.bucketing import BucketedFunction, BUCKETS
+
+Array = jax.Array
+
+# corners of a cell in units of its size, (8, 3), x slowest
+CORNERS = onp.stack(onp.meshgrid(*[onp.arange(2)]*3, indexing='ij'), -1).reshape(-1, 3)
+
+
+class _PointStore:
+    """
+    Density values on the points of the finest lattice of an octree, keyed by their
+    linear lattice index; points shared by neighbouring cells (and by the parents
+    and their children) are evaluated once.
+    """
+
+    def __init__(self, f: Callable, origin: onp.ndarray, h: onp.ndarray, m: onp.ndarray):
+        self.f = f
+        self.origin, self.h, self.m = origin, h, m
+        self.keys = onp.zeros(0, dtype=onp.int64)
+        self.values = onp.zeros(0)
+
+    def key(self, idx: onp.ndarray) -> onp.ndarray:
+        idx = idx.astype(onp.int64)
+        return (idx[..., 0]*self.m[1] + idx[..., 1])*self.m[2] + idx[..., 2]
+
+    def point(self, keys: onp.ndarray) -> onp.ndarray:
+        ij, k = onp.divmod(keys, self.m[2])
+        i, j = onp.divmod(ij, self.m[1])
+        return onp.stack((i, j, k), -1)*self.h + self.origin
+
+    def lookup(self, keys: onp.ndarray) -> onp.ndarray:
+        return self.values[onp.searchsorted(self.keys, keys)]
+
+    def __call__(self, idx: onp.ndarray) -> onp.ndarray:
+        """Values at the lattice indices 'idx' (..., 3), evaluating the new points in one batch."""
+        keys = self.key(idx)
+        new = onp.setdiff1d(onp.unique(keys), self.keys, assume_unique=True)
+        if new.shape[0] > 0:
+            rho = onp.asarray(self.f(jnp.asarray(self.point(new)))).reshape(new.shape[0])
+            keys_all = onp.concatenate((self.keys, new))
+            order = onp.argsort(keys_all, kind='stable')
+            self.keys = keys_all[order]
+            self.values = onp.concatenate((self.values, rho))[order]
+        return self.lookup(keys)
+
+
+@dataclass
+class Octree:
+    """
+    Adaptive octree of a density over a box, built by 'build_octree'.
+
+    The cell corners live on the finest lattice, 'origin + idx*h' with idx in
+    [0, n0*2^max_level]; 'leaves[l]' are the lattice indices of the lower corners
+    of the leaf cells of level l (size 2^(max_level - l) lattice steps), and 'keys'
+    and 'values' the evaluated lattice points (sorted linear indices) and densities.
+    """
+    origin: onp.ndarray
+    h: onp.ndarray
+    n0: onp.ndarray
+    max_level: int
+    keys: onp.ndarray
+    values: onp.ndarray
+    leaves: list = field(default_factory=list)
+
+    @property
+    def m(self) -> onp.ndarray:
+        return self.n0*2**self.max_level + 1
+
+    def _store(self) -> _PointStore:
+        store = _PointStore(None, self.origin, self.h, self.m)
+        store.keys, store.values = self.keys, self.values
+        return store
+
+    @property
+    def n_evaluations(self) -> int:
+        return int(self.keys.shape[0])
+
+    @property
+    def n_leaves(self) -> int:
+        return int(sum(c.shape[0] for c in self.leaves))
+
+    def points(self) -> onp.ndarray:
+        """Evaluated points, (n_evaluations, 3)."""
+        return self._store().point(self.keys)
+
+    def integral(self) -> float:
+        """
+        Integral over the leaves, the volume times (mean of the corners + 2 centre)/3
+        (exact for quadratics) in the cells whose centre was evaluated (all but the
+        finest), the mean of the corners (trilinear interpolant) in the others.
+        """
+        store = self._store()
+        total = 0.
+        for level, cells in enumerate(self.leaves):
+            s = 2**(self.max_level - level)
+            if cells.shape[0] > 0:
+                rc = onp.mean(store.lookup(store.key(cells[:, None] + s*CORNERS[None])), 1)
+                if s > 1:
+                    rc = (rc + 2.*store.lookup(store.key(cells + s//2)))/3.
+                total += onp.prod(self.h*s)*onp.sum(rc)
+        return float(total)
+
+    def interpolate(self, x: Any) -> onp.ndarray:
+        """Trilinear interpolation in the leaf cells at the points 'x', (N, 3); points outside the box are clipped."""
+        store = self._store()
+        u = (onp.asarray(x, dtype=float).reshape(-1, 3) - self.origin)/self.h
+        u = onp.clip(u, 0., self.m - 1.)
+        out = onp.full(u.shape[0], onp.nan)
+        todo = onp.arange(u.shape[0])
+        for level in range(self.max_level, -1, -1):
+            cells = self.leaves[level]
+            if cells.shape[0] == 0 or todo.shape[0] == 0:
+                continue
+            s = 2**(self.max_level - level)
+            leaf_keys = onp.sort(store.key(cells))
+            c = onp.minimum(onp.floor(u[todo]/s)*s, self.m - 1 - s).astype(onp.int64)
+            k = store.key(c)
+            pos = onp.minimum(onp.searchsorted(leaf_keys, k), leaf_keys.shape[0] - 1)
+            found = leaf_keys[pos] == k
+            idx, c = todo[found], c[found]
+            t = (u[idx] - c)/s
+            rc = store.lookup(store.key(c[:, None] + s*CORNERS[None]))
+            wc = onp.prod(onp.where(CORNERS[None] == 1, t[:, None], 1. - t[:, None]), -1)
+            out[idx] = onp.sum(wc*rc, 1)
+            todo = todo[~found]
+        return out
+
+    def to_grid(self, grid: Any) -> onp.ndarray:
+        """Resampled density on a uniform grid ('volumetric.VolumeGrid'), (nx, ny, nz)."""
+        return self.interpolate(grid.coords()).reshape(grid.shape)
+
+    def save(self, fname: str):
+        onp.savez_compressed(fname, origin=self.origin, h=self.h, n0=self.n0, max_level=self.max_level,
+                             keys=self.keys, values=self.values,
+                             **{f'leaves_{l}': c for l, c in enumerate(self.leaves)})
+
+    @classmethod
+    def load(cls, fname: str) -> 'Octree':
+        d = onp.load(fname)
+        max_level = int(d['max_level'])
+        return cls(origin=d['origin'], h=d['h'], n0=d['n0'], max_level=max_level,
+                   keys=d['keys'], values=d['values'],
+                   leaves=[d[f'leaves_{l}'] for l in range(max_level + 1)])
+
+
+def build_octree(f: Callable, origin: Any, extent: Any, n0: Any = 8, max_level: int = 4,
+                 atol: float = 3E-4, gtol: Optional[float] = None, nuclei: Optional[Any] = None,
+                 buckets: Sequence[int] = BUCKETS) -> Octree:
+    """
+    Adaptive octree of the density 'f' over the box [origin, origin + extent].
+
+    Starting from n0 cells per axis, a cell is split in eight while
+    - the density at its centre differs by more than 'atol' from the trilinear
+      interpolation of its corners (the mean of the corners), or
+    - with 'gtol', the spread of the corner values (~ |grad rho| times the cell
+      size) is larger than 'gtol', or
+    - it holds a nucleus or touches a cell that does (cusps are refined to 'max_level').
+    Only the new corners and centres of every level are evaluated (one batch per
+    level, in the bucket sizes of 'BucketedFunction').
+
+    Parameters
+    ----------
+    f : Callable
+        Density, 'f(x)' -> (N,) or (N, 1), e.g. the reverse CNF.
+    origin, extent : Any
+        Lower corner and size of the box, (3,) Bohr.
+    n0 : Any, optional
+        Cells per axis of level 0, int (along the longest side, the others scaled to
+        keep the cells close to cubes) or (3,), by default 8
+    max_level : int, optional
+        Refinement levels, the finest spacing is extent/(n0 2^max_level), by default 4
+    atol : float, optional
+        Interpolation error at the cell centres, by default 3E-4
+    gtol : Optional[float], optional
+        Corner spread, by default None (not used)
+    nuclei : Optional[Any], optional
+        Nuclear coordinates (Na, 3), by default None
+
+    Returns
+    -------
+    Octree
+    """
+    origin = onp.asarray(origin, dtype=float).ravel()
+    extent = onp.asarray(extent, dtype=float).ravel()
+    if onp.ndim(n0) == 0:
+        n0 = onp.maximum(1, onp.round(n0*extent/extent.max())).astype(int)
+    n0 = onp.asarray(n0, dtype=int)
+    s0 = 2**max_level
+    h = extent/(n0*s0)
+    f = f if isinstance(f, BucketedFunction) else BucketedFunction(f, buckets)
+    store = _PointStore(f, origin, h, n0*s0 + 1)
+    u_nuc = None if nuclei is None else (onp.asarray(nuclei, dtype=float).reshape(-1, 3) - origin)/h
+
+    cells = onp.stack(onp.meshgrid(*[onp.arange(n)*s0 for n in n0], indexing='ij'), -1).reshape(-1, 3)
+    leaves = []
+    for level in range(max_level + 1):
+        s = s0 >> level
+        rc = store(cells[:, None] + s*CORNERS[None])
+        if level == max_level:
+            leaves.append(cells)
+            break
+        rcen = store(cells + s//2)
+        refine = onp.abs(rcen - onp.mean(rc, 1)) > atol
+        if gtol is not None:
+            refine |= (onp.max(rc, 1) - onp.min(rc, 1)) > gtol
+        if u_nuc is not None:
+            near = (u_nuc[None] >= cells[:, None] - s) & (u_nuc[None] <= cells[:, None] + 2*s)
+            refine |= onp.any(onp.all(near, -1), -1)
+        leaves.append(cells[~refine])
+        cells = (cells[refine][:, None] + (s//2)*CORNERS[None]).reshape(-1, 3)
+
+    return Octree(origin=origin, h=h, n0=n0, max_level=max_level,
+                  keys=store.keys, values=store.values, leaves=leaves)
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    from scipy.interpolate import RegularGridInterpolator
+    from ofdft_normflows.promolecular_distrax import ProMolecularDensity
+    from ofdft_normflows.utils import coordinates
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Adaptive octree vs uniform cube (promolecular density)")
+    parser.add_argument("--mol_name", type=str, default='H2O', help="molecule name")
+    parser.add_argument("--n", type=int, default=80, help="points per axis of the uniform cube")
+    parser.add_argument("--n0", type=int, default=8, help="level-0 cells along the longest side")
+    parser.add_argument("--max_level", type=int, default=4, help="refinement levels")
+    parser.add_argument("--atol", type=float, default=3E-4, help="interpolation error at the cell centres")
+    parser.add_argument("--margin", type=float, default=5., help="box margin (Bohr)")
+    args = parser.parse_args()
+
+    Ne, atoms, z, coords = coordinates(args.mol_name)
+    coords = onp.asarray(coords, dtype=float).reshape(-1, 3)
+    prior_dist = ProMolecularDensity(jnp.asarray(z).ravel(), jnp.asarray(coords))
+    f_rho = jax.jit(lambda x: Ne*jnp.exp(prior_dist.log_prob(x)).reshape(-1))
+
+    origin = coords.min(0) - args.margin
+    extent = coords.max(0) - coords.min(0) + 2*args.margin
+
+    start = time.time()
+    tree = build_octree(f_rho, origin, extent, args.n0, args.max_level, args.atol, nuclei=coords)
+    t_tree = time.time() - start
+
+    axes = [onp.linspace(o, o + e, args.n) for o, e in zip(origin, extent)]
+    xu = onp.stack(onp.meshgrid(*axes, indexing='ij'), -1).reshape(-1, 3)
+    rho_u = onp.asarray(BucketedFunction(f_rho)(jnp.asarray(xu))).reshape((args.n,)*3)
+    uniform = RegularGridInterpolator(axes, rho_u)
+    dv = onp.prod(extent/(args.n - 1))
+
+    # accuracy near the nuclei, random points within 1 Bohr of every nucleus
+    rng = onp.random.default_rng(0)
+    d = rng.normal(size=(4096, coords.shape[0], 3))
+    d *= (rng.uniform(size=(4096, coords.shape[0], 1))**(1/3))/onp.linalg.norm(d, axis=-1, keepdims=True)
+    xt = (coords[None] + d).reshape(-1, 3)
+    rho_t = onp.asarray(f_rho(jnp.asarray(xt)))
+
+    def report(name, n_eval, rho_x, integral):
+        err = onp.abs(rho_x - rho_t)
+        print(f'{name:8s} {n_eval:9d} evaluations  near nuclei: median |err| {onp.median(err):.2e}, '
+              f'max |err| {err.max():.2e}, rel L2 {onp.linalg.norm(rho_x - rho_t)/onp.linalg.norm(rho_t):.2e}  '
+              f'N = {integral:.5f} (exact {Ne})')
+
+    report('uniform', xu.shape[0], uniform(xt), rho_u.sum()*dv)
+    report('octree', tree.n_evaluations, tree.interpolate(xt), tree.integral())
+    print(f'octree: {tree.n_leaves} leaves, leaves per level {[c.shape[0] for c in tree.leaves]}, '
+          f'finest spacing {tree.h.max():.3f} Bohr (uniform {extent.max()/(args.n - 1):.3f}), {t_tree:.2f} s')
@@ -0,0 +1,286 @@
+import os
+from typing import Any, Callable, Optional, Sequence
+
+import numpy as onp
+import pandas as pd
+import jax
+import jax.numpy as jnp
+import jax.random as jrnd
+from jax import lax
+
+from ofdft_normflows.jax_ode import neural_ode, neural_ode_score
+from ofdft_normflows.ensemble import stack_trees, broadcast_members
+from ofdft_normflows.checkpoint_analysis import (checkpoint_steps, select_steps, load_job, flow_model,
+                                                 restore_checkpoints, checkpoint_densities, density_tag,
+                                                 CachedDensities)
+from ofdft_normflows.density_error import ERROR_COLUMNS, reference_density, density_errors
+
+Array = jax.Array
+
+# name -> (columns, f(ctx, params) -> {column: (n_epochs,) values}), see 'metric'
+METRICS = {}
+
+
+def metric(name: str, columns: Sequence[str]) -> Callable:
+    """Registers an offline metric, 'f(ctx, params)' of a 'RunContext' and a list of parameter trees."""
+    def _register(f):
+        METRICS[name] = (tuple(columns), f)
+        return f
+    return _register
+
+
+class RunContext:
+    """
+    Everything the metrics of one run share, built lazily: the job parameters, the flow,
+    the DFT references (training grid and screened Becke grid) and the common samples of the energy estimates;
+    'cache' holds values shared by several metrics of the same batch of checkpoints.
+    'member' selects a member of an ensemble run (its functional weights).
+    """
+
+    def __init__(self, rwd: str, n_samples: int = 4096, seed: int = 0, member: Optional[int] = None):
+        self.rwd = rwd
+        self.member = member
+        self.job = load_job(rwd)
+        self.flow = flow_model(self.job)
+        self.mol = self.flow['mol']
+        self.n_samples = n_samples
+        self.seed = seed
+        self.cache = {}
+        self._dft = None
+        self._reference = None
+        self._samples = None
+        self._energy_function = None
+
+    @property
+    def weights(self) -> tuple:
+        """Functional weights (kin, vnuc, hart, x, c) of the loss of the run, 'ens_weights' of the member."""
+        if self.member is None or self.job.get('ens_weights') is None:
+            return (1., 1., 1., 1., 1.)
+        job = self.job
+        n_members = max(len(job['ens_seeds']), len(job['ens_lrs']), len(job['ens_weights']))
+        return tuple(broadcast_members(job['ens_weights'], n_members)[self.member])
+
+    def rho(self, params, x):
+        """Ne rho_NF at the points 'x', (N,)."""
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = neural_ode(params, zt, self.flow['model_rev'], -1., 0., 3)
+        return self.flow['Ne']*jnp.exp(self.flow['prior_dist'].log_prob(z0) - logp_z0).reshape(-1)
+
+    @property
+    def dft(self) -> dict:
+        """DFT reference of the training ('DFTDistribution'), its grid, weights and density."""
+        if self._dft is None:
+            from ofdft_normflows.dft_distrax import DFTDistribution
+            m = DFTDistribution(self.mol['atoms'], self.mol['coords'])
+            self._dft = {'m': m, 'coords': jnp.asarray(m.coords), 'weights': onp.asarray(m.weights).ravel(),
+                         'rho': onp.asarray(m.prob(m, m.coords)).ravel()}
+        return self._dft
+
+    @property
+    def reference(self) -> dict:
+        """DFT density on the screened Becke grid of the density errors ('density_error.reference_density')."""
+        if self._reference is None:
+            self._reference = reference_density(self.mol)
+        return self._reference
+
+    @property
+    def samples(self) -> Array:
+        """Prior samples of the energy estimates, the same for every checkpoint (common random numbers)."""
+        if self._samples is None:
+            from ofdft_normflows.utils import batch_generator
+            self._samples = next(batch_generator(jrnd.PRNGKey(self.seed), self.n_samples, self.flow['prior_dist']))
+        return self._samples
+
+    def rho_dft_grid(self, params: list) -> onp.ndarray:
+        """Ne rho_NF of every checkpoint of the batch on the DFT grid, (N, n_epochs), shared by the metrics."""
+        if 'rho_dft_grid' not in self.cache:
+            self.cache['rho_dft_grid'] = onp.asarray(
+                checkpoint_densities(self.rho, params, self.dft['coords'], density_tag(self.mol)))
+        return self.cache['rho_dft_grid']
+
+
+@metric('norm', ('I',))
+def _norm(ctx: RunContext, params: list) -> dict:
+    """Normalization integral on the DFT grid, the 'I' of the training trajectory."""
+    return {'I': ctx.dft['weights'] @ ctx.rho_dft_grid(params)}
+
+
+@metric('dft_error', ERROR_COLUMNS)
+def _dft_error(ctx: RunContext, params: list) -> dict:
+    """Errors of the density with respect to the DFT reference, 'density_error.density_errors'."""
+    if ctx.flow['bool_hgh']:
+        raise ValueError(f"{ctx.rwd} is an HGH run (valence density), it is not comparable to the all-electron reference.")
+    return density_errors(CachedDensities(ctx.rho, params, density_tag(ctx.mol)), ctx.reference)
+
+
+def energy_function(ctx: RunContext) -> Callable:
+    """
+    Energy terms of one parameter set on the samples, the estimator of 'OFDFT_NF.training'
+    with the functionals of the job, the Hartree term with its 'hartree_est' (pairs
+    (x_i, x_{i+B}) by default, or 'ustat', 'tree' and 'grid' over all the samples).
+    'E' is the loss of the run, weighted with the 'ens_weights' of an ensemble member
+    (as 'E' of its training trajectory), the terms are not weighted.
+    """
+    from ofdft_normflows.functionals import _kinetic, _nuclear, _hartree, _exchange_correlation
+
+    job, Ne, model_fwd = ctx.job, ctx.flow['Ne'], ctx.flow['model_fwd']
+    mol = {'coords': ctx.mol['coords'], 'z': ctx.mol['z']}
+    B = ctx.n_samples
+    w = ctx.weights
+    hartree_est = job.get('hartree_est', 'pair')
+    if job.get('spec') is not None:
+        from ofdft_normflows.composite_functionals import composite_functional, group_energies
+        e_functional = composite_functional(job['spec'], Ne, mol)
+    else:
+        t_functional = _kinetic(job['kin'])
+        v_functional = _nuclear(job['v_nuc'])
+        vh_functional = _hartree(job['h_pot'])
+        x_functional = _exchange_correlation(job['x_pot'])
+        c_functional = _exchange_correlation(job['c_pot'])
+    if ctx.flow['bool_hgh']:
+        from ofdft_normflows.hgh_pseudopotentials import compile_projectors, hgh_nonlocal
+        hgh_projectors = compile_projectors(mol)
+
+    def energy(params, samples):
+        zt, logp_zt, score_all = neural_ode_score(params, samples, model_fwd, 0., 1., 3)
+        den_all = jnp.exp(logp_zt)
+        den, denp = den_all[:B], den_all[B:]
+        x, xp = zt[:B], zt[B:]
+        score = score_all[:B]
+        if job.get('spec') is not None:
+            e, terms = e_functional(den, score, x, xp)
+            groups = group_energies(terms)
+            return e, {'T': groups['kin'], 'V': groups['vnuc'], 'H': groups['hart'], 'XC': groups['xc']}
+        e_t = t_functional(den, score, Ne)
+        e_v = v_functional(x, Ne, mol)
+        if ctx.flow['bool_hgh']:
+            e_v = e_v + hgh_nonlocal(x, xp, den, denp, Ne, hgh_projectors)
+        if hartree_est == 'ustat':
+            from ofdft_normflows.hartree_estimators import hartree_ustat
+            e_h = hartree_ustat(zt, Ne, vh_functional, job.get('hartree_tile', 256))
+        elif hartree_est == 'tree':
+            from ofdft_normflows.tree_code import hartree_tree
+            e_h = hartree_tree(zt, Ne, job.get('theta', 0.5))
+        elif hartree_est == 'grid':
+            from ofdft_normflows.poisson import hartree_grid
+            e_h = hartree_grid(zt, Ne, job['h_pot'], job.get('n_grid', 64), job.get('poisson', 'hockney'))
+        else:
+            e_h = vh_functional(x, xp, Ne)
+        e_x = x_functional(den, score, Ne)
+        e_c = c_functional(den, Ne)
+        e = w[0]*e_t + w[1]*e_v + w[2]*e_h + w[3]*e_x + w[4]*e_c
+        return e, {'T': e_t, 'V': e_v, 'H': e_h, 'XC': e_x + e_c}
+
+    def summary(params, samples):
+        e, terms = energy(params, samples)
+        out = {k: jnp.mean(v) for k, v in terms.items()}
+        out['E'] = jnp.mean(e)
+        out['E_se'] = jnp.std(e)/jnp.sqrt(e.shape[0])
+        return out
+
+    # one compiled function for all the checkpoints of a batch
+    return jax.jit(jax.vmap(summary, in_axes=(0, None)))
+
+
+@metric('energy', ('E_offline', 'E_offline_se', 'T_offline', 'V_offline', 'H_offline', 'XC_offline'))
+def _energy(ctx: RunContext, params: list) -> dict:
+    """
+    Energy and its terms on 'n_samples' samples (the same for every checkpoint) and the standard error of E,
+    '_offline' columns next to the training estimates ('E', 'T', ...) of the trajectory.
+    """
+    if ctx._energy_function is None:
+        ctx._energy_function = energy_function(ctx)
+    out = ctx._energy_function(stack_trees(params), ctx.samples)
+    return {('E_offline_se' if k == 'E_se' else f'{k}_offline'): onp.asarray(out[k])
+            for k in ('E', 'E_se', 'T', 'V', 'H', 'XC')}
+
+
+def metrics_store(rwd: str, mol_name: str, member: Optional[int] = None) -> str:
+    """Training trajectory CSV of a run that the offline metrics are merged in, the '_ensemble' one for a member."""
+    if member is None:
+        return os.path.join(rwd, f'training_trajectory_{mol_name}.csv')
+    return os.path.join(rwd, f'training_trajectory_{mol_name}_ensemble.csv')
+
+
+def update_store(fname: str, df: pd.DataFrame, keys: Sequence[str] = ('epoch',)) -> pd.DataFrame:
+    """Merges 'df' into the CSV 'fname' by 'keys' (epoch), new values replace the stored ones, other columns are kept."""
+    keys = list(keys)
+    if os.path.exists(fname):
+        old = pd.read_csv(fname).set_index(keys)
+        new = df.set_index(keys)
+        df = new.combine_first(old)
+        df = df[list(dict.fromkeys(list(old.columns) + list(new.columns)))].reset_index()
+    df = df.sort_values(keys).reset_index(drop=True)
+    df.to_csv(fname, index=False)
+    return df
+
+
+def evaluate_run(rwd: str, metrics: Sequence[str] = ('norm', 'energy', 'dft_error'), steps: str = 'log:20',
+                 member: Optional[int] = None, n_samples: int = 4096, seed: int = 0,
+                 epochs_per_batch: int = 8, n_threads: Optional[int] = None,
+                 bool_store: bool = True) -> pd.DataFrame:
+    """
+    Recomputes 'metrics' (see METRICS) for the checkpoints of a run selected by 'steps'
+    ('checkpoint_analysis.select_steps', e.g. 'log:20', 'stride:10' or '0,100,1000').
+
+    The checkpoints are restored in parallel threads and evaluated 'epochs_per_batch'
+    at a time, every metric with one compiled function for the whole batch. With
+    'bool_store' the columns are merged by epoch in the training trajectory,
+    '{rwd}/training_trajectory_{mol}.csv', or by epoch and member in
+    '{rwd}/training_trajectory_{mol}_ensemble.csv' for a member of an ensemble run ('metrics_store').
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per selected epoch, 'epoch' and the metric columns.
+    """
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics {unknown}, available: {sorted(METRICS)}.")
+    run_dir = rwd if member is None else os.path.join(rwd, f'member_{member}')
+    ckpt_dir = os.path.join(run_dir, 'checkpoints_all')
+    selected = select_steps(checkpoint_steps(ckpt_dir), steps)
+
+    ctx = RunContext(rwd, n_samples, seed, member)
+    rows = []
+    for start in range(0, len(selected), epochs_per_batch):
+        batch = selected[start:start + epochs_per_batch]
+        params = restore_checkpoints(ckpt_dir, batch, ctx.flow['params'], n_threads)
+        ctx.cache = {}
+        values = {'epoch': onp.array(batch)}
+        for name in metrics:
+            values.update(METRICS[name][1](ctx, params))
+        rows.append(pd.DataFrame({k: onp.asarray(v).ravel() for k, v in values.items()}))
+    df = pd.concat(rows, ignore_index=True)
+    if bool_store:
+        fname = metrics_store(rwd, ctx.mol['mol_name'], member)
+        if member is None:
+            update_store(fname, df)
+        else:
+            update_store(fname, df.assign(member=member), ('epoch', 'member'))
+    return df
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Metrics of saved checkpoints, computed after training")
+    parser.add_argument("--rwd", type=str, nargs='+', required=True, help="results directories")
+    parser.add_argument("--metrics", type=str, default='norm,energy,dft_error',
+                        help=f"comma separated metrics, {', '.join(sorted(METRICS))}")
+    parser.add_argument("--steps", type=str, default='log:20', help="'all', 'stride:k', 'log:n' or '0,1,11,...'")
+    parser.add_argument("--member", type=int, default=None, help="member of an ensemble run")
+    parser.add_argument("--n_samples", type=int, default=4096, help="samples of the energy estimates")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the energy samples")
+    parser.add_argument("--epochs_per_batch", type=int, default=8, help="checkpoints evaluated at once")
+    args = parser.parse_args()
+
+    for rwd in args.rwd:
+        start = time.time()
+        df = evaluate_run(rwd, args.metrics.split(','), args.steps, args.member, args.n_samples,
+                          args.seed, args.epochs_per_batch)
+        print(f'{rwd}: {len(df)} checkpoints, {time.time() - start:.1f} s')
+        print(df.to_string(index=False))
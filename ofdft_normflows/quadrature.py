@@ -0,0 +1,273 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import numpy as onp
+import jax
+import jax.numpy as jnp
+
+from ofdft_normflows.hartree_estimators import hartree_ustat
+
+Array = jax.Array
+
+RULES_1D = ('trapz', 'gauss')
+
+# the local functionals get max(rho, DEN_FLOOR), the far tails of a grid underflow
+# (e.g. rs = 1/(2 Ne rho) of 'xc_1d') where samples never go; their weight p_i is ~0
+DEN_FLOOR = 1E-12
+
+
+@dataclass
+class Quadrature:
+    r"""
+    Points 'x' (n, d) and weights 'w' (n,) of \int f(x) dx. The 1D rules also
+    differentiate functions given on their nodes, the uniform spacing 'h' (central
+    differences) for 'trapz' and the spectral differentiation matrix 'D' for 'gauss'.
+    """
+    x: onp.ndarray
+    w: onp.ndarray
+    rule: str
+    h: Optional[float] = None
+    D: Optional[onp.ndarray] = None
+
+    @property
+    def n(self) -> int:
+        return self.x.shape[0]
+
+    def derivative(self, f: Array) -> Array:
+        """df/dx on the nodes of a 1D rule, (n,)."""
+        if self.rule == 'trapz':
+            return jnp.gradient(f, self.h)
+        if self.D is not None:
+            return jnp.asarray(self.D) @ f
+        raise ValueError(f"No derivative for the '{self.rule}' rule.")
+
+
+def trapezoid(n: int, a: float, b: float) -> Quadrature:
+    """Trapezoid rule on 'n' uniform points of [a, b]."""
+    x = onp.linspace(a, b, n)
+    h = (b - a)/(n - 1)
+    w = onp.full(n, h)
+    w[[0, -1]] = 0.5*h
+    return Quadrature(x[:, None], w, 'trapz', h=h)
+
+
+def gauss_legendre(n: int, a: float, b: float) -> Quadrature:
+    """
+    Gauss-Legendre rule with 'n' nodes in [a, b] and the differentiation matrix of the
+    interpolating polynomial, D_ij = (l_j/l_i)/(x_i - x_j), D_ii = -sum_{j != i} D_ij, with
+    the barycentric weights of the Gauss nodes l_j = (-1)^j sqrt((1 - t_j^2) w_j).
+    """
+    t, wt = onp.polynomial.legendre.leggauss(n)
+    x = 0.5*(b - a)*t + 0.5*(a + b)
+    w = 0.5*(b - a)*wt
+    lam = (-1.)**onp.arange(n)*onp.sqrt((1. - t**2)*wt)
+    dx = x[:, None] - x[None]
+    onp.fill_diagonal(dx, 1.)
+    D = lam[None]/lam[:, None]/dx
+    onp.fill_diagonal(D, 0.)
+    onp.fill_diagonal(D, -D.sum(1))
+    return Quadrature(x[:, None], w, 'gauss', D=D)
+
+
+def quadrature_1d(rule: str = 'gauss', n: int = 256, a: float = -20., b: float = 20.) -> Quadrature:
+    """1D rule 'trapz' or 'gauss' on [a, b]."""
+    if rule == 'trapz':
+        return trapezoid(n, a, b)
+    if rule == 'gauss':
+        return gauss_legendre(n, a, b)
+    raise ValueError(f"Unknown quadrature rule '{rule}', available: {RULES_1D}.")
+
+
+def becke_quadrature(coords: Any, z: Any, level: int = 1, rho: Optional[Callable] = None,
+                     threshold: float = 1E-10) -> Quadrature:
+    """
+    Becke grid of a molecule ('becke_grid.becke_grid'), built once per run and screened
+    with 'rho(x)' (e.g. the promolecular prior), points with |w rho| < 'threshold' are dropped.
+    """
+    from ofdft_normflows.becke_grid import becke_grid, screen_grid
+
+    x, w = becke_grid(coords, z, level)
+    if rho is not None:
+        x, w, _ = screen_grid(x, w, rho(x), threshold)
+    return Quadrature(onp.asarray(x), onp.asarray(w), 'becke')
+
+
+def log_density_and_score(log_rho: Callable, params: Any, q: Quadrature):
+    """
+    log rho and its gradient (the score) at the nodes of 'q', (n,) and (n, d).
+
+    On a 1D rule the score is the derivative of log rho on the nodes (one reverse ODE
+    solve). On other grids it is the gradient of sum_i log rho(x_i) with respect to
+    the points, a backward pass through the reverse ODE (the points are independent,
+    the shared step sizes are constants of the adjoint); the training gradient then
+    differentiates through both passes.
+    """
+    x = jnp.asarray(q.x)
+    if q.rule in RULES_1D:
+        log_den = jnp.reshape(log_rho(params, x), (-1,))
+        return log_den, q.derivative(log_den)[:, None]
+    log_den, vjp = jax.vjp(lambda x: jnp.reshape(log_rho(params, x), (-1,)), x)
+    score, = vjp(jnp.ones_like(log_den))
+    return log_den, score
+
+
+def expectation(p: Array, e: Array) -> Array:
+    """sum_i p_i e_i of a per-point term e, (n,) or (n, 1)."""
+    return jnp.vdot(p, jnp.reshape(e, p.shape))
+
+
+def quadrature_energy(log_rho: Callable, params: Any, q: Quadrature, local_terms: Callable,
+                      kernel: Callable, Ne: int, tile: int = 256, bool_diagonal: Optional[bool] = None) -> dict:
+    r"""
+    Energy terms by quadrature over the reverse-evaluated density instead of samples,
+
+    E[\rho] = \sum_i p_i e(\rho_i, s_i, x_i) + \sum_{i, j} p_i p_j v_H(x_i, x_j),
+
+    with p_i = w_i \rho(x_i) / \sum_j w_j \rho(x_j), the same per-point functionals as the
+    sampling loss (their mean over samples becomes a weighted sum). The i = j terms of
+    the Hartree sum are only kept for finite kernels (the soft-Coulomb of the 1D rules);
+    without them the 3D sum is renormalized over i != j ('hartree_ustat'). Normalizing by the
+    quadrature norm keeps mass outside of the grid from lowering the energy. No Monte Carlo
+    noise, the gradient flows through the reverse ODE ('log_rho').
+
+    Parameters
+    ----------
+    log_rho : Callable
+        'log_rho(params, x)' -> (n,) of the normalized density.
+    params : Any
+        Flow parameters.
+    q : Quadrature
+        Quadrature rule, e.g. 'quadrature_1d' or 'becke_quadrature'.
+    local_terms : Callable
+        'local_terms(den, score, x)' -> dict of per-point terms (n, 1), e.g.
+        {'kin': ..., 'vnuc': ..., 'xc': ...}.
+    kernel : Callable
+        Hartree pair kernel ('functionals._hartree').
+    Ne : int
+        Number of electrons.
+    tile : int, optional
+        Rows per tile of the pair sum ('hartree_ustat'), by default 256
+    bool_diagonal : Optional[bool], optional
+        Keep the i = j Hartree terms, by default for the 1D rules
+
+    Returns
+    -------
+    dict
+        Terms of 'local_terms', 'hart' and the quadrature norm 'I' (\int rho, without Ne).
+    """
+    log_den, score = log_density_and_score(log_rho, params, q)
+    den = jnp.exp(log_den)
+    x = jnp.asarray(q.x)
+    p = jnp.asarray(q.w)*den
+    norm = jnp.sum(p)
+    p = p/norm
+    den_local = jnp.maximum(den, DEN_FLOOR)[:, None]
+    terms = {k: expectation(p, v) for k, v in local_terms(den_local, score, x).items()}
+    terms['hart'] = hartree_ustat(x, Ne, kernel, tile, p)
+    if bool_diagonal if bool_diagonal is not None else q.rule in RULES_1D:
+        p2 = p*p
+        terms['hart'] = terms['hart']*(1. - jnp.sum(p2)) + expectation(p2, kernel(x, x, Ne))
+    terms['I'] = norm
+    return terms
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    import pandas as pd
+    import optax
+    import jax.random as jrnd
+    from jax import lax
+    from distrax import MultivariateNormalDiag
+    from ofdft_normflows.cn_flows import Gen_CNFSimpleMLP as CNF
+    from ofdft_normflows.jax_ode import neural_ode, neural_ode_score
+    from ofdft_normflows.functionals import _kinetic, _nuclear, _hartree, _exchange_correlation
+    from ofdft_normflows.utils import batche_generator_1D
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Time to accuracy, quadrature vs sampling loss (1D LiH)")
+    parser.add_argument("--epochs", type=int, default=300, help="epochs of every loss")
+    parser.add_argument("--nn", type=str, default='64,64', help="hidden layers of the CNF")
+    parser.add_argument("--bs", type=int, default=512, help="batch size of the sampling loss")
+    parser.add_argument("--rules", type=str, default='gauss:128,trapz:256',
+                        help="quadrature losses, comma separated 'rule:n'")
+    parser.add_argument("--n_ref", type=int, default=512, help="Gauss-Legendre nodes of the reference energy")
+    parser.add_argument("--every", type=int, default=10, help="epochs between reference energies")
+    parser.add_argument("--tol", type=str, default='1e-2,3e-3,1e-3', help="energy tolerances (Ha)")
+    parser.add_argument("--out", type=str, default='quadrature_benchmark.csv', help="trajectories")
+    args = parser.parse_args()
+
+    Ne, R, Z_alpha, Z_beta = 2, 0.7, 3, 1
+    nn = tuple(int(k) for k in args.nn.split(','))
+    model_rev = CNF(1, nn, bool_neg=False)
+    model_fwd = CNF(1, nn, bool_neg=True)
+    params0 = model_rev.init(jrnd.split(jrnd.PRNGKey(0))[1], jnp.array(0.), jnp.ones((1, 2)))
+    prior_dist = MultivariateNormalDiag(jnp.zeros(1), jnp.ones(1))
+    t_functional, v_functional = _kinetic('tfw_1d'), _nuclear('attr')
+    vh_functional, xc_functional = _hartree('softc'), _exchange_correlation('xc_1d')
+
+    def log_rho_rev(params, x):
+        zt = lax.concatenate((x, jnp.zeros((x.shape[0], 1))), 1)
+        z0, logp_z0 = neural_ode(params, zt, model_rev, -1., 0., 1)
+        return prior_dist.log_prob(z0) - jnp.reshape(logp_z0, (-1,))
+
+    def local_terms(den, score, x):
+        return {'kin': t_functional(den, score, Ne), 'vnuc': v_functional(x, R, Z_alpha, Z_beta, Ne),
+                'xc': xc_functional(den, Ne)}
+
+    def quad_loss(q):
+        def loss(params, batch):
+            terms = quadrature_energy(log_rho_rev, params, q, local_terms, vh_functional, Ne)
+            return terms['kin'] + terms['vnuc'] + terms['hart'] + terms['xc']
+        return loss
+
+    def mc_loss(params, batch):
+        zt, logp_zt, score = neural_ode_score(params, batch, model_fwd, 0., 1., 1)
+        den = jnp.exp(logp_zt)
+        x, xp = zt[:args.bs], zt[args.bs:]
+        e = t_functional(den[:args.bs], score[:args.bs], Ne) + vh_functional(x, xp, Ne) \
+            + v_functional(x, R, Z_alpha, Z_beta, Ne) + xc_functional(den[:args.bs], Ne)
+        return jnp.mean(e)
+
+    ref_loss = jax.jit(quad_loss(gauss_legendre(args.n_ref, -20., 20.)))
+    optimizer = optax.chain(optax.clip_by_global_norm(1.0), optax.rmsprop(learning_rate=3E-4))
+
+    losses = {'mc': mc_loss}
+    losses.update({f'{r}:{n}': quad_loss(quadrature_1d(r, int(n))) for r, n in
+                   (s.split(':') for s in args.rules.split(','))})
+    rows = []
+    for name, loss in losses.items():
+        @jax.jit
+        def step(params, opt_state, batch):
+            value, grads = jax.value_and_grad(loss)(params, batch)
+            updates, opt_state = optimizer.update(grads, opt_state, params)
+            return optax.apply_updates(params, updates), opt_state, value
+
+        params, opt_state = params0, optimizer.init(params0)
+        gen_batches = batche_generator_1D(jrnd.PRNGKey(1), args.bs, prior_dist)
+        start = time.time()
+        jax.block_until_ready(step(params, opt_state, next(gen_batches)))
+        t_compile, t_train = time.time() - start, 0.
+        for i in range(args.epochs + 1):
+            batch = next(gen_batches)
+            start = time.time()
+            params, opt_state, value = jax.block_until_ready(step(params, opt_state, batch))
+            t_train += time.time() - start
+            if i % args.every == 0 or i == args.epochs:
+                rows.append({'loss': name, 'epoch': i, 't': t_train, 'E_loss': float(value),
+                             'E': float(ref_loss(params, None))})
+        print(f'{name}: compile {t_compile:.1f} s, {args.epochs} epochs {t_train:.1f} s, '
+              f'E = {rows[-1]["E"]:.6f}')
+
+    df = pd.DataFrame(rows)
+    df.to_csv(args.out, index=False)
+    # time to reach the lowest reference energy of all the runs within 'tol'
+    e_min = df['E'].min()
+    for name, g in df.groupby('loss', sort=False):
+        line = []
+        for tol in (float(t) for t in args.tol.split(',')):
+            hit = g[g['E'] - e_min <= tol]
+            line.append(f'{tol:.0e}: ' + (f"{hit['t'].iloc[0]:.1f} s (epoch {hit['epoch'].iloc[0]})"
+                                          if len(hit) else '-'))
+        print(f'{name}: ' + ', '.join(line))
@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import hashlib
+import itertools
+import threading
+import subprocess
+from typing import Any, Callable, Optional, Sequence
+
+import pandas as pd
+
+
+INDEX_COLUMNS = ['config_id', 'status', 'results_dir', 'returncode',
+                 'start', 'end', 'wall_time', 'cores', 'config']
+
+
+def expand_grid(grid: dict, fixed: Optional[dict] = None) -> list:
+    """
+    Cartesian product of a parameter grid.
+
+    Parameters
+    ----------
+    grid : dict
+        Maps a CLI argument name to the list of values to sweep.
+    fixed : Optional[dict], optional
+        Arguments shared by all configurations, by default None
+
+    Returns
+    -------
+    list
+        List of configurations (dicts).
+    """
+    fixed = {} if fixed is None else dict(fixed)
+    keys = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        config = dict(fixed)
+        config.update(dict(zip(keys, values)))
+        configs.append(config)
+    return configs
+
+
+def load_configs(file: str) -> list:
+    """
+    Reads the configurations of a sweep from a JSON file. The file either holds a
+    list of configurations, or a dict with 'grid' (and optionally 'fixed' and 'configs').
+
+    Parameters
+    ----------
+    file : str
+        JSON file.
+
+    Returns
+    -------
+    list
+        List of configurations (dicts).
+    """
+    with open(file, 'r') as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        return spec
+    configs = list(spec.get('configs', []))
+    if 'grid' in spec:
+        configs += expand_grid(spec['grid'], spec.get('fixed'))
+    return configs
+
+
+def config_id(config: dict) -> str:
+    """Stable short hash of a configuration."""
+    s = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()[:12]
+
+
+def config_to_argv(config: dict) -> list:
+    """Converts a configuration into CLI arguments, {'lr': 1e-4} -> ['--lr', '0.0001'], {'flag': True} -> ['--flag']."""
+    argv = []
+    for k, v in config.items():
+        if isinstance(v, bool):
+            argv += [f'--{k}'] if v else []
+            continue
+        if isinstance(v, (list, tuple)):
+            v = ','.join(str(vi) for vi in v)
+        argv += [f'--{k}', str(v)]
+    return argv
+
+
+def core_slots(n_workers: int, threads_per_worker: int, cores: Optional[Sequence[int]] = None) -> list:
+    """
+    Splits the available cores into disjoint subsets, one per worker.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of concurrent runs.
+    threads_per_worker : int
+        Number of cores (and XLA threads) given to each run.
+    cores : Optional[Sequence[int]], optional
+        Cores to use, by default the affinity of the current process.
+
+    Returns
+    -------
+    list
+        List of core subsets.
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(
+            os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    cores = list(cores)
+    if n_workers*threads_per_worker > len(cores):
+        raise ValueError(
+            f"{n_workers} workers x {threads_per_worker} threads exceed the {len(cores)} available cores.")
+    return [cores[i*threads_per_worker:(i+1)*threads_per_worker] for i in range(n_workers)]
+
+
+def thread_budget_env(n_threads: int, env: Optional[dict] = None) -> dict:
+    """
+    Environment limiting BLAS/OpenMP (PySCF) to 'n_threads' threads. XLA has no flag
+    for the size of its CPU thread pool, it follows the affinity of the process (set
+    by 'run_sweep' with 'sched_setaffinity'); single-threaded runs also turn off the
+    multi-threaded Eigen kernels.
+    """
+    env = dict(os.environ if env is None else env)
+    if n_threads == 1:
+        env['XLA_FLAGS'] = (env.get('XLA_FLAGS', '') + ' --xla_cpu_multi_thread_eigen=false').strip()
+    for k in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[k] = str(n_threads)
+    return env
+
+
+class SweepIndex:
+    """
+    Single CSV file recording the status of every configuration of a sweep.
+    Updates are serialized with a lock and written atomically.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self._lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(file):
+            df = pd.read_csv(file, dtype=str, keep_default_na=False)
+            for r in df.to_dict('records'):
+                self.records[r['config_id']] = r
+
+    def status(self, cid: str) -> Optional[str]:
+        if cid not in self.records:
+            return None
+        return self.records[cid]['status']
+
+    def update(self, cid: str, **values):
+        with self._lock:
+            record = self.records.setdefault(
+                cid, {k: '' for k in INDEX_COLUMNS})
+            record.update(values)
+            record['config_id'] = cid
+            df = pd.DataFrame(list(self.records.values()), columns=INDEX_COLUMNS)
+            tmp = self.file + '.tmp'
+            df.to_csv(tmp, index=False)
+            os.replace(tmp, self.file)
+
+
+def run_sweep(configs: Sequence[dict],
+              command: Sequence[str],
+              results_dir: Callable,
+              index_file: str = 'sweep_index.csv',
+              n_workers: int = 1,
+              threads_per_worker: int = 1,
+              cores: Optional[Sequence[int]] = None,
+              log_dir: str = 'sweep_logs',
+              bool_rerun_failed: bool = True,
+              bool_precompile: bool = False) -> dict:
+    """
+    Runs a list of configurations in a pool of pinned worker processes.
+
+    Each run is a separate process (e.g. 'python OFDFT_NF.py --lr ...') pinned to
+    its own core subset and given an XLA thread budget. Configurations whose
+    results directory already contains 'completed.json', or that are marked as
+    completed in the index, are skipped.
+
+    Parameters
+    ----------
+    configs : Sequence[dict]
+        Configurations, converted to CLI arguments with 'config_to_argv'.
+    command : Sequence[str]
+        Base command, e.g. ['python', 'OFDFT_NF.py'].
+    results_dir : Callable
+        Maps a configuration to the results directory written by the run.
+    index_file : str, optional
+        CSV index of the sweep, by default 'sweep_index.csv'
+    n_workers : int, optional
+        Number of concurrent runs, by default 1
+    threads_per_worker : int, optional
+        Cores/threads per run, by default 1
+    cores : Optional[Sequence[int]], optional
+        Cores to use, by default all cores of the current process.
+    log_dir : str, optional
+        Directory for the stdout/stderr of each run, by default 'sweep_logs'
+    bool_rerun_failed : bool, optional
+        Re-run configurations marked as failed, by default True
+    bool_precompile : bool, optional
+        Run every pending configuration with '--compile_only' first, so the
+        runs load their executables from the persistent compilation cache; skipped
+        when the backend cannot persist executables (CPU without the XLA runtime), by default False
+
+    Returns
+    -------
+    dict
+        Summary of the sweep, including the throughput in configurations per hour.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import queue
+
+    os.makedirs(log_dir, exist_ok=True)
+    index = SweepIndex(index_file)
+    slots = queue.Queue()
+    for slot in core_slots(n_workers, threads_per_worker, cores):
+        slots.put(slot)
+
+    pending = []
+    n_skipped = 0
+    for config in configs:
+        cid = config_id(config)
+        rdir = results_dir(config)
+        status = index.status(cid)
+        if status == 'completed' or os.path.exists(os.path.join(rdir, 'completed.json')):
+            if status != 'completed':
+                index.update(cid, status='completed', results_dir=rdir,
+                             config=json.dumps(config, sort_keys=True))
+            n_skipped += 1
+            continue
+        if status == 'failed' and not bool_rerun_failed:
+            n_skipped += 1
+            continue
+        index.update(cid, status='pending', results_dir=rdir,
+                     config=json.dumps(config, sort_keys=True))
+        pending.append((cid, rdir, config))
+
+    def _compile(item):
+        cid, rdir, config = item
+        cores_i = slots.get()
+        try:
+            # same thread budget (XLA flags) as the run, otherwise the cache keys differ
+            env = thread_budget_env(len(cores_i))
+            with open(os.path.join(log_dir, f'{cid}_compile.log'), 'w') as log:
+                proc = subprocess.run(list(command) + config_to_argv(config) + ['--compile_only'],
+                                      env=env, stdout=log, stderr=subprocess.STDOUT)
+            return proc.returncode == 0
+        finally:
+            slots.put(cores_i)
+
+    def _run(item):
+        cid, rdir, config = item
+        cores_i = slots.get()
+        try:
+            env = thread_budget_env(len(cores_i))
+            start = time.time()
+            index.update(cid, status='running', start=start,
+                         cores=' '.join(str(c) for c in cores_i))
+
+            def _pin():
+                if hasattr(os, 'sched_setaffinity'):
+                    os.sched_setaffinity(0, cores_i)
+
+            with open(os.path.join(log_dir, f'{cid}.log'), 'w') as log:
+                proc = subprocess.run(list(command) + config_to_argv(config), env=env,
+                                      stdout=log, stderr=subprocess.STDOUT,
+                                      preexec_fn=_pin)
+            end = time.time()
+            bool_done = proc.returncode == 0 and os.path.exists(
+                os.path.join(rdir, 'completed.json'))
+            index.update(cid, status='completed' if bool_done else 'failed',
+                         returncode=proc.returncode, end=end, wall_time=end - start)
+            return bool_done
+        finally:
+            slots.put(cores_i)
+
+    t_compile = 0.
+    if bool_precompile and pending:
+        from ofdft_normflows.compilation import executables_persist
+        if not executables_persist(thread_budget_env(threads_per_worker)):
+            print('sweep: skipping the compile pass, the executables of this backend are not '
+                  'kept in the persistent cache (see compilation.enable_compilation_cache)')
+            bool_precompile = False
+    if bool_precompile and pending:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            n_compiled = sum(pool.map(_compile, pending))
+        t_compile = time.time() - start
+        print(f'sweep: compiled {n_compiled}/{len(pending)} configurations in {t_compile:.1f} s')
+
+    start = time.time()
+    n_completed, n_failed = 0, 0
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for bool_done in pool.map(_run, pending):
+            n_completed += int(bool_done)
+            n_failed += int(not bool_done)
+            hours = (time.time() - start)/3600.
+            print(f'sweep: {n_completed + n_failed}/{len(pending)} finished, '
+                  f'{n_failed} failed, {n_completed/max(hours, 1E-9):.2f} configs/hour')
+
+    hours = (time.time() - start)/3600.
+    return {'n_configs': len(configs),
+            'n_skipped': n_skipped,
+            'n_completed': n_completed,
+            'n_failed': n_failed,
+            'wall_time': hours*3600.,
+            'compile_time': t_compile,
+            'configs_per_hour': n_completed/hours if hours > 0 else 0.,
+            }
@@ -0,0 +1,351 @@
+from typing import Any, Optional
+from functools import partial
+
+import numpy as onp
+import jax
+import jax.numpy as jnp
+
+Array = jax.Array
+
+# same softening as 'functionals.Hartree_potential', 1/sqrt(r^2 + 3 eps), eps = 1E-5
+EPS_HARTREE = (3*1E-5)**0.5
+
+
+# ------------------------------------------------------------------------------------------------------------
+# OCTREE (host side, NumPy)
+# ------------------------------------------------------------------------------------------------------------
+
+def _part1by2(v: onp.ndarray) -> onp.ndarray:
+    """Spreads the lower 21 bits of 'v' to every third bit."""
+    v = v & onp.uint64(0x1fffff)
+    v = (v | v << onp.uint64(32)) & onp.uint64(0x1f00000000ffff)
+    v = (v | v << onp.uint64(16)) & onp.uint64(0x1f0000ff0000ff)
+    v = (v | v << onp.uint64(8)) & onp.uint64(0x100f00f00f00f00f)
+    v = (v | v << onp.uint64(4)) & onp.uint64(0x10c30c30c30c30c3)
+    v = (v | v << onp.uint64(2)) & onp.uint64(0x1249249249249249)
+    return v
+
+
+def morton_codes(y: onp.ndarray, depth: int) -> onp.ndarray:
+    """Morton (Z-order) codes of the points 'y' on a 2^depth grid of their bounding cube."""
+    lo = y.min(axis=0)
+    size = (y.max(axis=0) - lo).max()
+    size = size if size > 0 else 1.
+    ijk = onp.floor((y - lo)/size*(2**depth)).astype(onp.int64)
+    ijk = onp.clip(ijk, 0, 2**depth - 1).astype(onp.uint64)
+    return _part1by2(ijk[:, 0]) | (_part1by2(ijk[:, 1]) << onp.uint64(1)) | (_part1by2(ijk[:, 2]) << onp.uint64(2))
+
+
+class Octree:
+    """
+    Linear octree of point charges. Sources are sorted by Morton code, so the
+    particles of every cell are a contiguous range of the sorted arrays and each
+    level is described by flat arrays (start, count, charge, center of charge,
+    bounding box and child range).
+
+    Parameters
+    ----------
+    y : onp.ndarray
+        Positions of the sources, (M, 3).
+    q : onp.ndarray
+        Charges of the sources, (M,).
+    depth : int, optional
+        Maximum depth of the tree, by default 16
+    """
+
+    def __init__(self, y: onp.ndarray, q: onp.ndarray, depth: int = 16):
+        codes = morton_codes(y, depth)
+        self.order = onp.argsort(codes, kind='stable')
+        self.y = y[self.order]
+        self.q = q[self.order]
+        codes = codes[self.order]
+        self.depth = depth
+
+        aq = onp.abs(self.q)
+        aq = onp.where(aq > 0, aq, 1E-300)
+        self.levels = []
+        for level in range(depth + 1):
+            prefix = codes >> onp.uint64(3*(depth - level))
+            prefix, start, count = onp.unique(
+                prefix, return_index=True, return_counts=True)
+            w = onp.add.reduceat(aq, start)
+            center = onp.add.reduceat(aq[:, None]*self.y, start, axis=0)/w[:, None]
+            box_lo = onp.minimum.reduceat(self.y, start, axis=0)
+            box_hi = onp.maximum.reduceat(self.y, start, axis=0)
+            self.levels.append({'prefix': prefix, 'start': start, 'count': count,
+                                'charge': onp.add.reduceat(self.q, start),
+                                'center': center, 'lo': box_lo, 'hi': box_hi,
+                                'size': (box_hi - box_lo).max(axis=1)})
+        for level in range(depth):
+            parent = self.levels[level+1]['prefix'] >> onp.uint64(3)
+            prefix = self.levels[level]['prefix']
+            self.levels[level]['child_lo'] = onp.searchsorted(parent, prefix, 'left')
+            self.levels[level]['child_hi'] = onp.searchsorted(parent, prefix, 'right')
+
+    def evaluate(self, x: onp.ndarray, theta: float = 0.5, eps: float = EPS_HARTREE,
+                 leaf_size: int = 32, target_index: Optional[onp.ndarray] = None,
+                 chunk: int = 4096):
+        r"""
+        Barnes-Hut evaluation of the softened potential and its gradient at 'x',
+
+        \phi(x_i) = \sum_j \frac{q_j}{\sqrt{|x_i - y_j|^2 + \epsilon^2}},
+
+        a cell is replaced by its monopole (total charge at the center of charge)
+        if size/distance < theta and 'x_i' lies outside its bounding box,
+        otherwise it is opened; leaves (<= 'leaf_size' particles) are summed directly.
+
+        Parameters
+        ----------
+        x : onp.ndarray
+            Targets, (N, 3).
+        theta : float, optional
+            Opening angle, by default 0.5 (0 is the direct sum).
+        eps : float, optional
+            Softening length, by default EPS_HARTREE
+        leaf_size : int, optional
+            Maximum number of particles summed directly per cell, by default 32
+        target_index : Optional[onp.ndarray], optional
+            Source index of every target, excludes the self-interaction when the
+            targets are the sources, by default None
+        chunk : int, optional
+            Targets processed at once (bounds the size of the interaction lists), by default 4096
+
+        Returns
+        -------
+        tuple
+            Potential (N,) and its gradient with respect to the targets (N, 3).
+        """
+        n = x.shape[0]
+        phi = onp.zeros(n, dtype=x.dtype)
+        grad = onp.zeros((n, 3), dtype=x.dtype)
+        for i in range(0, n, chunk):
+            idx = None if target_index is None else target_index[i:i+chunk]
+            phi[i:i+chunk], grad[i:i+chunk] = self._evaluate_chunk(
+                x[i:i+chunk], theta, eps, leaf_size, idx)
+        return phi, grad
+
+    def _evaluate_chunk(self, x, theta, eps, leaf_size, target_index):
+        n = x.shape[0]
+        eps2 = eps*eps
+        phi = onp.zeros(n, dtype=x.dtype)
+        grad = onp.zeros((n, 3), dtype=x.dtype)
+
+        def _accumulate(t, q, d, d2):
+            inv = 1./onp.sqrt(d2 + eps2)
+            phi[:] += onp.bincount(t, weights=q*inv, minlength=n)
+            gq = -q*inv*inv*inv
+            for k in range(3):
+                grad[:, k] += onp.bincount(t, weights=gq*d[:, k], minlength=n)
+
+        def _expand(t, lo, counts):
+            # all (t, lo + k) pairs for k < counts
+            total = counts.sum()
+            t_rep = onp.repeat(t, counts)
+            offset = onp.arange(total) - onp.repeat(onp.cumsum(counts) - counts, counts)
+            return t_rep, onp.repeat(lo, counts) + offset
+
+        t = onp.arange(n)
+        c = onp.zeros(n, dtype=onp.int64)
+        for level in range(self.depth + 1):
+            if t.shape[0] == 0:
+                break
+            lev = self.levels[level]
+            d = x[t] - lev['center'][c]
+            d2 = onp.sum(d*d, axis=1)
+            outside = onp.any((x[t] < lev['lo'][c]) | (x[t] > lev['hi'][c]), axis=1)
+            far = outside & (lev['size'][c]**2 < theta*theta*d2)
+            if onp.any(far):
+                _accumulate(t[far], lev['charge'][c[far]], d[far], d2[far])
+
+            leaf = ~far & ((lev['count'][c] <= leaf_size) | (level == self.depth))
+            if onp.any(leaf):
+                t_p, j = _expand(t[leaf], lev['start'][c[leaf]], lev['count'][c[leaf]])
+                d_p = x[t_p] - self.y[j]
+                q_p = self.q[j]
+                if target_index is not None:
+                    q_p = onp.where(self.order[j] == target_index[t_p], 0., q_p)
+                _accumulate(t_p, q_p, d_p, onp.sum(d_p*d_p, axis=1))
+
+            split = ~far & ~leaf
+            if level == self.depth or not onp.any(split):
+                break
+            lo = lev['child_lo'][c[split]]
+            t, c = _expand(t[split], lo, lev['child_hi'][c[split]] - lo)
+        return phi, grad
+
+
+def tree_potential(x: onp.ndarray, y: onp.ndarray, q: onp.ndarray, theta: float = 0.5,
+                   eps: float = EPS_HARTREE, leaf_size: int = 32, bool_self: bool = False):
+    """
+    Potential of the charges 'q' at 'y' evaluated at 'x' and its gradient, see 'Octree.evaluate'.
+    If 'bool_self', 'x' are the sources and the self-interaction is excluded.
+    """
+    x = onp.asarray(x, dtype=onp.float64)
+    y = x if bool_self else onp.asarray(y, dtype=onp.float64)
+    tree = Octree(y, onp.asarray(q, dtype=onp.float64))
+    target_index = onp.arange(x.shape[0]) if bool_self else None
+    return tree.evaluate(x, theta, eps, leaf_size, target_index)
+
+
+# ------------------------------------------------------------------------------------------------------------
+# JAX WRAPPERS
+# ------------------------------------------------------------------------------------------------------------
+
+def _host_self(x, theta, eps, leaf_size):
+    phi, grad = tree_potential(x, None, onp.ones(x.shape[0]), theta, eps, leaf_size, True)
+    return phi.astype(x.dtype), grad.astype(x.dtype)
+
+
+def _host_external(x, y, q, theta, eps, leaf_size):
+    phi, grad = tree_potential(x, y, q, theta, eps, leaf_size, False)
+    return phi.astype(x.dtype), grad.astype(x.dtype)
+
+
+def _callback(fun, x, *args):
+    shapes = (jax.ShapeDtypeStruct(x.shape[:1], x.dtype),
+              jax.ShapeDtypeStruct(x.shape, x.dtype))
+    return jax.pure_callback(fun, shapes, x, *args)
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(1, 2, 3, 4))
+def hartree_tree(x_all: Array, Ne: int, theta: float = 0.5, eps: float = EPS_HARTREE,
+                 leaf_size: int = 32) -> jax.Array:
+    r"""
+    Barnes-Hut estimate of the all-pairs (U-statistic) Hartree energy of the samples,
+
+    V_{\text{H}} \approx \frac{N_e^2}{2N(N-1)} \sum_{i \neq j} \frac{1}{\sqrt{|x_i - x_j|^2 + \epsilon^2}},
+
+    same kernel as 'functionals.Hartree_potential'. The tree is built and traversed
+    on the host (NumPy) through 'jax.pure_callback'; the gradient with respect to
+    the samples is the (tree) field at every sample.
+
+    Parameters
+    ----------
+    x_all : Array
+        Samples, (N, 3).
+    Ne : int
+        Number of electrons.
+    theta : float, optional
+        Opening angle, by default 0.5
+    eps : float, optional
+        Softening length, by default EPS_HARTREE
+    leaf_size : int, optional
+        Maximum number of particles summed directly per cell, by default 32
+
+    Returns
+    -------
+    jax.Array
+        Hartree energy estimate.
+    """
+    phi, _ = _callback(partial(_host_self, theta=theta, eps=eps, leaf_size=leaf_size), x_all)
+    n = x_all.shape[0]
+    return 0.5*(Ne**2)*jnp.sum(phi)/(n*(n - 1))
+
+
+def _hartree_tree_fwd(x_all, Ne, theta, eps, leaf_size):
+    phi, grad = _callback(partial(_host_self, theta=theta, eps=eps, leaf_size=leaf_size), x_all)
+    n = x_all.shape[0]
+    c = 0.5*(Ne**2)/(n*(n - 1))
+    # every pair appears twice in sum_i phi_i
+    return c*jnp.sum(phi), 2*c*grad
+
+
+def _hartree_tree_bwd(Ne, theta, eps, leaf_size, grad, g):
+    return (g*grad,)
+
+
+hartree_tree.defvjp(_hartree_tree_fwd, _hartree_tree_bwd)
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(3, 4, 5))
+def _external_tree(x: Array, y: Array, q: Array, theta: float, eps: float, leaf_size: int):
+    return _external_tree_fwd(x, y, q, theta, eps, leaf_size)[0]
+
+
+def _external_tree_fwd(x, y, q, theta, eps, leaf_size):
+    phi, grad = _callback(partial(_host_external, theta=theta, eps=eps, leaf_size=leaf_size), x, y, q)
+    return phi, (grad, y, q)
+
+
+def _external_tree_bwd(theta, eps, leaf_size, res, g):
+    # the sources (nuclei) are fixed
+    grad, y, q = res
+    return g[:, None]*grad, jnp.zeros_like(y), jnp.zeros_like(q)
+
+
+_external_tree.defvjp(_external_tree_fwd, _external_tree_bwd)
+
+
+def nuclei_potential_tree(x: Array, Ne: int, mol_info: Any, theta: float = 0.5,
+                          eps: float = 1E-4, leaf_size: int = 32) -> jax.Array:
+    r"""
+    Electron-nuclei potential at every sample with the nuclei as Barnes-Hut sources,
+
+    v_{\text{e-N}}(x) = -N_e \sum_a \frac{Z_a}{\sqrt{|x - R_a|^2 + \epsilon^2}},
+
+    same signature as 'functionals.Nuclei_potential'. Useful for large molecules
+    and batches; for a handful of nuclei the direct sum is faster.
+
+    Parameters
+    ----------
+    x : Array
+        Samples, (N, 3).
+    Ne : int
+        Number of electrons.
+    mol_info : Any
+        Molecular information, {'coords', 'z'}.
+    theta : float, optional
+        Opening angle, by default 0.5
+    eps : float, optional
+        Softening length, by default 1E-4
+    leaf_size : int, optional
+        Maximum number of nuclei summed directly per cell, by default 32
+
+    Returns
+    -------
+    jax.Array
+        Potential, (N, 1).
+    """
+    y = jnp.asarray(mol_info['coords'], x.dtype)
+    q = jnp.ravel(jnp.asarray(mol_info['z'], x.dtype))
+    phi = _external_tree(x, y, q, theta, eps, leaf_size)
+    return -Ne*phi[:, None]
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    from ofdft_normflows.functionals import Hartree_potential
+    from ofdft_normflows.hartree_estimators import hartree_ustat
+    from ofdft_normflows.promolecular_distrax import ProMolecularDensity
+    from ofdft_normflows.utils import coordinates
+
+    jax.config.update("jax_enable_x64", True)
+
+    parser = argparse.ArgumentParser(description="Barnes-Hut vs direct Hartree sum")
+    parser.add_argument("--mol_name", type=str, default='C6H6', help="molecule name")
+    parser.add_argument("--n", type=str, default='1000,4000,16000', help="comma separated number of samples")
+    parser.add_argument("--theta", type=str, default='0.3,0.5,0.7', help="comma separated opening angles")
+    parser.add_argument("--tile", type=int, default=512, help="tile of the direct sum")
+    args = parser.parse_args()
+
+    Ne, atoms, z, coords = coordinates(args.mol_name)
+    prior_dist = ProMolecularDensity(z.ravel(), coords)
+
+    def _time(f, x):
+        jax.block_until_ready(f(x))
+        start = time.time()
+        out = jax.block_until_ready(f(x))
+        return out, time.time() - start
+
+    direct = jax.jit(jax.value_and_grad(lambda x: hartree_ustat(x, Ne, Hartree_potential, args.tile)))
+    print(f"{'N':>8} {'theta':>6} {'t_direct':>10} {'t_tree':>10} {'rel_err_E':>10} {'rel_err_grad':>12}")
+    for n in [int(ni) for ni in args.n.split(',')]:
+        x = prior_dist.sample(seed=jax.random.PRNGKey(n), sample_shape=n)
+        (e_d, g_d), t_d = _time(direct, x)
+        for theta in [float(t) for t in args.theta.split(',')]:
+            tree = jax.jit(jax.value_and_grad(lambda x: hartree_tree(x, Ne, theta)))
+            (e_t, g_t), t_t = _time(tree, x)
+            err_e = abs(e_t - e_d)/abs(e_d)
+            err_g = jnp.linalg.norm(g_t - g_d)/jnp.linalg.norm(g_d)
+            print(f"{n:>8} {theta:>6.2f} {t_d:>10.3f} {t_t:>10.3f} {err_e:>10.2e} {err_g:>12.2e}")
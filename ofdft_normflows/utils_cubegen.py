@@ -1,23 +1,26 @@
+import os
+from contextlib import ExitStack
+
 import numpy as onp
 import jax
 import jax.numpy as jnp
 from jax import lax
 from flax.training import checkpoints
 
-import pyscf
-from pyscf import gto, dft, lib
-from pyscf.dft import numint
-from pyscf.dft import r_numint
-from pyscf.data.nist import BOHR
-from pyscf.tools.cubegen import Cube
-from pyscf import scf
-from pyscf.tools import cubegen
-
-import distrax
 from distrax import MultivariateNormalDiag
 
+from ofdft_normflows.bucketing import BucketedFunction
+from ofdft_normflows.checkpoint_analysis import CachedDensities
+from ofdft_normflows.poisson import poisson_on_grid
+from ofdft_normflows.becke_grid import becke_grid, screen_grid
+from ofdft_normflows.octree import build_octree
+from ofdft_normflows.volumetric import VolumeGrid, CubeWriter, ChunkedVolumeWriter, write_npz, VOL_EXT
+
 BHOR = 1.8897259886  # 1AA to BHOR
 
+# the cube grids are built from the nuclei ('VolumeGrid.from_molecule'), PySCF is only
+# imported by 'density' (a PySCF molecule)
+
 
 def get_molecule(atoms, geometry):
     m_ = ""
@@ -35,7 +38,7 @@ def get_molecule(atoms, geometry):
 def density(mol, outfile='mol.cube', nx=80, ny=80, nz=80, resolution=None,
             margin=5.):
 
-    from pyscf.pbc.gto import Cell
+    from pyscf.tools.cubegen import Cube
     cc = Cube(mol, nx, ny, nz, resolution, margin)
     coords = cc.get_coords()
     ngrids = cc.get_ngrids()
@@ -51,65 +54,175 @@ def density(mol, outfile='mol.cube', nx=80, ny=80, nz=80, resolution=None,
     return rho
 
 
-def _density(f_density: callable, mol_pyscf: any, outfile_head: str = 'mol', rwd: str = './',
+def allocate_buffers(names: list, n: int, memmap_dir: str = None) -> dict:
+    """Host buffers for 'n' grid values, memory-mapped '{memmap_dir}/{name}.npy' files if 'memmap_dir' is given."""
+    if memmap_dir is None:
+        return {k: onp.empty(n) for k in names}
+    os.makedirs(memmap_dir, exist_ok=True)
+    return {k: onp.lib.format.open_memmap(f"{memmap_dir}/{k}.npy", mode='w+', dtype=onp.float64, shape=(n,))
+            for k in names}
+
+
+def stream_evaluate(f_chunk: callable, coords: onp.ndarray, buffers: dict, sinks: dict = None,
+                    chunk_size: int = 1024) -> dict:
+    """
+    Evaluates 'f_chunk' (points -> dict of per-point values) on 'coords' chunk by chunk
+    and writes every chunk in place in the host 'buffers' (and the 'sinks', e.g. 'volumetric.CubeWriter').
+
+    The transfers are double-buffered, chunk i+1 is dispatched to the device before
+    the results of chunk i are copied to the host.
+    """
+    sinks = {} if sinks is None else sinks
+
+    def flush(start, stop, res):
+        for k, v in res.items():
+            v = onp.asarray(v).reshape(stop - start)
+            buffers[k][start:stop] = v
+            for sink in sinks.get(k, ()):
+                sink.write(v)
+
+    pending = None
+    for start in range(0, coords.shape[0], chunk_size):
+        stop = min(start + chunk_size, coords.shape[0])
+        res = f_chunk(jax.device_put(coords[start:stop]))  # asynchronous dispatch
+        for v in res.values():
+            v.copy_to_host_async()
+        if pending is not None:
+            flush(*pending)
+        pending = (start, stop, res)
+    if pending is not None:
+        flush(*pending)
+    return buffers
+
+
+def cube_grid(mol_inf: any, nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None,
+              margin: float = 5.) -> VolumeGrid:
+    """Cube box of a molecule ('coords' and 'z', Bohr), the same as 'pyscf.tools.cubegen.Cube'."""
+    return VolumeGrid.from_molecule(mol_inf['z'], mol_inf['coords'], nx, ny, nz, resolution, margin)
+
+
+def _open_sinks(stack: ExitStack, grid: VolumeGrid, comments: dict, outfile_head: str, rwd: str,
+                formats: tuple) -> dict:
+    """Streaming writers of every field, '{field}_{outfile_head}.cube' and/or '{outfile_head}.vol'."""
+    sinks = {k: [] for k in comments}
+    if 'cube' in formats:
+        for k, comment in comments.items():
+            sinks[k].append(stack.enter_context(CubeWriter(f"{rwd}/{k}_{outfile_head}.cube", grid, comment)))
+    if 'vol' in formats:
+        store = stack.enter_context(ChunkedVolumeWriter(f"{rwd}/{outfile_head}{VOL_EXT}", grid))
+        for k, comment in comments.items():
+            sinks[k].append(store.sink(k, comment))
+    return sinks
+
+
+def _density(f_density: callable, mol_inf: any, outfile_head: str = 'mol', rwd: str = './',
              save_cube_file: bool = True,
-             nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.):
+             nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.,
+             chunk_size: int = 1024, memmap_dir: str = None, formats: tuple = ('cube',)):
 
-    from pyscf.pbc.gto import Cell
-    cc = Cube(mol_pyscf, nx, ny, nz, resolution, margin)
-    coords = cc.get_coords()
-    ngrids = cc.get_ngrids()
-    grid = jnp.array(coords)
+    cc = cube_grid(mol_inf, nx, ny, nz, resolution, margin)
+    grid = cc.coords()
 
     if grid.shape[1] != 3:
         assert 0
 
-    # rho = f_density(grid)
-    total_data_size = grid.shape[0]
-    batch_size = 1024
-
-    rho_ = jnp.zeros((1, 1))
-    for i in range(0, total_data_size, batch_size):
-        start_idx = i
-        end_idx = jax.lax.min(i + batch_size, total_data_size)
-
-        # Get the current batch of input data
-        input_data = jnp.arange(start_idx, end_idx, dtype=jnp.int32)
-        grid_batch = grid[input_data]
-        rho_batch = f_density(jax.device_put(grid_batch))
-        rho_ = jax.lax.concatenate((rho_, jax.device_get(rho_batch)), 0)
-
-    rho = rho_[1:]
-    print(grid.shape, rho.shape)
-    rho = rho.reshape(cc.nx, cc.ny, cc.nz)
-
-    if save_cube_file:
-        # Write out density to the .cube file
-        outfile = f"{rwd}/rho_{outfile_head}.cube"
-        cc.write(rho, outfile, comment='Electron density in real space (e/Bohr^3)')
+    # the last (partial) chunk is padded, one executable for all the chunks
+    # (the density cache buckets the checkpoints it evaluates itself)
+    if not isinstance(f_density, CachedDensities):
+        f_density = BucketedFunction(f_density)
+    buffers = allocate_buffers(['rho'], grid.shape[0], memmap_dir)
+
+    comments = {'rho': 'Electron density in real space (e/Bohr^3)'}
+    with ExitStack() as stack:
+        sinks = {}
+        if save_cube_file:
+            # Write out density to the .cube/.vol files while it is evaluated
+            sinks = _open_sinks(stack, cc, comments, outfile_head, rwd, formats)
+        stream_evaluate(lambda x: {'rho': f_density(x)}, grid, buffers, sinks, chunk_size)
+
+    rho = buffers['rho'].reshape(cc.shape)
+    if save_cube_file and 'npz' in formats:
+        write_npz(f"{rwd}/{outfile_head}.npz", {'rho': rho}, cc)
     return {'rho': rho,
             'grid': grid,
             }
 
 
-def _density_and_mep(f_density: callable, mol_inf: any, mol_pyscf: any,
-                     outfile_head: str = 'mol', rwd: str = './',
-                     save_cube_file: bool = True,
-                     nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.):
-
-    # becke grid
-    mf_hf = dft.RKS(mol_pyscf)
-    mf_hf.kernel()
-    # mf_hf.grids.level = 3
-    int_coords = jax.device_put(jnp.array(mf_hf.grids.coords))
-    int_weights = jax.device_put(jnp.array(mf_hf.grids.weights))
-    int_rho_val_coords = jax.device_put(f_density(int_coords))
-
-    from ofdft_normflows.functionals import Nuclei_potential
-
-    @jax.jit
-    def f_vnuc(x):
-        return -1.*Nuclei_potential(x=x, Ne=1., mol_info=mol_inf)  # positive
+def _density_epochs(f_densities: callable, mol_inf: any, steps: list, outfile_head: str = 'mol',
+                    rwd: str = './', save_cube_file: bool = True,
+                    nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.,
+                    chunk_size: int = 1024, memmap_dir: str = None, formats: tuple = ('cube',),
+                    bool_mep: bool = False):
+    """
+    Densities of several checkpoints on the same cube grid in one streaming pass,
+    'f_densities(x)' -> (N, len(steps)) (e.g. 'checkpoint_analysis.batched_density'
+    of the restored parameters). Writes 'rho_{outfile_head}_{step}.cube' (and/or
+    '{outfile_head}_{step}.vol/.npz') for every step; with 'bool_mep' also the MEP
+    of every step (FFT Poisson solve), 'mol_inf' gives the nuclei. Jitted functions
+    are bucketed, others (e.g. 'checkpoint_analysis.CachedDensities', through the
+    density cache) are called on every chunk of 'chunk_size' points.
+    """
+    cc = cube_grid(mol_inf, nx, ny, nz, resolution, margin)
+    grid = cc.coords()
+
+    fields = ['rho'] + (['mep'] if bool_mep else [])
+    names = [f'{k}_{step}' for step in steps for k in fields]
+    buffers = allocate_buffers(names, grid.shape[0], memmap_dir)
+    if bool_mep:
+        from ofdft_normflows.functionals import Nuclei_potential
+        f_vnuc = BucketedFunction(jax.jit(lambda x: -1.*Nuclei_potential(x=x, Ne=1., mol_info=mol_inf)))
+        vnuc = allocate_buffers(['vnuc'], grid.shape[0], memmap_dir)
+    if not isinstance(f_densities, CachedDensities):
+        f_densities = BucketedFunction(f_densities)
+
+    def f_chunk(x):
+        rho = f_densities(x)
+        out = {f'rho_{step}': rho[:, i] for i, step in enumerate(steps)}
+        if bool_mep:
+            out['vnuc'] = f_vnuc(x)
+        return out
+
+    comments = {'rho': 'Electron density in real space (e/Bohr^3)',
+                'mep': 'Molecular electrostatic potential in real space'}
+    with ExitStack() as stack:
+        sinks = {}
+        if save_cube_file:
+            for step in steps:
+                s_step = _open_sinks(stack, cc, {k: comments[k] for k in fields},
+                                     f'{outfile_head}_{step}', rwd, formats)
+                sinks.update({f'{k}_{step}': v for k, v in s_step.items()})
+        stream_evaluate(f_chunk, grid, {**buffers, **(vnuc if bool_mep else {})}, sinks, chunk_size)
+
+        if bool_mep:
+            h = jnp.asarray(cube_spacing(cc))
+            for step in steps:
+                rho = jnp.asarray(buffers[f'rho_{step}']).reshape(cc.shape)
+                buffers[f'mep_{step}'][:] = vnuc['vnuc'] - onp.asarray(poisson_on_grid(rho, h)).ravel()
+                for sink in sinks.get(f'mep_{step}', ()):
+                    sink.write(buffers[f'mep_{step}'])
+
+    out = {k: buffers[k].reshape(cc.shape) for k in names}
+    if save_cube_file and 'npz' in formats:
+        for step in steps:
+            write_npz(f"{rwd}/{outfile_head}_{step}.npz", {k: out[f'{k}_{step}'] for k in fields}, cc)
+    out['grid'] = grid
+    return out
+
+
+def cube_spacing(grid: VolumeGrid) -> onp.ndarray:
+    """Grid spacing of the cube along x, y and z."""
+    return onp.linalg.norm(grid.axes, axis=1)
+
+
+def _electronic_potential_direct(f_density: callable, mol_inf: any, grid_level: int = 3,
+                                 threshold: float = 1E-12) -> callable:
+    r"""
+    Electronic potential \int rho(r')/|r - r'| dr' as a direct sum over a Becke grid
+    ('becke_grid', no SCF) screened by the density, O(N_points x N_becke).
+    """
+    int_coords, int_weights = becke_grid(mol_inf['coords'], mol_inf['z'], grid_level)
+    int_coords, int_weights, int_rho_val_coords = screen_grid(
+        int_coords, int_weights, f_density(int_coords), threshold)
 
     @jax.jit
     def integral(x, rho_val, grid, w):
@@ -117,91 +230,228 @@ def _density_and_mep(f_density: callable, mol_inf: any, mol_pyscf: any,
         z = lax.expand_dims(1./z, (1,))
         integrand = rho_val * z
         return jnp.vdot(w, integrand)
-    v_integral = jax.vmap(integral, in_axes=(0, None, None))
-
-    from pyscf.pbc.gto import Cell
-    cc = Cube(mol_pyscf, nx, ny, nz, resolution, margin)
-    coords = cc.get_coords()
-    ngrids = cc.get_ngrids()
-    grid = jnp.array(coords)
-
-    if grid.shape[1] != 3:
-        assert 0
+    v_integral = jax.vmap(integral, in_axes=(0, None, None, None))
+
+    # the last (partial) chunk of the cube grid is padded to the same bucket as the others
+    f_mep_integral = BucketedFunction(
+        lambda rho_val, grid, w, x: v_integral(x, rho_val, grid, w))
+    return lambda x: f_mep_integral(int_rho_val_coords, int_coords, int_weights, x)
+
+
+def mep_accuracy(f_density: callable, mol_inf: any, grid: onp.ndarray, v_elec: onp.ndarray,
+                 n_check: int = 256, seed: int = 0, grid_level: int = 3) -> dict:
+    """
+    Compares the electronic potential on the cube ('v_elec', e.g. from the FFT Poisson
+    solve) with the direct sum over the Becke grid on 'n_check' random cube points.
+
+    The direct sum is itself a quadrature of a singular integrand, cube points that
+    fall close to a Becke grid point carry its largest errors, so the median error
+    is the more reliable measure of the FFT accuracy.
+
+    Returns
+    -------
+    dict
+        Maximum, median and RMS absolute errors, and the maximum relative error.
+    """
+    idx = onp.sort(onp.random.default_rng(seed).choice(grid.shape[0], n_check, replace=False))
+    v_direct = onp.asarray(_electronic_potential_direct(f_density, mol_inf, grid_level)(jnp.asarray(grid[idx])))
+    err = onp.ravel(v_elec)[idx] - v_direct
+    return {'max_abs_err': float(onp.max(onp.abs(err))),
+            'median_abs_err': float(onp.median(onp.abs(err))),
+            'rms_err': float(onp.sqrt(onp.mean(err**2))),
+            'max_rel_err': float(onp.max(onp.abs(err)/onp.abs(v_direct))),
+            'n_check': n_check}
+
+
+def _density_and_mep(f_density: callable, mol_inf: any,
+                     outfile_head: str = 'mol', rwd: str = './',
+                     save_cube_file: bool = True,
+                     nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.,
+                     chunk_size: int = 1024, memmap_dir: str = None,
+                     mep_method: str = 'fft', n_check: int = 0,
+                     grid_level: int = 3, threshold: float = 1E-12, formats: tuple = ('cube',)):
+    """
+    Density, nuclear potential and molecular electrostatic potential (MEP) on a cube grid.
+
+    The electronic part of the MEP is computed with 'mep_method',
+    'fft': Poisson equation of the density on the cube grid itself (isolated
+    boundary conditions, 'poisson.poisson_on_grid'), O(G log G), no SCF;
+    'direct': sum over a Becke grid ('becke_grid.becke_grid' at 'grid_level', points
+    with |w rho| < 'threshold' dropped) for every cube point.
+    With 'n_check' > 0, the 'fft' potential is compared with the direct sum on
+    'n_check' random cube points ('mep_check' in the output).
+
+    With 'save_cube_file', the fields are written in 'formats', 'cube' (one Gaussian
+    cube file per field), 'vol' (chunked float32 store '{outfile_head}.vol' with lazy
+    slices) and/or 'npz' ('{outfile_head}.npz'), see 'volumetric'.
+
+    A 'checkpoint_analysis.CachedDensities' of one checkpoint reads the density of
+    every chunk from the density cache (and buckets the evaluations itself),
+    other functions are bucketed here.
+    """
+    # the last (partial) chunk is padded, one executable for all the chunks
+    if not isinstance(f_density, CachedDensities):
+        f_density = BucketedFunction(f_density)
 
-    # rho = f_density(grid)
-    total_data_size = grid.shape[0]
-    batch_size = 1024
+    from ofdft_normflows.functionals import Nuclei_potential
 
-    rho_ = jnp.zeros((1, 1))
-    mep_ = jnp.zeros((1, 1))
-    vnuc_ = jnp.zeros((1, 1))
-    for i in range(0, total_data_size, batch_size):
-        start_idx = i
-        end_idx = jax.lax.min(i + batch_size, total_data_size)
+    @jax.jit
+    def f_vnuc(x):
+        return -1.*Nuclei_potential(x=x, Ne=1., mol_info=mol_inf)  # positive
 
-        # Get the current batch of input data
-        input_data = jnp.arange(start_idx, end_idx, dtype=jnp.int32)
-        grid_batch = grid[input_data]
-        grid_batch = jax.device_put(grid_batch)
+    # the last (partial) chunk of the cube grid is padded to the same bucket as the others
+    f_vnuc = BucketedFunction(f_vnuc)
 
-        # density
-        rho_batch = f_density(grid_batch)
-        rho_ = jax.lax.concatenate((rho_, jax.device_get(rho_batch)), 0)
+    mep_method = mep_method.lower()
+    if mep_method == 'direct':
+        f_elec = _electronic_potential_direct(f_density, mol_inf, grid_level, threshold)
+    elif mep_method != 'fft':
+        raise ValueError(f"Unknown MEP method '{mep_method}'.")
 
+    def f_chunk(x):
+        rho_batch = f_density(x)
         # nuclei potential sum_A Z_a / |r - Ra|
-        vnuc_batch = f_vnuc(grid_batch)
-        vnuc_ = jax.lax.concatenate((vnuc_, jax.device_get(vnuc_batch)), 0)
-
+        vnuc_batch = f_vnuc(x)
+        if mep_method == 'fft':
+            return {'rho': rho_batch, 'vnuc': vnuc_batch}
         # add integration
-        integ_batch = v_integral(
-            grid_batch, int_rho_val_coords, int_coords, int_weights)
-        mep_batch = vnuc_batch - integ_batch[:, None]
-        mep_ = jax.lax.concatenate((mep_, jax.device_get(mep_batch)), 0)
+        mep_batch = vnuc_batch - f_elec(x)[:, None]
+        return {'rho': rho_batch, 'vnuc': vnuc_batch, 'mep': mep_batch}
 
-    rho, vnuc, mep = rho_[1:], vnuc_[1:], mep_[1:]
-    rho = rho.reshape(cc.nx, cc.ny, cc.nz)
-    vnuc = vnuc.reshape(cc.nx, cc.ny, cc.nz)
-    mep = mep.reshape(cc.nx, cc.ny, cc.nz)
-    if save_cube_file:
-        # Write out density to the .cube file
-        outfile = f"{rwd}/rho_{outfile_head}.cube"
-        cc.write(rho, outfile, comment='Electron density in real space (e/Bohr^3)')
-        outfile = f"{rwd}/vnuc_{outfile_head}.cube"
-        cc.write(mep, outfile, comment='Nuclei potential in real space (e/Bohr)')
-        outfile = f"{rwd}/mep_{outfile_head}.cube"
-        cc.write(vnuc, outfile,
-                 comment='Molecular electrostatic potential in real space')
-    return {'rho': rho,
-            'grid': grid,
-            'Vnuc': vnuc,
-            'mep': mep,
-            }
+    cc = cube_grid(mol_inf, nx, ny, nz, resolution, margin)
+    grid = cc.coords()
+
+    if grid.shape[1] != 3:
+        assert 0
+
+    buffers = allocate_buffers(['rho', 'vnuc', 'mep'], grid.shape[0], memmap_dir)
+    comments = {'rho': 'Electron density in real space (e/Bohr^3)',
+                'vnuc': 'Nuclei potential in real space (e/Bohr)',
+                'mep': 'Molecular electrostatic potential in real space'}
+    with ExitStack() as stack:
+        sinks = {}
+        if save_cube_file:
+            # Write out the .cube/.vol files while the fields are evaluated
+            sinks = _open_sinks(stack, cc, comments, outfile_head, rwd, formats)
+        stream_evaluate(f_chunk, grid, buffers, sinks, chunk_size)
+
+        if mep_method == 'fft':
+            rho = jnp.asarray(buffers['rho']).reshape(cc.shape)
+            v_elec = onp.asarray(poisson_on_grid(rho, jnp.asarray(cube_spacing(cc)))).ravel()
+            buffers['mep'][:] = buffers['vnuc'] - v_elec
+            for sink in sinks.get('mep', ()):
+                sink.write(buffers['mep'])
+
+    out = {'rho': buffers['rho'].reshape(cc.shape),
+           'grid': grid,
+           'Vnuc': buffers['vnuc'].reshape(cc.shape),
+           'mep': buffers['mep'].reshape(cc.shape),
+           }
+    if save_cube_file and 'npz' in formats:
+        write_npz(f"{rwd}/{outfile_head}.npz", {k: out[n] for k, n in (('rho', 'rho'), ('vnuc', 'Vnuc'), ('mep', 'mep'))},
+                  cc)
+    if n_check > 0:
+        out['mep_check'] = mep_accuracy(f_density, mol_inf, grid,
+                                        buffers['vnuc'] - buffers['mep'], n_check, grid_level=grid_level)
+        print(f"MEP ({mep_method}) vs direct sum on {n_check} points: {out['mep_check']}")
+    return out
 
 
 def cube_generator(rho_rev: callable, mol_info: any,
                    outfile: str = 'molecule', rwd: str = './', save_cube_file: bool = True,
-                   nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.):
-
+                   nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.,
+                   chunk_size: int = 1024, memmap_dir: str = None,
+                   mep_method: str = 'fft', n_check: int = 0, grid_level: int = 3,
+                   formats: tuple = ('cube',)):
+    """
+    Density, nuclear potential and MEP cubes of one flow, 'rho_rev(x)' -> (N, 1), e.g.
+    'checkpoint_analysis.CachedDensities' of one checkpoint (through the density cache)
+    or a jitted density (bucketed), see '_density_and_mep'.
+    """
     mol_name = mol_info['mol_name']  # 'H2'
     Ne = mol_info['Ne']  # 2
     # jnp.array([[0., 0., -1.4008538753/2], [0., 0., 1.4008538753/2]])
     coords = mol_info['coords']
     z = mol_info['z']  # jnp.array([[1.], [1.]])
-    atoms = mol_info['atoms']  # ['H', 'H']
     mol_ = {'coords': coords, 'z': z}
 
-    # pyscf
-    mol = gto.M(atom=get_molecule(atoms, coords), basis='sto-3g',
-                unit='B')  # , symmetry = True)
-
-    cube_arrays = _density_and_mep(f_density=rho_rev, mol_inf=mol_, mol_pyscf=mol,
+    cube_arrays = _density_and_mep(f_density=rho_rev, mol_inf=mol_,
                                    outfile_head=outfile, rwd=rwd,
                                    save_cube_file=save_cube_file,
                                    nx=nx, ny=ny, nz=nz,
-                                   resolution=resolution, margin=margin)
+                                   resolution=resolution, margin=margin,
+                                   chunk_size=chunk_size, memmap_dir=memmap_dir,
+                                   mep_method=mep_method, n_check=n_check, grid_level=grid_level,
+                                   formats=formats)
     return cube_arrays
-    # cube_density, cube_grid = _density(f_density=rho_rev, mol_pyscf=mol, outfile=outfile,
+    # cube_density, cube_grid = _density(f_density=rho_rev, mol_inf=mol_, outfile=outfile,
     #                                    save_cube_file=save_cube_file,
     #                                    nx=nx, ny=ny, nz=nz,
     #                                    resolution=resolution, margin=margin)
-    # return cube_density, cube_grid
\ No newline at end of file
+    # return cube_density, cube_grid
+
+
+def cube_generator_epochs(rho_epochs: callable, mol_info: any, steps: list,
+                          outfile: str = 'molecule', rwd: str = './', save_cube_file: bool = True,
+                          nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.,
+                          chunk_size: int = 1024, memmap_dir: str = None, formats: tuple = ('cube',),
+                          bool_mep: bool = True):
+    """'cube_generator' for several checkpoints at once, 'rho_epochs(x)' -> (N, len(steps))."""
+    mol_ = {'coords': mol_info['coords'], 'z': mol_info['z']}
+    return _density_epochs(f_densities=rho_epochs, mol_inf=mol_, steps=steps,
+                           outfile_head=outfile, rwd=rwd, save_cube_file=save_cube_file,
+                           nx=nx, ny=ny, nz=nz, resolution=resolution, margin=margin,
+                           chunk_size=chunk_size, memmap_dir=memmap_dir, formats=formats,
+                           bool_mep=bool_mep)
+
+
+def adaptive_cube_generator(rho_rev: callable, mol_info: any,
+                            outfile: str = 'molecule', rwd: str = './', save_cube_file: bool = True,
+                            nx: int = 80, ny: int = 80, nz: int = 80, resolution: any = None, margin: float = 5.,
+                            n0: int = 8, max_level: int = 4, atol: float = 3E-4, gtol: float = None,
+                            formats: tuple = ('cube',), bool_mep: bool = True):
+    """
+    'cube_generator' with the density evaluated on an adaptive octree ('octree.build_octree')
+    over the cube box instead of every cube point; the cells are refined where the
+    density (or, with 'gtol', its gradient) changes quickly and around the nuclei,
+    and the density is resampled (trilinear in the leaves) to the uniform cube for export.
+
+    H2 CNF (64, 64), 80^3 cube: 35k reverse-ODE evaluations instead of 512k (14 s vs
+    113 s on CPU), within 1 Bohr of the nuclei a median error of 1.3e-4 vs 2.0e-4 and a
+    relative L2 error of 2.1e-3 vs 3.6e-3 for the uniform cube (trilinear interpolation),
+    see also 'python -m ofdft_normflows.octree'.
+
+    The octree is saved in '{outfile}_octree.npz' ('octree.Octree.load'), with
+    'bool_mep' the MEP of the resampled density is computed by the FFT Poisson solve.
+    """
+    coords = onp.asarray(mol_info['coords']).reshape(-1, 3)
+    mol_ = {'coords': mol_info['coords'], 'z': mol_info['z']}
+    grid = cube_grid(mol_, nx, ny, nz, resolution, margin)
+
+    extent = onp.diag(grid.axes)*(onp.array(grid.shape) - 1)
+    tree = build_octree(rho_rev, grid.origin, extent, n0, max_level, atol, gtol, nuclei=coords)
+    print(f'octree: {tree.n_evaluations} density evaluations ({grid.coords().shape[0]} cube points), '
+          f'{tree.n_leaves} leaves, N = {tree.integral():.6f}')
+    out = {'rho': tree.to_grid(grid), 'grid': grid.coords(), 'octree': tree}
+
+    comments = {'rho': 'Electron density in real space (e/Bohr^3)'}
+    if bool_mep:
+        from ofdft_normflows.functionals import Nuclei_potential
+        f_vnuc = BucketedFunction(jax.jit(lambda x: -1.*Nuclei_potential(x=x, Ne=1., mol_info=mol_)))
+        out['Vnuc'] = onp.asarray(f_vnuc(jnp.asarray(out['grid']))).reshape(grid.shape)
+        v_elec = poisson_on_grid(jnp.asarray(out['rho']), jnp.asarray(cube_spacing(grid)))
+        out['mep'] = out['Vnuc'] - onp.asarray(v_elec)
+        comments.update({'vnuc': 'Nuclei potential in real space (e/Bohr)',
+                         'mep': 'Molecular electrostatic potential in real space'})
+
+    if save_cube_file:
+        fields = {k: out['Vnuc' if k == 'vnuc' else k] for k in comments}
+        with ExitStack() as stack:
+            sinks = _open_sinks(stack, grid, comments, outfile, rwd, formats)
+            for k, v in fields.items():
+                for sink in sinks[k]:
+                    sink.write(v.ravel())
+        if 'npz' in formats:
+            write_npz(f"{rwd}/{outfile}.npz", fields, grid)
+        tree.save(f"{rwd}/{outfile}_octree.npz")
+    return out
@@ -14,9 +14,10 @@ from flax.training import checkpoints
 from distrax import MultivariateNormalDiag
 
 from ofdft_normflows.utils_cubegen import cube_generator
-from ofdft_normflows.cn_flows import neural_ode
+from ofdft_normflows.jax_ode import neural_ode
 from ofdft_normflows.cn_flows import Gen_CNFSimpleMLP as CNF
 from ofdft_normflows.dft_distrax import DFTDistribution
+from ofdft_normflows.checkpoint_analysis import restore_checkpoints, density_profiles, density_tag
 
 BHOR = 1.8897259886
 
@@ -118,19 +119,6 @@ def plot_rho_h2(epochs: list, CKPT_DIR: str, nn_arch: tuple = (512, 512, 512,)):
         logp_x = prior_dist.log_prob(z0)[:, None] - logp_z0
         return Ne*jnp.exp(logp_x)  # logp_x
 
-    @jax.jit
-    def rho_rev(x): return _rho_rev(params, x)
-    # load pretrained model
-
-    def get_params(ei: int):
-        if ei > 0:
-            restored_state = checkpoints.restore_checkpoint(
-                ckpt_dir=f"{CKPT_DIR}/checkpoints_all/", target=params, step=ei)
-            return restored_state
-        else:
-            return params
-
-    # 1D Figure
     # 1D Figure
     xt = jnp.linspace(-4.5, 4.5, 1000)
     yz = jnp.zeros((xt.shape[0], 2))
@@ -139,23 +127,23 @@ def plot_rho_h2(epochs: list, CKPT_DIR: str, nn_arch: tuple = (512, 512, 512,)):
     m = DFTDistribution(atoms, coords)
     rho_exact = m.prob(m, zt)
 
-    rho_pred_epochs = {}
-    for ei in epochs:
-        params = get_params(ei)
-        rho_pred_ei = rho_rev(params, zt)
-        rho_pred_epochs[ei] = rho_pred_ei
+    # all the checkpoints restored in parallel and evaluated by one compiled function (or read from the density cache)
+    params_epochs = restore_checkpoints(f"{CKPT_DIR}/checkpoints_all/", epochs, params)
+    rho_pred = density_profiles(_rho_rev, params_epochs, zt, density_tag({'mol_name': mol_name, 'Ne': Ne}, 'CNF'))
+    rho_pred_epochs = {ei: rho_pred[i] for i, ei in enumerate(epochs)}
 
     FIG_DIR = f"{CKPT_DIR}/Figures"
     fig, ax = plt.subplots()
     plt.plot(xt, rho_exact,
              color='k', ls=":", label=r"$\hat{\rho}_{{\cal M}}$")
-    plt.plot(xt, rho_pred_epochs[0],
-             color='k', ls="--", label=r"$N_{e}\rho_{0}$")
+    if 0 in rho_pred_epochs:
+        plt.plot(xt, rho_pred_epochs[0],
+                 color='k', ls="--", label=r"$N_{e}\rho_{0}$")
     for i, k in enumerate(rho_pred_epochs):
         if k != 0:
             rho_ei = rho_pred_epochs[k]
-            plt.plot(xt, rho_pred_epochs[ei],
-                     color='tab:blue', ls="--", label=r"$\rho_{{\cal M}}(%s)$" % ei)
+            plt.plot(xt, rho_ei,
+                     color='tab:blue', ls="--", label=r"$\rho_{{\cal M}}(%s)$" % k)
     plt.xlabel('X [Bhor]')
     plt.legend()
     plt.tight_layout()
@@ -0,0 +1,460 @@
+import os
+import json
+import time
+import zlib
+import itertools
+from dataclasses import dataclass
+from typing import Any, Optional, Sequence
+
+import numpy as onp
+
+# only NumPy, post-processing scripts can read volumes without importing JAX or PySCF
+
+CUBE_VALUE_FMT = '%13.5E'
+VOL_EXT = '.vol'
+DEFAULT_CHUNKS = (32, 32, 32)
+
+
+@dataclass
+class VolumeGrid:
+    """
+    Uniform grid of a volume, 'origin' (3,), step vectors 'axes' (3, 3) (rows), number
+    of points per axis 'shape' and the atoms (charges 'atom_z' and coordinates
+    'atom_coords', Bohr) written in the .cube header.
+    """
+    origin: onp.ndarray
+    axes: onp.ndarray
+    shape: tuple
+    atom_z: onp.ndarray
+    atom_coords: onp.ndarray
+
+    @classmethod
+    def from_cube(cls, cc: Any) -> 'VolumeGrid':
+        """Grid of a 'pyscf.tools.cubegen.Cube'."""
+        steps = [xs[-1] if len(xs) == 1 else xs[1] for xs in (cc.xs, cc.ys, cc.zs)]
+        mol = cc.mol
+        return cls(origin=onp.asarray(cc.boxorig, dtype=float),
+                   axes=(cc.box.T*steps).T,
+                   shape=(cc.nx, cc.ny, cc.nz),
+                   atom_z=onp.array([mol.atom_charge(ia) for ia in range(mol.natm)]),
+                   atom_coords=onp.asarray(mol.atom_coords()))
+
+    @classmethod
+    def from_molecule(cls, atom_z: Any, atom_coords: Any, nx: int = 80, ny: int = 80, nz: int = 80,
+                      resolution: Optional[float] = None, margin: float = 5.) -> 'VolumeGrid':
+        """
+        Box of a 'pyscf.tools.cubegen.Cube' of the nuclei without building a PySCF molecule,
+        the nuclei plus 'margin' on every side and 'nx' x 'ny' x 'nz' points (or 'resolution'
+        spacing), the end points included.
+        """
+        atom_coords = onp.asarray(atom_coords, dtype=float).reshape(-1, 3)
+        extent = atom_coords.max(0) - atom_coords.min(0) + 2*margin
+        shape = (nx, ny, nz)
+        if resolution is not None:
+            shape = tuple(int(n) for n in onp.ceil(extent/resolution))
+        steps = [e/(n - 1) if n > 1 else e for e, n in zip(extent, shape)]
+        return cls(origin=atom_coords.min(0) - margin,
+                   axes=onp.diag(steps),
+                   shape=shape,
+                   atom_z=onp.asarray(atom_z, dtype=float).ravel(),
+                   atom_coords=atom_coords)
+
+    def coords(self) -> onp.ndarray:
+        """Points of the grid, (nx*ny*nz, 3), x slowest (same order as 'Cube.get_coords')."""
+        idx = onp.stack(onp.meshgrid(*[onp.arange(n) for n in self.shape], indexing='ij'), -1)
+        return idx.reshape(-1, 3) @ self.axes + self.origin
+
+    def to_dict(self) -> dict:
+        return {'origin': onp.asarray(self.origin).tolist(), 'axes': onp.asarray(self.axes).tolist(),
+                'shape': [int(n) for n in self.shape], 'atom_z': onp.asarray(self.atom_z).tolist(),
+                'atom_coords': onp.asarray(self.atom_coords).tolist()}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'VolumeGrid':
+        return cls(origin=onp.array(d['origin']), axes=onp.array(d['axes']), shape=tuple(d['shape']),
+                   atom_z=onp.array(d['atom_z']), atom_coords=onp.array(d['atom_coords']).reshape(-1, 3))
+
+
+# ------------------------------------------------------------------------------------------------------------
+# GAUSSIAN CUBE (TEXT)
+# ------------------------------------------------------------------------------------------------------------
+
+def cube_header(grid: VolumeGrid, comment: Optional[str] = None) -> str:
+    """Header of a Gaussian .cube file (same layout as 'pyscf.tools.cubegen.Cube.write')."""
+    if comment is None:
+        comment = 'Generic field? Supply the optional argument "comment" to define this line'
+    lines = [comment, f'ofdft_normflows  Date: {time.ctime()}',
+             f'{len(grid.atom_z):5d}' + '%12.6f%12.6f%12.6f' % tuple(grid.origin)]
+    for n, d in zip(grid.shape, grid.axes):
+        lines.append(f'{n:5d}{d[0]:12.6f}{d[1]:12.6f}{d[2]:12.6f}')
+    for z, r in zip(grid.atom_z, grid.atom_coords):
+        lines.append('%5d%12.6f' % (int(z), 0.) + '%12.6f%12.6f%12.6f' % tuple(r))
+    return '\n'.join(lines) + '\n'
+
+
+_CUBE_WIDTH = 13
+# characters of 000 ... 999
+_DIGITS_3 = onp.array([list(f'{i:03d}'.encode()) for i in range(1000)], dtype=onp.uint8)
+
+
+def format_cube_values(values: onp.ndarray) -> onp.ndarray:
+    """
+    Characters of CUBE_VALUE_FMT ('%13.5E') of every value, (N, 13) uint8, built with
+    array operations (sign, 6 significant digits and the exponent of every value at once).
+    Values whose text the arrays cannot reproduce exactly (non-finite, 3-digit exponents,
+    rounding within 1E-6 of a tie) are formatted with '%' one by one.
+    """
+    v = onp.asarray(values, dtype=float).ravel()
+    a = onp.abs(v)
+    finite = onp.isfinite(v)
+    nonzero = finite & (a > 0.)
+    # 3-digit exponents are formatted one by one, the others are scaled without overflow
+    safe = onp.where(nonzero & (a > 1E-150) & (a < 1E150), a, 1.)
+    e = onp.floor(onp.log10(safe)).astype(onp.int64)
+    for _ in range(2):
+        # log10 can be one off next to a power of ten
+        scaled = safe*10.**(5 - e)
+        e = e - (scaled < 1E5) + (scaled >= 1E6)
+    scaled = safe*10.**(5 - e)
+    frac = scaled - onp.floor(scaled)
+    m = onp.rint(scaled).astype(onp.int64)
+    carry = m >= 1000000
+    m = onp.where(carry, 100000, m)
+    e = e + carry
+    m = onp.where(nonzero, m, 0)
+    e = onp.where(nonzero, e, 0)
+    slow = ~finite | ((safe != a) & nonzero) | (onp.abs(e) >= 100) | (nonzero & (onp.abs(frac - 0.5) < 1E-6))
+
+    # one contiguous row per character, transposed at the end
+    chars = onp.empty((_CUBE_WIDTH, v.shape[0]), dtype=onp.uint8)
+    hi, lo = _DIGITS_3.T[:, m//1000], _DIGITS_3.T[:, m % 1000]
+    chars[0] = ord(' ')
+    chars[1] = onp.where(onp.signbit(v), ord('-'), ord(' '))
+    chars[2] = hi[0]
+    chars[3] = ord('.')
+    chars[4:6] = hi[1:]
+    chars[6:9] = lo
+    chars[9] = ord('E')
+    chars[10] = onp.where(e < 0, ord('-'), ord('+'))
+    chars[11:] = _DIGITS_3.T[1:, onp.minimum(onp.abs(e), 99)]
+    out = onp.ascontiguousarray(chars.T)
+    for i in onp.flatnonzero(slow):
+        out[i] = onp.frombuffer((CUBE_VALUE_FMT % v[i]).encode(), dtype=onp.uint8)
+    return out
+
+
+class CubeWriter:
+    """
+    Streaming .cube writer, the values arrive in grid order (x slowest) in chunks of any
+    size and every complete (ix, iy) row of 'nz' values is written (6 values per line).
+    The text of a chunk is assembled as one byte array ('format_cube_values' and the
+    line breaks inserted at fixed offsets), the same text as 'Cube.write'.
+    """
+
+    def __init__(self, fname: str, grid: VolumeGrid, comment: Optional[str] = None):
+        self.fname = fname
+        self.grid = grid
+        self.comment = comment
+        nz = grid.shape[2]
+        # offsets of the line breaks in the characters of one row
+        self.breaks = onp.append(onp.arange(6, nz, 6), nz)*_CUBE_WIDTH
+        self.rest = onp.zeros(0)
+
+    def __enter__(self):
+        self.f = open(self.fname, 'w')
+        self.f.write(cube_header(self.grid, self.comment))
+        return self
+
+    def write(self, values: onp.ndarray):
+        nz = self.grid.shape[2]
+        values = onp.concatenate((self.rest, onp.ravel(values)))
+        n_rows = values.shape[0]//nz
+        if n_rows > 0:
+            chars = format_cube_values(values[:n_rows*nz]).reshape(n_rows, nz*_CUBE_WIDTH)
+            chars = onp.insert(chars, self.breaks, ord('\n'), axis=1)
+            self.f.write(chars.tobytes().decode('ascii'))
+        self.rest = values[n_rows*nz:]
+
+    def __exit__(self, *exc):
+        self.f.close()
+        if exc[0] is None and self.rest.shape[0] > 0:
+            raise ValueError(f'{self.fname}: {self.rest.shape[0]} values left, incomplete grid')
+
+
+def write_cube(fname: str, values: onp.ndarray, grid: VolumeGrid, comment: Optional[str] = None):
+    with CubeWriter(fname, grid, comment) as w:
+        w.write(values)
+
+
+def read_cube(fname: str):
+    """Reads a .cube file, returns the values (nx, ny, nz) and the 'VolumeGrid'."""
+    with open(fname) as f:
+        f.readline()
+        f.readline()
+        natm, *origin = f.readline().split()
+        natm = abs(int(natm))
+        shape, axes = [], []
+        for _ in range(3):
+            n, *ax = f.readline().split()
+            shape.append(int(n))
+            axes.append([float(a) for a in ax])
+        atoms = onp.array([[float(v) for v in f.readline().split()] for _ in range(natm)]).reshape(-1, 5)
+        values = onp.array(f.read().split(), dtype=float)
+    grid = VolumeGrid(origin=onp.array(origin, dtype=float), axes=onp.array(axes), shape=tuple(shape),
+                      atom_z=atoms[:, 0].astype(int), atom_coords=atoms[:, 2:])
+    return values.reshape(shape), grid
+
+
+# ------------------------------------------------------------------------------------------------------------
+# NPZ
+# ------------------------------------------------------------------------------------------------------------
+
+def write_npz(fname: str, fields: dict, grid: VolumeGrid, dtype: Any = onp.float32):
+    """All the fields (nx, ny, nz) and the grid in one compressed .npz file (float32 by default)."""
+    arrays = {k: onp.asarray(v, dtype=dtype).reshape(grid.shape) for k, v in fields.items()}
+    onp.savez_compressed(fname, **arrays, _grid=onp.array(json.dumps(grid.to_dict())))
+
+
+# ------------------------------------------------------------------------------------------------------------
+# CHUNKED (zarr-like directory of zlib-compressed chunks)
+# ------------------------------------------------------------------------------------------------------------
+
+def _chunk_name(index: Sequence[int]) -> str:
+    return '.'.join(str(i) for i in index)
+
+
+class ChunkedVolumeWriter:
+    """
+    Writes fields into a '.vol' directory, 'meta.json' and one zlib-compressed float32
+    file per (cx, cy, cz) chunk of every field ('{field}/i.j.k'). Fields can be streamed
+    in grid order with 'sink(name).write(values)' (e.g. as 'stream_evaluate' sinks) or
+    written at once with 'write_field'.
+    """
+
+    def __init__(self, path: str, grid: VolumeGrid, chunks: Sequence[int] = DEFAULT_CHUNKS,
+                 dtype: Any = onp.float32, level: int = 4, attrs: Optional[dict] = None):
+        self.path = path
+        self.grid = grid
+        self.chunks = tuple(min(c, n) for c, n in zip(chunks, grid.shape))
+        self.dtype = onp.dtype(dtype)
+        self.level = level
+        self.attrs = {} if attrs is None else attrs
+        self.fields = {}
+
+    def __enter__(self):
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def _write_slab(self, name: str, ix0: int, slab: onp.ndarray):
+        """Writes the chunks of the planes [ix0, ix0 + slab.shape[0]) of a field."""
+        cx, cy, cz = self.chunks
+        i = ix0//cx
+        for j, k in itertools.product(range(-(-self.grid.shape[1]//cy)), range(-(-self.grid.shape[2]//cz))):
+            block = onp.ascontiguousarray(slab[:, j*cy:(j + 1)*cy, k*cz:(k + 1)*cz], dtype=self.dtype)
+            with open(os.path.join(self.path, name, _chunk_name((i, j, k))), 'wb') as f:
+                f.write(zlib.compress(block.tobytes(), self.level))
+
+    def sink(self, name: str, comment: Optional[str] = None) -> '_FieldSink':
+        os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        self.fields[name] = comment
+        return _FieldSink(self, name)
+
+    def write_field(self, name: str, values: onp.ndarray, comment: Optional[str] = None):
+        self.sink(name, comment).write(values)
+
+    def __exit__(self, *exc):
+        meta = {'format': 'ofdft_normflows.vol', 'version': 1, 'dtype': self.dtype.str,
+                'chunks': list(self.chunks), 'grid': self.grid.to_dict(),
+                'fields': self.fields, 'attrs': self.attrs}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+
+
+class _FieldSink:
+    """Buffers the streamed values of one field until a slab of 'cx' planes is complete."""
+
+    def __init__(self, writer: ChunkedVolumeWriter, name: str):
+        self.writer = writer
+        self.name = name
+        self.rest = onp.zeros(0)
+        self.ix = 0
+
+    def write(self, values: onp.ndarray):
+        _, ny, nz = self.writer.grid.shape
+        nx = self.writer.grid.shape[0]
+        cx = self.writer.chunks[0]
+        values = onp.concatenate((self.rest, onp.ravel(values)))
+        plane = ny*nz
+        while values.shape[0] >= cx*plane or (self.ix + values.shape[0]//plane == nx and values.shape[0] >= plane):
+            n_planes = min(cx, values.shape[0]//plane)
+            slab = values[:n_planes*plane].reshape(n_planes, ny, nz)
+            self.writer._write_slab(self.name, self.ix, slab)
+            self.ix += n_planes
+            values = values[n_planes*plane:]
+        self.rest = values
+
+
+class ChunkedArray:
+    """
+    Read-only view of one field of a '.vol' store, 'a[i0:i1, :, k]' decompresses only
+    the chunks that intersect the selection (positive steps and integer indices).
+    """
+
+    def __init__(self, path: str, name: str, meta: dict):
+        self.path = os.path.join(path, name)
+        self.shape = tuple(meta['grid']['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = onp.dtype(meta['dtype'])
+        self.ndim = 3
+
+    def _chunk(self, index: tuple) -> onp.ndarray:
+        shape = tuple(min(c, n - i*c) for c, n, i in zip(self.chunks, self.shape, index))
+        with open(os.path.join(self.path, _chunk_name(index)), 'rb') as f:
+            return onp.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(shape)
+
+    def __getitem__(self, key: Any) -> onp.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(3 - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),)*(3 - len(key))
+        lo, hi, steps, squeeze = [], [], [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 1:
+                    raise IndexError('only positive steps are supported')
+                lo.append(start)
+                hi.append(max(start, stop))
+                steps.append(step)
+                squeeze.append(False)
+            else:
+                k = int(k) + (n if int(k) < 0 else 0)
+                if not 0 <= k < n:
+                    raise IndexError(f'index {k} out of bounds for axis of size {n}')
+                lo.append(k)
+                hi.append(k + 1)
+                steps.append(1)
+                squeeze.append(True)
+
+        out = onp.empty([h - l for l, h in zip(lo, hi)], dtype=self.dtype)
+        ranges = [range(l//c, -(-h//c)) for l, h, c in zip(lo, hi, self.chunks)]
+        for index in itertools.product(*ranges):
+            block = self._chunk(index)
+            src, dst = [], []
+            for i, l, h, c in zip(index, lo, hi, self.chunks):
+                b0, b1 = max(l, i*c), min(h, (i + 1)*c)
+                src.append(slice(b0 - i*c, b1 - i*c))
+                dst.append(slice(b0 - l, b1 - l))
+            out[tuple(dst)] = block[tuple(src)]
+        out = out[tuple(slice(None, None, s) for s in steps)]
+        return out[tuple(0 if s else slice(None) for s in squeeze)]
+
+    def __array__(self, dtype: Any = None) -> onp.ndarray:
+        a = self[:, :, :]
+        return a if dtype is None else a.astype(dtype)
+
+
+class Volume:
+    """
+    Fields and grid of a volumetric file ('.vol' directory, '.npz' or '.cube'),
+    'vol[name]' is a lazily sliceable 'ChunkedArray' for '.vol' stores and a
+    NumPy array otherwise.
+    """
+
+    def __init__(self, fields: dict, grid: VolumeGrid, comments: Optional[dict] = None):
+        self.fields = fields
+        self.grid = grid
+        self.comments = {} if comments is None else comments
+
+    def __getitem__(self, name: str) -> Any:
+        return self.fields[name]
+
+    def keys(self):
+        return self.fields.keys()
+
+    def __repr__(self) -> str:
+        return f"Volume(shape={tuple(self.grid.shape)}, fields={list(self.fields)})"
+
+
+def open_volume(path: str) -> Volume:
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        fields = {k: ChunkedArray(path, k, meta) for k in meta['fields']}
+        return Volume(fields, VolumeGrid.from_dict(meta['grid']), meta['fields'])
+    if path.endswith('.npz'):
+        data = onp.load(path)
+        grid = VolumeGrid.from_dict(json.loads(str(data['_grid'])))
+        return Volume({k: data[k] for k in data.files if k != '_grid'}, grid)
+    if path.endswith('.cube'):
+        values, grid = read_cube(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        return Volume({name: values}, grid)
+    raise ValueError(f"Unknown volumetric format '{path}'.")
+
+
+def to_cube(path: str, field: str, fname: Optional[str] = None) -> str:
+    """Converts one field of a '.vol'/'.npz' file back to a .cube file (for external viewers)."""
+    vol = open_volume(path)
+    if fname is None:
+        fname = f"{os.path.splitext(path.rstrip('/'))[0]}_{field}.cube"
+    grid = vol.grid
+    with CubeWriter(fname, grid, vol.comments.get(field) or f'{field} from {os.path.basename(path)}') as w:
+        for ix in range(grid.shape[0]):
+            w.write(onp.asarray(vol[field][ix]))
+    return fname
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Volumetric files (.vol, .npz, .cube)")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_info = sub.add_parser('info', help="grid and fields of a file")
+    p_info.add_argument("path", type=str)
+    p_cube = sub.add_parser('to_cube', help="convert a field to .cube")
+    p_cube.add_argument("path", type=str)
+    p_cube.add_argument("--field", type=str, default='rho')
+    p_cube.add_argument("--out", type=str, default=None)
+    p_bench = sub.add_parser('benchmark', help="write/read times and sizes of the formats")
+    p_bench.add_argument("--n", type=int, default=80, help="points per axis")
+    p_bench.add_argument("--rwd", type=str, default='.', help="output directory")
+    args = parser.parse_args()
+
+    if args.cmd == 'info':
+        vol = open_volume(args.path)
+        print(vol, '\norigin', vol.grid.origin, '\naxes', vol.grid.axes.tolist())
+    elif args.cmd == 'to_cube':
+        print(to_cube(args.path, args.field, args.out))
+    else:
+        n = args.n
+        grid = VolumeGrid(origin=-5.*onp.ones(3), axes=onp.eye(3)*10./(n - 1), shape=(n, n, n),
+                          atom_z=onp.array([1, 1]), atom_coords=onp.array([[0., 0., -0.7], [0., 0., 0.7]]))
+        x = grid.coords()
+        rho = (onp.exp(-2.*onp.linalg.norm(x - grid.atom_coords[0], axis=1))
+               + onp.exp(-2.*onp.linalg.norm(x - grid.atom_coords[1], axis=1)))/onp.pi
+
+        def _size(p):
+            if os.path.isdir(p):
+                return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(p) for f in fs)
+            return os.path.getsize(p)
+
+        paths = {'cube': f'{args.rwd}/bench.cube', 'npz': f'{args.rwd}/bench.npz', 'vol': f'{args.rwd}/bench{VOL_EXT}'}
+        start = time.time()
+        write_cube(paths['cube'], rho, grid, 'density')
+        t_cube = time.time() - start
+        start = time.time()
+        write_npz(paths['npz'], {'rho': rho}, grid)
+        t_npz = time.time() - start
+        start = time.time()
+        with ChunkedVolumeWriter(paths['vol'], grid) as w:
+            w.write_field('rho', rho)
+        t_vol = time.time() - start
+        for k, t in zip(paths, (t_cube, t_npz, t_vol)):
+            start = time.time()
+            a = open_volume(paths[k])
+            a = onp.asarray(a[list(a.keys())[0]])[n//2]
+            print(f'{k:>5}: write {t:.2f} s, {_size(paths[k])/2**20:.1f} MiB, '
+                  f'read one plane {time.time() - start:.3f} s')